@@ -0,0 +1,1118 @@
+"""
+Benchmarks del convertidor de documentos a audio.
+
+Se ejecutan sin conexión usando el motor de voz local (StubTTSBackend) y trabajan
+en un directorio temporal para no modificar las carpetas cache/, audio/ ni temp/ del proyecto.
+
+Uso:
+    python benchmark.py cache
+    python benchmark.py sqlite
+    python benchmark.py taskstore
+    python benchmark.py pipeline
+    python benchmark.py concat
+    python benchmark.py disk
+    python benchmark.py coalesce
+    python benchmark.py similarity
+    python benchmark.py split
+    python benchmark.py chunksize
+    python benchmark.py normalize
+    python benchmark.py docx
+    python benchmark.py isolation
+    python benchmark.py fairness
+"""
+import argparse
+import hashlib
+import math
+import multiprocessing
+import os
+import random
+import resource
+import sqlite3
+import sys
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+import unicodedata
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+# Importar main.py desde un directorio de trabajo temporal
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, PROJECT_DIR)
+if __name__ == "__main__":
+    # Los procesos de extracción de PDF reimportan este módulo y heredan el directorio ya creado
+    os.chdir(tempfile.mkdtemp(prefix="benchmark_"))
+os.environ["TTS_BACKEND"] = "stub"
+
+import main
+import parsers
+
+WORDS = (
+    "el la los las de del en un una por para con sin sobre entre documento informe "
+    "resultado análisis proceso sistema datos usuario servicio tiempo parte caso forma "
+    "trabajo empresa gobierno proyecto desarrollo calidad medida nivel cambio política"
+).split()
+
+def make_paragraph(rng, sentences=4):
+    """Genera un párrafo sintético en español."""
+    parts = []
+    for _ in range(sentences):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(8, 20))]
+        parts.append(" ".join(words).capitalize() + ".")
+    return " ".join(parts)
+
+def make_document(rng, paragraphs=40):
+    """Genera un documento sintético con el número de párrafos indicado."""
+    return "\n".join(make_paragraph(rng) for _ in range(paragraphs))
+
+def make_pdf(path, rng, pages, lines_per_page=40):
+    """Escribe un PDF mínimo con texto sintético (una línea por frase, fuente Helvetica)."""
+    objects = {
+        1: "<< /Type /Catalog /Pages 2 0 R >>",
+        3: "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    }
+    page_ids = []
+    next_id = 4
+    for _ in range(pages):
+        lines = [" ".join(rng.choice(WORDS) for _ in range(10)) + "." for _ in range(lines_per_page)]
+        stream = "BT /F1 10 Tf 12 TL 50 780 Td " + " ".join(f"({line}) '" for line in lines) + " ET"
+        page_id, content_id = next_id, next_id + 1
+        next_id += 2
+        page_ids.append(page_id)
+        objects[page_id] = (f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>")
+        objects[content_id] = f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream"
+    objects[2] = f"<< /Type /Pages /Kids [{' '.join(f'{i} 0 R' for i in page_ids)}] /Count {len(page_ids)} >>"
+    
+    data = b"%PDF-1.4\n"
+    offsets = {}
+    for object_id in sorted(objects):
+        offsets[object_id] = len(data)
+        data += f"{object_id} 0 obj\n{objects[object_id]}\nendobj\n".encode("latin-1")
+    xref = len(data)
+    data += f"xref\n0 {next_id}\n0000000000 65535 f \n".encode()
+    data += "".join(f"{offsets[i]:010d} 00000 n \n" for i in range(1, next_id)).encode()
+    data += f"trailer\n<< /Size {next_id} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, "wb") as f:
+        f.write(data)
+
+def use_stub_backend(latency=0.0, per_char_latency=0.0):
+    """Activa el motor local y quita el límite de velocidad pensado para el servicio real."""
+    backend = main.StubTTSBackend(latency=latency, per_char_latency=per_char_latency)
+    main.set_tts_backend(backend)
+    main.tts_dispatcher.rate_limiter = main.TokenBucket(rate=1e9, capacity=1e9)
+    return backend
+
+def run_chunks(text, lang="es"):
+    """Procesa un texto con process_chunks_parallel como una tarea nueva y devuelve la tarea."""
+    task_id = new_task()
+    main.process_chunks_parallel(main.split_text_optimized(text), task_id, lang=lang)
+    main.remove_task_segments(task_id)
+    return pop_task(task_id)
+
+def bench_cache(args):
+    """Tasa de aciertos del caché de fragmentos al procesar documentos repetidos."""
+    rng = random.Random(args.seed)
+    use_stub_backend(args.latency)
+    base_document = make_document(rng, args.paragraphs)
+    
+    print(f"{'ejecución':<28}{'aciertos':>10}{'fallos':>10}{'tiempo (s)':>12}")
+    for run in range(args.runs):
+        start = time.perf_counter()
+        status = run_chunks(base_document)
+        elapsed = time.perf_counter() - start
+        print(f"{'documento repetido #' + str(run + 1):<28}{status.get('cache_hits', 0):>10}"
+              f"{status.get('cache_misses', 0):>10}{elapsed:>12.3f}")
+    
+    # El mismo documento en otro idioma no debe reutilizar el audio
+    status = run_chunks(base_document, lang="en")
+    print(f"{'mismo texto, lang=en':<28}{status.get('cache_hits', 0):>10}{status.get('cache_misses', 0):>10}")
+    
+    stats = main.get_cache_hit_rate()
+    print(f"\nTasa de aciertos global: {stats['hit_rate']:.1%} "
+          f"({stats['hits']} aciertos, {stats['misses']} fallos)")
+    memory = main.memory_cache.stats()
+    print(f"Capa en memoria: {memory['hits']} aciertos, {memory['negative_hits']} fallos recordados, "
+          f"{memory['misses']} consultas a SQLite, {memory['invalidations']} invalidaciones")
+
+def new_task():
+    task_id = f"bench{random.getrandbits(48):x}"
+    main.task_store.create(task_id, {"status": "processing", "progress": 0, "start_time": time.time()})
+    return task_id
+
+def pop_task(task_id):
+    task = main.task_store.get(task_id)
+    main.task_store.delete(task_id)
+    return task
+
+def run_phased(pdf_path):
+    """Flujo por fases: extraer todo, dividir todo y después sintetizar."""
+    task_id = new_task()
+    text = main.extract_text_from_pdf_optimized(pdf_path)
+    main.process_chunks_parallel(main.split_text_optimized(text), task_id)
+    main.remove_task_segments(task_id)
+    return pop_task(task_id)
+
+def run_streaming(pdf_path):
+    """Flujo continuo: las páginas pasan al divisor y a la síntesis a medida que se extraen."""
+    task_id = new_task()
+    main.run_conversion_pipeline(task_id, pdf_path, "pdf")
+    main.remove_task_segments(task_id)
+    main.remove_task_text(task_id)
+    return pop_task(task_id)
+
+def bench_pipeline(args):
+    """Latencia hasta el primer audio y tiempo total: flujo por fases frente a flujo continuo."""
+    rng = random.Random(args.seed)
+    use_stub_backend(args.latency)
+    # Calentar el pool de procesos para no medir su arranque
+    make_pdf("warmup.pdf", rng, main.PDF_PAGES_PER_TASK * 2, lines_per_page=1)
+    main.extract_text_from_pdf_optimized("warmup.pdf")
+    
+    print(f"{args.pages} páginas, latencia del motor {args.latency}s, {main.MAX_WORKERS} hilos de síntesis\n")
+    print(f"{'flujo':<12}{'primer audio (s)':>18}{'total (s)':>12}{'fragmentos':>12}")
+    for name, runner in (("por fases", run_phased), ("continuo", run_streaming)):
+        # Un PDF distinto por flujo para que ninguno aproveche el caché del otro
+        pdf_path = f"{name.replace(' ', '_')}.pdf"
+        make_pdf(pdf_path, rng, args.pages)
+        start = time.perf_counter()
+        status = runner(pdf_path)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<12}{status['time_to_first_audio']:>18.2f}{elapsed:>12.2f}{status['chunks_total']:>12}")
+
+def legacy_lookup(db_path, text_hash):
+    """Búsqueda como se hacía antes: una conexión nueva por consulta."""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute('SELECT audio_path FROM text_chunks WHERE hash_id = ?', (text_hash,))
+    result = cursor.fetchone()
+    conn.close()
+    return result[0] if result else None
+
+def legacy_store(db_path, text_hash, text, audio_path):
+    """Inserción como se hacía antes: conexión nueva, SELECT y después INSERT."""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute('SELECT hash_id FROM text_chunks WHERE hash_id = ?', (text_hash,))
+    if cursor.fetchone() is None:
+        cursor.execute(
+            'INSERT INTO text_chunks (hash_id, text, audio_path, created_at) VALUES (?, ?, ?, ?)',
+            (text_hash, text, audio_path, int(time.time()))
+        )
+        conn.commit()
+    conn.close()
+
+def timed_rate(label, count, func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<44}{count / elapsed:>14,.0f} op/s")
+
+def bench_sqlite(args):
+    """Búsquedas e inserciones por segundo en el caché SQLite, antes y después del repositorio."""
+    rng = random.Random(args.seed)
+    texts = [make_paragraph(rng, 2) for _ in range(args.keys)]
+    keys = [main.chunk_cache_key(text, "es") for text in texts]
+    
+    legacy_db = "legacy.db"
+    conn = sqlite3.connect(legacy_db)
+    conn.execute('CREATE TABLE text_chunks (hash_id TEXT PRIMARY KEY, text TEXT, audio_path TEXT, created_at INTEGER)')
+    conn.close()
+    repository = main.CacheRepository("repository.db")
+    repository.init_schema()
+    
+    print(f"{len(keys)} claves, {args.threads} hilos\n")
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        timed_rate("antes: inserción (connect + SELECT + INSERT)", len(keys), lambda: list(executor.map(
+            lambda i: legacy_store(legacy_db, keys[i], texts[i], f"{keys[i]}.mp3"), range(len(keys)))))
+        timed_rate("después: INSERT OR IGNORE (WAL, por hilo)", len(keys), lambda: list(executor.map(
+            lambda i: repository.insert(keys[i], texts[i], f"{keys[i]}.mp3", "es", 0), range(len(keys)))))
+        timed_rate("antes: búsqueda (connect por consulta)", len(keys), lambda: list(executor.map(
+            lambda key: legacy_lookup(legacy_db, key), keys)))
+        timed_rate("después: búsqueda (conexión por hilo)", len(keys), lambda: list(executor.map(
+            repository.get_audio_path, keys)))
+    timed_rate("después: búsqueda por lotes (una consulta)", len(keys), lambda: repository.lookup_many(keys))
+
+def task_store_backends():
+    """Almacenes de tareas a comparar; Redis solo si el paquete está instalado y el servidor responde."""
+    stores = {"memory": main.MemoryTaskStore(), "sqlite": main.SQLiteTaskStore("tasks_bench.db")}
+    try:
+        store = main.RedisTaskStore(prefix=f"benchmark{os.getpid()}:")
+        store.client.ping()
+        stores["redis"] = store
+    except Exception as e:
+        print(f"(Redis no disponible: {e})")
+    for store in stores.values():
+        store.init()
+    return stores
+
+def run_task_store_operations(store):
+    """Secuencia fija de operaciones; devuelve cada resultado y el estado final de las tareas."""
+    results = []
+    store.create("t1", {"status": "queued", "progress": 0, "title": "Capítulo ñ — «uno»",
+                        "chunk_latency": {"p50": 1.0, "p95": 2.0, "samples": 10}})
+    results.append(store.update("t1", {"chunk_latency": {"p50": 3.0}, "error": None, "tags": ["a", "é"]}))
+    results.append(store.update_if("t1", "title", "Capítulo ñ — «uno»", {"owner": "w1"}))
+    results.append(store.update_if("t1", "error", None, {"retryable": None}))
+    results.append(store.update_if("t1", "missing", None, {"progress": 5}))
+    results.append(store.update_if("t1", "status", "error", {"progress": 99}))
+    results.append(store.update_if("t1", "tags", ["a", "é"], {"chunk_latency": None}))
+    results.append(store.update_if("t1", "progress", 6, {"progress": 99}))
+    store.increment("t1", "cache_hits")
+    store.increment("t1", "cache_hits", 2)
+    results.append(store.update("t1", {"status": "error", "completion_time": 10.0}))
+    results.append(sorted(store.finished_before(20.0)))
+    results.append(store.update_if("t1", "status", "error", {"status": "queued", "completion_time": None}))
+    results.append(sorted(store.finished_before(20.0)))
+    results.append(sorted(task_id for task_id, _ in store.unfinished()))
+    results.append(store.update("t2", {"status": "queued"}))
+    results.append(store.update_if("t2", "status", None, {"status": "queued"}))
+    results.append(store.claim_document("es:abc", "t1"))
+    results.append(store.claim_document("es:abc", "t2"))
+    results.append(store.replace_document("es:abc", "t2", "t3"))
+    results.append(store.replace_document("es:abc", "t1", "t3"))
+    store.release_document("es:abc", "t3")
+    results.append(store.claim_document("es:abc", "t2"))
+    final = store.get("t1")
+    store.delete("t1")
+    return results, final, store.get("t1")
+
+def check_task_stores(stores):
+    """Comprueba que todos los almacenes de tareas dan los mismos resultados que MemoryTaskStore."""
+    outcomes = {name: run_task_store_operations(store) for name, store in stores.items()}
+    for name, got in outcomes.items():
+        assert got == outcomes["memory"], f"{name}: {got} != {outcomes['memory']}"
+    print(f"Almacenes de tareas ({', '.join(stores)}): mismos resultados y mismo estado final\n")
+
+def bench_taskstore(args):
+    """Comprueba que los almacenes de tareas se comportan igual y mide sus actualizaciones por segundo."""
+    stores = task_store_backends()
+    check_task_stores(stores)
+    for name, store in stores.items():
+        task_ids = [f"bench{i}" for i in range(args.threads)]
+        for task_id in task_ids:
+            store.create(task_id, {"status": "processing", "progress": 0, "segments_ready": 0})
+        count = args.keys
+        with ThreadPoolExecutor(max_workers=args.threads) as executor:
+            timed_rate(f"{name}: update (progreso de un fragmento)", count, lambda: list(executor.map(
+                lambda i: store.update(task_ids[i % len(task_ids)], {"progress": i % 100, "segments_ready": i}),
+                range(count))))
+            timed_rate(f"{name}: get", count, lambda: list(executor.map(
+                lambda i: store.get(task_ids[i % len(task_ids)]), range(count))))
+        for task_id in task_ids:
+            store.delete(task_id)
+
+def make_chunk_mp3(path, frames, with_tags=True):
+    """Fragmento como los de un motor de voz real: ID3v2 + frame Info propio + audio."""
+    with open(path, "wb") as f:
+        if with_tags:
+            f.write(b"ID3\x04\x00\x00\x00\x00\x00\x20" + b"\x00" * 32)
+            f.write(main.build_xing_frame(main.SILENT_MP3_FRAME[:4], frames, frames * len(main.SILENT_MP3_FRAME)))
+        f.write(main.SILENT_MP3_FRAME * frames)
+
+def legacy_concatenate(input_files, output_file):
+    """Concatenación anterior: cada fragmento completo en memoria, con sus cabeceras."""
+    with open(output_file, 'wb') as outfile:
+        for fname in input_files:
+            with open(fname, 'rb') as infile:
+                outfile.write(infile.read())
+
+def declared_duration(path):
+    """Duración que anuncia la cabecera Info/Xing del principio del archivo (la que usan los reproductores)."""
+    with open(path, "rb") as f:
+        data = f.read(4096)
+    pos = main.id3v2_size(data)
+    info = main.parse_mp3_header(data[pos:pos + 4])
+    offset = pos + main.xing_offset(info)
+    if data[offset:offset + 4] not in (b"Xing", b"Info"):
+        return None
+    frames = int.from_bytes(data[offset + 8:offset + 12], "big")
+    return frames * info["samples"] / info["sample_rate"]
+
+def bench_concat(args):
+    """Tiempo, memoria y duración anunciada al concatenar un trabajo de muchos fragmentos."""
+    rng = random.Random(args.seed)
+    # Entre ~20 y ~55 s por fragmento, como un fragmento de 800 caracteres leído por gTTS
+    frame_counts = [rng.randint(800, 2300) for _ in range(args.chunks)]
+    chunk_files = []
+    for i, frames in enumerate(frame_counts):
+        path = f"chunk_{i}.mp3"
+        make_chunk_mp3(path, frames)
+        chunk_files.append(path)
+    expected = sum(frame_counts) * main.SILENT_MP3_FRAME_DURATION
+    
+    print(f"{args.chunks} fragmentos, duración real {expected:.1f} s\n")
+    print(f"{'método':<20}{'tiempo (s)':>12}{'pico memoria':>16}{'duración anunciada':>22}")
+    for name, func in (("antes", legacy_concatenate), ("por frames", main.concatenate_audio_files)):
+        output = f"{name.replace(' ', '_')}.mp3"
+        start = time.perf_counter()
+        func(chunk_files, output)
+        elapsed = time.perf_counter() - start
+        # Segunda pasada solo para medir memoria: tracemalloc ralentiza mucho el escaneo de frames
+        tracemalloc.start()
+        func(chunk_files, output)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        duration = declared_duration(output)
+        shown = f"{duration:.1f} s" if duration is not None else "-"
+        print(f"{name:<20}{elapsed:>12.3f}{peak / 1024:>13,.0f} KB{shown:>22}")
+
+def disk_usage(*directories):
+    """Bytes ocupados de verdad: cada inodo (los enlaces comparten uno) se cuenta una sola vez."""
+    sizes = {}
+    for directory in directories:
+        for root, _, files in os.walk(directory):
+            for name in files:
+                stat = os.stat(os.path.join(root, name))
+                sizes[(stat.st_dev, stat.st_ino)] = stat.st_size
+    return sum(sizes.values())
+
+def bench_disk(args):
+    """Disco usado al convertir varias veces el mismo documento: MP3 final frente a archivo virtual."""
+    rng = random.Random(args.seed)
+    use_stub_backend()
+    document = make_document(rng, args.paragraphs)
+    
+    final_bytes = 0
+    print(f"{'ejecución':<14}{'antes (MB)':>14}{'virtual (MB)':>16}")
+    for run in range(args.runs):
+        task_id = new_task()
+        audio_files = main.process_chunks_parallel(main.split_text_optimized(document), task_id)
+        manifest = main.build_audio_manifest(task_id, audio_files)
+        # Antes: cada tarea escribía además un MP3 final con todos sus fragmentos copiados
+        final_bytes += manifest["size"]
+        store_bytes = disk_usage(main.AUDIO_CACHE_DIR)
+        virtual_bytes = disk_usage(main.AUDIO_CACHE_DIR, main.SEGMENTS_DIR)
+        print(f"{'#' + str(run + 1):<14}{(store_bytes + final_bytes) / 2**20:>14.2f}{virtual_bytes / 2**20:>16.2f}")
+
+class NoSingleFlight:
+    """Comportamiento anterior a synthesis_flight: cada tarea sintetiza y guarda su fragmento."""
+    def do(self, key, func, text, lang, synth_filename, signature=None):
+        main.text_to_speech_optimized(text, synth_filename, lang=lang)
+        return main.store_in_cache(text, lang, synth_filename, signature), False
+
+def run_concurrent_jobs(documents, page_interval):
+    """
+    Sintetiza cada documento (lista de páginas, cada una una lista de fragmentos) como una tarea,
+    todas a la vez; cada página llega page_interval segundos después de la anterior, como en la extracción.
+    """
+    def pages(document):
+        for page in document:
+            yield page
+            time.sleep(page_interval)
+    
+    task_ids = [new_task() for _ in documents]
+    with ThreadPoolExecutor(max_workers=len(documents)) as pool:
+        list(pool.map(lambda job: main.process_chunk_stream(pages(job[1]), job[0]), zip(task_ids, documents)))
+    for task_id in task_ids:
+        main.remove_task_segments(task_id)
+        pop_task(task_id)
+
+def bench_coalesce(args):
+    """Llamadas al motor de voz con tareas simultáneas que comparten fragmentos (cabeceras, avisos legales)."""
+    rng = random.Random(args.seed)
+    backend = use_stub_backend(args.latency)
+    # Tantos hilos de síntesis como en un servidor con --threads núcleos lógicos
+    main.chunk_scheduler = main.FairChunkScheduler(max_workers=args.threads)
+    main.tts_dispatcher.in_flight = main.threading.BoundedSemaphore(args.threads)
+    
+    print(f"{args.jobs} tareas simultáneas, {args.paragraphs} párrafos propios y {args.shared} compartidos por tarea, "
+          f"latencia del motor {args.latency}s, {args.threads} hilos de síntesis\n")
+    print(f"{'síntesis':<20}{'llamadas':>10}{'fragmentos':>12}{'distintos':>11}{'compartidas':>13}{'tiempo (s)':>12}")
+    for name, flight in (("sin single-flight", NoSingleFlight()), ("single-flight", main.SingleFlight())):
+        # Textos nuevos en cada variante para que ninguna aproveche el caché de la otra
+        boilerplate = main.split_text_optimized(make_document(rng, args.shared))
+        documents = []
+        for _ in range(args.jobs):
+            # Cada página empieza con un fragmento común, como una cabecera o un aviso legal
+            chunks = main.split_text_optimized(make_document(rng, args.paragraphs))
+            step = max(1, len(chunks) // len(boilerplate))
+            pages = [[shared_chunk] + chunks[i * step:(i + 1) * step] for i, shared_chunk in enumerate(boilerplate)]
+            pages[-1].extend(chunks[len(boilerplate) * step:])
+            documents.append(pages)
+        main.synthesis_flight = flight
+        calls_before = backend.calls
+        start = time.perf_counter()
+        run_concurrent_jobs(documents, args.latency)
+        elapsed = time.perf_counter() - start
+        shared = flight.stats()["shared"] if hasattr(flight, "stats") else 0
+        chunks = [chunk for document in documents for page in document for chunk in page]
+        print(f"{name:<20}{backend.calls - calls_before:>10}{len(chunks):>12}{len(set(chunks)):>11}"
+              f"{shared:>13}{elapsed:>12.2f}")
+
+class LegacyTextChunkTree:
+    """Copia del árbol de fragmentos anterior a ChunkSimilarityIndex, solo para comparar."""
+    def __init__(self):
+        self.chunks = {}
+        self.children = {}
+    
+    def add_chunk(self, text, chunk_id):
+        words = text.split()
+        key = " ".join(words[:3]) if len(words) >= 3 else text[:20]
+        if key not in self.children:
+            self.children[key] = LegacyTextChunkTree()
+        self.children[key].chunks[chunk_id] = text
+    
+    def find_similar_chunks(self, text, threshold=0.8):
+        words = text.split()
+        key = " ".join(words[:3]) if len(words) >= 3 else text[:20]
+        similar_chunks = []
+        if key in self.children:
+            for chunk_id, chunk_text in self.children[key].chunks.items():
+                words1 = set(text.lower().split())
+                words2 = set(chunk_text.lower().split())
+                similarity = len(words1 & words2) / len(words1 | words2) if words1 and words2 else 0
+                if similarity >= threshold:
+                    similar_chunks.append((chunk_id, similarity))
+        return similar_chunks
+
+def edit_words(rng, text, edits):
+    """Cambia edits palabras al azar (una errata, un número de página...)."""
+    words = text.split()
+    for _ in range(edits):
+        words[rng.randrange(len(words))] = rng.choice(WORDS).upper()
+    return " ".join(words)
+
+def bench_similarity(args):
+    """Recall, falsos positivos y latencia de la búsqueda de fragmentos casi iguales: árbol anterior frente a MinHash/LSH."""
+    rng = random.Random(args.seed)
+    corpus = []
+    while len(corpus) < args.keys:
+        corpus.extend(main.split_text_optimized(make_document(rng, args.paragraphs)))
+    corpus = corpus[:args.keys]
+    sources = rng.sample(range(len(corpus)), min(args.queries, len(corpus)))
+    near_duplicates = [(idx, edit_words(rng, corpus[idx], 1)) for idx in sources]
+    unrelated = main.split_text_optimized(make_document(rng, args.paragraphs))[:args.queries]
+    
+    def legacy_lookup(index, text):
+        matches = index.find_similar_chunks(text)
+        best = max(matches, key=lambda x: x[1]) if matches else None
+        return best[0] if best and best[1] > 0.9 else None
+    
+    def minhash_lookup(index, text):
+        matches = index.find_similar(index.signature(text), "es")
+        return matches[0][0] if matches else None
+    
+    def legacy_add(index, idx, text):
+        index.add_chunk(text, idx)
+    
+    def minhash_add(index, idx, text):
+        index.add(idx, "es", index.signature(text))
+    
+    print(f"{len(corpus)} fragmentos indexados, {len(near_duplicates)} casi iguales (una palabra cambiada) "
+          f"y {len(unrelated)} distintos como consultas\n")
+    print(f"{'índice':<18}{'alta (ms)':>11}{'memoria (MB)':>14}{'búsqueda (ms)':>15}{'recall':>9}{'falsos +':>10}")
+    for name, factory, add, lookup in (
+            ("árbol anterior", LegacyTextChunkTree, legacy_add, legacy_lookup),
+            ("MinHash/LSH", lambda: main.ChunkSimilarityIndex(max_entries=len(corpus)), minhash_add, minhash_lookup)):
+        tracemalloc.start()
+        index = factory()
+        for idx, text in enumerate(corpus):
+            add(index, idx, text)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        # Tiempos sin tracemalloc, que los distorsiona
+        index = factory()
+        start = time.perf_counter()
+        for idx, text in enumerate(corpus):
+            add(index, idx, text)
+        add_ms = (time.perf_counter() - start) * 1000 / len(corpus)
+        start = time.perf_counter()
+        found = sum(1 for idx, text in near_duplicates if lookup(index, text) == idx)
+        false_positives = sum(1 for text in unrelated if lookup(index, text) is not None)
+        lookup_ms = (time.perf_counter() - start) * 1000 / (len(near_duplicates) + len(unrelated))
+        print(f"{name:<18}{add_ms:>11.3f}{memory / 2**20:>14.2f}{lookup_ms:>15.3f}"
+              f"{found / len(near_duplicates):>9.1%}{false_positives:>10}")
+
+def legacy_split_into_sentences(text):
+    """Copia del divisor de oraciones anterior (un find() por final y oración), solo para comparar."""
+    sentence_endings = ['. ', '! ', '? ', '.\n', '!\n', '?\n', '... ', '...\n']
+    result = []
+    remaining_text = text
+    while remaining_text:
+        min_idx = len(remaining_text)
+        min_ending = None
+        for ending in sentence_endings:
+            idx = remaining_text.find(ending)
+            if idx != -1 and idx < min_idx:
+                min_idx = idx
+                min_ending = ending
+        if min_ending:
+            result.append(remaining_text[:min_idx + len(min_ending)])
+            remaining_text = remaining_text[min_idx + len(min_ending):]
+        else:
+            result.append(remaining_text)
+            break
+    return result
+
+def legacy_split_text(text, max_length=800):
+    """Copia de la división en fragmentos anterior (concatenación con +=), solo para comparar."""
+    if len(text) <= max_length:
+        return [text]
+    chunks = []
+    current_chunk = ""
+    for para in text.split('\n'):
+        if not para.strip():
+            continue
+        if len(current_chunk) + len(para) + 1 > max_length and current_chunk:
+            chunks.append(current_chunk)
+            current_chunk = para
+        elif current_chunk:
+            current_chunk += '\n' + para
+        else:
+            current_chunk = para
+    if current_chunk:
+        chunks.append(current_chunk)
+    final_chunks = []
+    for chunk in chunks:
+        if len(chunk) <= max_length:
+            final_chunks.append(chunk)
+            continue
+        current_sentence_chunk = ""
+        for sentence in legacy_split_into_sentences(chunk):
+            if len(current_sentence_chunk) + len(sentence) > max_length and current_sentence_chunk:
+                final_chunks.append(current_sentence_chunk)
+                current_sentence_chunk = sentence
+            elif current_sentence_chunk:
+                current_sentence_chunk += ' ' + sentence
+            else:
+                current_sentence_chunk = sentence
+        if current_sentence_chunk:
+            final_chunks.append(current_sentence_chunk)
+    return final_chunks
+
+def random_text(rng, length):
+    """Texto aleatorio con los casos difíciles del divisor: puntos suspensivos, signos seguidos, líneas vacías."""
+    tokens = WORDS + [".", "!", "?", "...", "?!", " ", "  ", "\n", "\n\n", ". ", ".\n", "¿", "¡", "\t"]
+    parts = []
+    size = 0
+    while size < length:
+        token = rng.choice(tokens)
+        parts.append(token if token.strip() == "" or token in ".!?...?!" else " " + token)
+        size += len(parts[-1])
+    return "".join(parts)
+
+def check_split(args):
+    """
+    Comprueba con textos aleatorios que el divisor actual da los mismos fragmentos que el anterior.
+    La única diferencia permitida son las oraciones más largas que el máximo: antes quedaban
+    enteras (y se recortaban al sintetizar); ahora se dividen sin superar el máximo ni perder texto.
+    """
+    rng = random.Random(args.seed)
+    divided = 0
+    for case in range(args.cases):
+        text = random_text(rng, rng.choice((50, 400, 2000, 10000)))
+        max_length = rng.choice((20, 80, 200, 800))
+        expected = legacy_split_text(text, max_length)
+        chunks = main.split_text_optimized(text, max_length)
+        assert main.split_into_sentences(text) == legacy_split_into_sentences(text), f"caso {case}: oraciones"
+        if all(len(chunk) <= max_length for chunk in expected):
+            assert chunks == expected, f"caso {case}: fragmentos"
+        else:
+            divided += 1
+            assert all(len(chunk) <= max_length for chunk in chunks), f"caso {case}: fragmento demasiado largo"
+            assert "".join(text.split()) == "".join("".join(chunks).split()), f"caso {case}: texto perdido"
+        # Por partes (páginas) debe dar lo mismo que de una vez
+        cuts = sorted(rng.sample(range(len(text) + 1), min(5, len(text) + 1)))
+        pieces = [text[i:j] for i, j in zip([0] + cuts, cuts + [len(text)])]
+        batches = main.iter_chunk_batches(pieces, max_length)
+        assert [chunk for batch in batches for chunk in batch] == chunks, f"caso {case}: por partes"
+    print(f"{args.cases} textos aleatorios: mismos fragmentos que la implementación anterior "
+          f"({divided} con oraciones más largas que el máximo, divididas sin perder texto)\n")
+
+def bench_split(args):
+    """Velocidad (MB/s) de la división en oraciones y fragmentos: implementación anterior frente a la actual."""
+    check_split(args)
+    rng = random.Random(args.seed)
+    texts = {
+        "documento": "\n".join(make_document(rng, args.paragraphs) for _ in range(20)),
+        # PDF extraído sin saltos de línea: un único párrafo enorme
+        "párrafo único": " ".join(make_paragraph(rng) for _ in range(args.sentences // 4)),
+    }
+    print(f"{'texto':<16}{'tamaño (MB)':>13}{'anterior (MB/s)':>17}{'actual (MB/s)':>15}")
+    for name, text in texts.items():
+        megabytes = len(text.encode("utf-8")) / 2**20
+        rates = []
+        for split in (legacy_split_text, main.split_text_optimized):
+            start = time.perf_counter()
+            split(text)
+            rates.append(megabytes / (time.perf_counter() - start))
+        print(f"{name:<16}{megabytes:>13.2f}{rates[0]:>17.2f}{rates[1]:>15.2f}")
+
+def bench_chunksize(args):
+    """Tiempo total y hasta el primer audio según el tamaño de fragmento, con el motor local."""
+    rng = random.Random(args.seed)
+    use_stub_backend(args.latency, args.char_latency)
+    document = "\n".join(make_document(rng, args.paragraphs) for _ in range(args.documents))
+    adaptive = main.choose_chunk_size(len(document))
+    
+    print(f"{len(document)} caracteres, {main.TTS_MAX_IN_FLIGHT} hilos de síntesis, latencia del motor "
+          f"{args.latency}s + {args.char_latency * 1000:.2f}ms por carácter\n")
+    print(f"{'tamaño':<18}{'fragmentos':>12}{'más largo':>11}{'primer audio (s)':>18}{'total (s)':>11}")
+    sizes = [(str(size), size) for size in (200, 400, 800, 1200, 2000, 5000)] + [(f"adaptativo ({adaptive})", adaptive)]
+    for name, size in sizes:
+        chunks = main.split_text_optimized(document, size)
+        task_id = new_task()
+        start = time.perf_counter()
+        # Un idioma distinto por tamaño: ningún tamaño aprovecha el caché de otro
+        main.process_chunks_parallel(chunks, task_id, lang=f"es-{name}")
+        elapsed = time.perf_counter() - start
+        main.remove_task_segments(task_id)
+        status = pop_task(task_id)
+        print(f"{name:<18}{len(chunks):>12}{max(map(len, chunks)):>11}"
+              f"{status['time_to_first_audio']:>18.2f}{elapsed:>11.2f}")
+
+def render_report(rng, paragraphs, title):
+    """
+    Simula el texto que pdfminer extrae de una exportación de un informe: otro ancho de línea
+    (con palabras partidas por guiones), cabecera con la fecha, pie con el número de página,
+    espacios dobles y, en algunas exportaciones, los acentos descompuestos (NFD).
+    """
+    width = rng.randint(60, 95)
+    lines_per_page = rng.randint(30, 45)
+    date = f"{rng.randint(1, 28)}/{rng.randint(1, 12)}/2024"
+    lines = []
+    for paragraph in paragraphs:
+        line = ""
+        for word in paragraph.split():
+            if line and len(line) + 1 + len(word) > width:
+                cut = len(word) // 2
+                if len(word) >= 8 and len(line) + cut + 2 <= width and rng.random() < 0.5:
+                    line, word = f"{line} {word[:cut]}-", word[cut:]
+                lines.append(line)
+                line = word
+            else:
+                line = f"{line}{'  ' if line and rng.random() < 0.02 else ' ' if line else ''}{word}"
+        lines.extend([line, ""])
+    pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)]
+    texts = []
+    for number, page in enumerate(pages, 1):
+        body = "\n".join(page)
+        texts.append(f"{title} - {date}\n\n{body}\n\nPágina {number} de {len(pages)}\n\n\x0c")
+    if rng.random() < 0.5:
+        texts = [unicodedata.normalize("NFD", text) for text in texts]
+    return texts
+
+def legacy_chunk_cache_key(text, lang):
+    """Clave anterior: el texto del fragmento tal cual."""
+    return hashlib.sha256(f"{lang}\0{text}".encode('utf-8')).hexdigest()
+
+def normalized_pages(pages):
+    normalizer = main.TextNormalizer()
+    for page in pages:
+        yield from normalizer.feed(page)
+    yield from normalizer.finish()
+
+def legacy_adaptive_batches(rng, pieces, pages_total):
+    """
+    Elección anterior del tamaño: la primera parte por el número de páginas, con la concurrencia
+    repartida entre los trabajos en marcha en ese momento (aquí, entre 1 y 4 al azar).
+    """
+    pieces = list(pieces)
+    page_chars = len(pieces[0]) if pieces else 0
+    if pages_total > 1 and page_chars < main.CHUNK_MIN_CHARS:
+        page_chars = 2000
+    concurrency = max(1, main.TTS_MAX_IN_FLIGHT // rng.randint(1, 4))
+    size = math.ceil(page_chars * pages_total / (concurrency * main.CHUNK_TARGET_WAVES))
+    size = max(main.CHUNK_MIN_CHARS, min(main.CHUNK_MAX_CHARS, size))
+    return main.iter_chunk_batches(pieces, size)
+
+def check_normalize(args):
+    """
+    Comprueba que la normalización quita la cabecera repetida y los números de página pero
+    conserva los títulos numerados que abren cada página ("Capítulo 1", "Capítulo 2", ...).
+    """
+    rng = random.Random(args.seed)
+    for footer in ("{}", "- {} -", "Página {} de 12", "Page {}/12"):
+        pages = []
+        for number in range(1, 13):
+            body = "\n\n".join(make_paragraph(rng, 2) for _ in range(3))
+            pages.append(f"Manual de usuario\n\nCapítulo {number}\n\n{body}\n\n{footer.format(number)}\n\x0c")
+        paragraphs = "".join(normalized_pages(pages)).split("\n")
+        assert "Manual de usuario" not in paragraphs, f"{footer}: cabecera sin quitar"
+        missing = [n for n in range(1, 13) if f"Capítulo {n}" not in paragraphs]
+        assert not missing, f"{footer}: títulos eliminados {missing}"
+        assert not any(footer.format(n) in paragraphs for n in range(1, 13)), f"{footer}: números de página sin quitar"
+    print("Títulos numerados al principio de cada página: se conservan; cabecera y números de página: eliminados\n")
+
+def bench_normalize(args):
+    """Aciertos del caché con informes exportados varias veces, con y sin normalizar el texto."""
+    check_normalize(args)
+    rng = random.Random(args.seed)
+    reports = [[make_paragraph(rng, rng.randint(2, 6)) for _ in range(args.paragraphs)]
+               for _ in range(args.reports)]
+    # Las exportaciones se procesan intercaladas: cada informe vuelve a llegar con otro formato
+    exports = [render_report(rng, paragraphs, f"Informe {i + 1}")
+               for _ in range(args.runs) for i, paragraphs in enumerate(reports)]
+    size = sum(len(page) for pages in exports for page in pages)
+    
+    def fixed(pieces, pages):
+        return main.iter_chunk_batches(pieces, main.CHUNK_FIXED_SIZE)
+    
+    def adaptive(pieces, pages):
+        return main.iter_chunk_batches(pieces, size_for=main.choose_chunk_size)
+    
+    load_rng = random.Random(args.seed)
+    approaches = [
+        ("texto extraído", lambda pages: pages, legacy_chunk_cache_key, fixed),
+        ("normalizado", normalized_pages, main.chunk_cache_key, fixed),
+        ("norm. + adapt. anterior", normalized_pages, main.chunk_cache_key,
+         lambda pieces, pages: legacy_adaptive_batches(load_rng, pieces, len(pages))),
+        ("norm. + adaptativo", normalized_pages, main.chunk_cache_key, adaptive),
+    ]
+    print(f"{args.reports} informes exportados {args.runs} veces, {size / 1e6:.2f} MB de texto, "
+          f"fragmentos de {main.CHUNK_FIXED_SIZE} caracteres o adaptativos\n")
+    print(f"{'texto':<26}{'fragmentos':>12}{'aciertos':>10}{'tasa':>8}{'tiempo (s)':>12}")
+    for name, prepare, cache_key, batches in approaches:
+        seen = set()
+        chunks = hits = 0
+        start = time.perf_counter()
+        for pages in exports:
+            for batch in batches(prepare(pages), pages):
+                for chunk in batch:
+                    key = cache_key(chunk, "es")
+                    chunks += 1
+                    hits += key in seen
+                    seen.add(key)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<26}{chunks:>12}{hits:>10}{hits / chunks:>8.1%}{elapsed:>12.2f}")
+    print(f"\nMáximo posible (solo falla la primera exportación de cada informe): {(args.runs - 1) / args.runs:.1%}")
+
+DOCX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Default Extension="png" ContentType="image/png"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '</Types>'
+)
+DOCX_RELATIONSHIPS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Target="word/document.xml" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+    '</Relationships>'
+)
+
+def docx_paragraph(text):
+    return f'<w:p><w:r><w:t xml:space="preserve">{text}</w:t></w:r></w:p>'
+
+def docx_table(rng):
+    """Tabla de 3 columnas con una celda combinada en horizontal (gridSpan) y otra en vertical (vMerge)."""
+    def cell(properties="", text=None):
+        content = docx_paragraph(text if text is not None else make_paragraph(rng, 1)) if text != "" else "<w:p/>"
+        return f"<w:tc>{f'<w:tcPr>{properties}</w:tcPr>' if properties else ''}{content}</w:tc>"
+    rows = [cell('<w:gridSpan w:val="2"/>') + cell(),
+            cell('<w:vMerge w:val="restart"/>') + cell() + cell()]
+    rows += [cell("<w:vMerge/>", "") + cell() + cell() for _ in range(2)]
+    grid = '<w:tblGrid>' + '<w:gridCol w:w="3000"/>' * 3 + '</w:tblGrid>'
+    return "<w:tbl>" + grid + "".join(f"<w:tr>{row}</w:tr>" for row in rows) + "</w:tbl>"
+
+def make_docx(path, rng, xml_bytes, file_bytes):
+    """
+    Escribe un DOCX con unos xml_bytes de document.xml (párrafos y tablas con celdas combinadas)
+    y una imagen sin comprimir que completa hasta file_bytes, como los DOCX grandes reales.
+    """
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as docx:
+        docx.writestr("[Content_Types].xml", DOCX_CONTENT_TYPES)
+        docx.writestr("_rels/.rels", DOCX_RELATIONSHIPS)
+        with docx.open("word/document.xml", "w") as f:
+            f.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                    b'<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>')
+            written = 0
+            while written < xml_bytes:
+                block = "".join(docx_paragraph(make_paragraph(rng)) for _ in range(8)) + docx_table(rng)
+                data = block.encode("utf-8")
+                f.write(data)
+                written += len(data)
+            f.write(b"<w:sectPr/></w:body></w:document>")
+    padding = file_bytes - os.path.getsize(path)
+    if padding > 0:
+        with zipfile.ZipFile(path, "a", zipfile.ZIP_STORED) as docx:
+            with docx.open("word/media/image1.png", "w") as f:
+                for _ in range(0, padding, 1024 * 1024):
+                    f.write(rng.randbytes(1024 * 1024))
+
+def legacy_docx_text(path):
+    """Extracción anterior con python-docx: párrafos y después tablas, leyendo cell.text de cada celda."""
+    doc = parsers.Document(path)
+    parts = [para.text for para in doc.paragraphs if para.text.strip()]
+    for table in doc.tables:
+        for row in table.rows:
+            row_text = [cell.text for cell in row.cells if cell.text.strip()]
+            if row_text:
+                parts.append(" | ".join(row_text))
+    return "\n".join(parts)
+
+def no_docx_fallback(docx_path):
+    raise RuntimeError("iter_docx_text no pudo leer el XML en streaming y recurrió a python-docx")
+
+def measure_docx_extractor(name, path):
+    """
+    Se ejecuta en un proceso nuevo: tiempo, memoria máxima añadida (RSS) y texto extraído.
+    En los métodos con iterparse la alternativa con python-docx falla en vez de medirse en su lugar.
+    """
+    if name.startswith("iterparse"):
+        parsers.extract_text_from_docx_optimized = no_docx_fallback
+    extractors = {
+        "python-docx (anterior)": legacy_docx_text,
+        "XML completo (alternativo)": parsers.extract_docx_fallback,
+        "iterparse en streaming": lambda path: "".join(parsers.iter_docx_text(path)),
+        # Como en la conversión: cada parte se procesa y se descarta
+        "iterparse, parte a parte": lambda path: sum(len(piece) for piece in parsers.iter_docx_text(path)),
+    }
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    text = extractors[name](path)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return elapsed, (peak - baseline) / 1024, text
+
+def bench_docx(args):
+    """Tiempo y memoria al extraer el texto de un DOCX grande: python-docx frente a iterparse."""
+    rng = random.Random(args.seed)
+    path = os.path.abspath("grande.docx")
+    make_docx(path, rng, int(args.xml_mb * 1024 * 1024), int(args.docx_mb * 1024 * 1024))
+    print(f"DOCX de {os.path.getsize(path) / 1e6:.0f} MB, document.xml de {args.xml_mb:.0f} MB sin comprimir\n")
+    
+    print(f"{'método':<30}{'tiempo (s)':>12}{'memoria (MB)':>14}{'caracteres':>13}{'celdas repetidas':>18}")
+    texts = {}
+    context = multiprocessing.get_context("fork")
+    for name in ("python-docx (anterior)", "XML completo (alternativo)", "iterparse en streaming",
+                 "iterparse, parte a parte"):
+        # Un proceso por método para que la memoria máxima de uno no oculte la del siguiente
+        with context.Pool(1) as pool:
+            elapsed, memory, text = pool.apply(measure_docx_extractor, (name, path))
+        assert text, f"{name}: no se extrajo texto"
+        if isinstance(text, int):
+            print(f"{name:<30}{elapsed:>12.2f}{memory:>14.0f}{text:>13}")
+            continue
+        # Párrafos y celdas: los textos generados no se repiten, salvo las celdas combinadas leídas varias veces
+        parts = [part for line in text.splitlines() for part in line.split(" | ")]
+        texts[name] = set(parts)
+        print(f"{name:<30}{elapsed:>12.2f}{memory:>14.0f}{len(text):>13}{len(parts) - len(texts[name]):>18}")
+    
+    assert texts["python-docx (anterior)"] == texts["iterparse en streaming"], "iterparse no da el mismo texto que python-docx"
+    print("\nMismo texto que python-docx (sin contar repeticiones)")
+
+def extract_in_thread(pdf_path):
+    """Extracción anterior: pdfminer en un hilo del proceso web."""
+    total_pages = parsers.count_pdf_pages(pdf_path)
+    return parsers.extract_pdf_pages(pdf_path, list(range(total_pages)))
+
+def measure_poll_latency(extract, interval=0.01):
+    """
+    Ejecuta extract() en un hilo mientras otro simula las consultas a /task: cada interval segundos
+    serializa un estado. Devuelve el tiempo de extracción (o el error) y los retrasos de cada consulta.
+    """
+    delays = []
+    outcome = {}
+    def run():
+        start = time.perf_counter()
+        try:
+            extract()
+            outcome["result"] = f"{time.perf_counter() - start:.2f} s"
+        except Exception as e:
+            outcome["result"] = f"{type(e).__name__} a los {time.perf_counter() - start:.2f} s"
+    thread = threading.Thread(target=run)
+    thread.start()
+    while thread.is_alive():
+        start = time.perf_counter()
+        time.sleep(interval)
+        main.json.dumps({"status": "processing", "progress": 50, "elapsed_time": start})
+        delays.append(time.perf_counter() - start - interval)
+    thread.join()
+    return outcome["result"], delays
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def worker_startup_cpu(context):
+    """CPU que gasta un proceso de extracción en arrancar (aquí importa también este script)."""
+    start = children_cpu()
+    worker = main.ParserWorker(context)
+    worker.conn.send((sum, (range(1),), 1.0))
+    worker.conn.recv()
+    worker.kill()
+    return children_cpu() - start
+
+def check_parse_budget(args):
+    """
+    Varias tareas de un mismo documento en paralelo, todas consumiendo CPU sin parar: entre todas
+    no deben pasar del límite de CPU del documento (antes cada una podía usarlo entero, y las
+    detenidas por el límite no se descontaban). Y una tarea que necesita más que su parte, pero
+    menos que el límite, debe terminar en lugar de hacer fallar el documento.
+    """
+    # Sin __file__ los procesos nuevos no importan este script (ni main.py), como con uvicorn: así
+    # su arranque, que se descuenta, es corto y estable
+    main_module = sys.modules["__main__"]
+    main_path = main_module.__dict__.pop("__file__", None)
+    try:
+        run_parse_budget_checks(args)
+    finally:
+        if main_path:
+            main_module.__file__ = main_path
+
+def run_parse_budget_checks(args):
+    """Las dos comprobaciones de check_parse_budget, con un pool propio de 4 procesos."""
+    size = 4
+    pool = main.ParserPool(size=size)
+    startup = statistics.median(worker_startup_cpu(pool.context) for _ in range(3))
+    
+    # Tarea de unos 0.4 límites de CPU junto a otras cortas: su parte inicial es 1/size del límite
+    start = time.process_time()
+    sum(range(10 ** 7))
+    n = int(10 ** 7 * 0.4 * args.parse_cpu / (time.process_time() - start))
+    budget = main.ParseBudget(cpu_seconds=args.parse_cpu)
+    futures = [pool.submit(budget, sum, range(n))] + [pool.submit(budget, sum, range(1000)) for _ in range(size - 1)]
+    assert futures[0].result() == n * (n - 1) // 2, "la tarea larga no terminó"
+    print(f"Tarea de unos {0.4 * args.parse_cpu:.1f} s de CPU con {size} procesos: termina "
+          f"({pool.stats()['killed']['cpu']} repetida tras agotar su parte)")
+    pool.executor.shutdown()
+    for worker in pool.idle:
+        worker.kill()
+    
+    # Procesos nuevos: los que terminan se cuentan en RUSAGE_CHILDREN con toda la CPU que usaron
+    pool = main.ParserPool(size=size)
+    budget = main.ParseBudget(cpu_seconds=args.parse_cpu)
+    start = children_cpu()
+    # sum(range(...)) hace de extracción patológica: consume CPU hasta que la detienen
+    futures = [pool.submit(budget, sum, range(10 ** 15)) for _ in range(2 * size)]
+    stopped = sum(isinstance(future.exception(), main.ParseLimitError) for future in futures)
+    pool.executor.shutdown()
+    for worker in pool.idle:
+        worker.kill()  # Para que todos los procesos arrancados cuenten en RUSAGE_CHILDREN
+    used = children_cpu() - start - pool.started * startup
+    # Margen por proceso: el arranque descontado es una estimación y cada proceso recibe su tarea
+    # antes de armar el temporizador
+    assert used <= args.parse_cpu + 0.05 * pool.started, f"{used:.1f} s de CPU con un límite de {args.parse_cpu:g} s"
+    print(f"{len(futures)} tareas en {size} procesos, límite de {args.parse_cpu:g} s de CPU por documento: "
+          f"{stopped} detenidas, {used:.1f} s de CPU en las tareas\n")
+
+def bench_isolation(args):
+    """Respuesta de otras peticiones mientras se extrae un PDF: en el proceso web frente a procesos aparte."""
+    rng = random.Random(args.seed)
+    pdf_path = os.path.abspath("aislamiento.pdf")
+    check_parse_budget(args)
+    make_pdf(pdf_path, rng, args.pages)
+    main.parser_pool.run(main.ParseBudget(), main.count_pdf_pages, pdf_path)  # Arrancar un proceso de extracción
+    
+    cases = [
+        ("hilo del proceso web", lambda: extract_in_thread(pdf_path)),
+        ("procesos de extracción", lambda: list(main.iter_pdf_pages(pdf_path))),
+        (f"límite de {args.parse_timeout:g} s", lambda: list(main.iter_pdf_pages(pdf_path, budget=main.ParseBudget(timeout=args.parse_timeout)))),
+    ]
+    print(f"PDF de {args.pages} páginas; consultas simuladas cada 10 ms mientras se extrae\n")
+    print(f"{'extracción':<26}{'resultado':>28}{'retraso p50 (ms)':>18}{'p99 (ms)':>10}{'máx (ms)':>10}")
+    for name, extract in cases:
+        result, delays = measure_poll_latency(extract)
+        delays.sort()
+        p99 = delays[min(len(delays) - 1, int(len(delays) * 0.99))]
+        print(f"{name:<26}{result:>28}{statistics.median(delays) * 1000:>18.1f}{p99 * 1000:>10.1f}{delays[-1] * 1000:>10.1f}")
+    print(f"\nProcesos de extracción: {main.parser_pool.stats()}")
+
+class FifoChunkScheduler(main.FairChunkScheduler):
+    """Planificación anterior: los fragmentos se atienden en orden de llegada, sin distinguir tareas."""
+    def _next(self):
+        task_id = min(self.queues, key=lambda task: self.queues[task][0][5])
+        queue = self.queues[task_id]
+        item = queue.popleft()
+        if not queue:
+            del self.queues[task_id]
+        return task_id, item
+
+def run_mixed_load(big_chunks, small_documents, interval):
+    """Una tarea grande y, mientras se procesa, tareas cortas cada interval segundos. Devuelve sus tiempos."""
+    results = {}
+    def run(name, chunks):
+        task_id = new_task()
+        start = time.perf_counter()
+        main.process_chunks_parallel(chunks, task_id)
+        elapsed = time.perf_counter() - start
+        main.remove_task_segments(task_id)
+        results[name] = (elapsed, pop_task(task_id)["chunk_latency"])
+    threads = [threading.Thread(target=run, args=("grande", big_chunks))]
+    threads[0].start()
+    for i, chunks in enumerate(small_documents):
+        time.sleep(interval)
+        threads.append(threading.Thread(target=run, args=(f"corta {i + 1}", chunks)))
+        threads[-1].start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def bench_fairness(args):
+    """Latencia de documentos cortos que llegan mientras se sintetiza uno enorme: FIFO frente a WFQ."""
+    rng = random.Random(args.seed)
+    use_stub_backend(args.latency, args.char_latency)
+    
+    print(f"Una tarea de {args.paragraphs * 10} párrafos y {args.small_jobs} tareas de 3 párrafos, una cada "
+          f"{args.interval}s; {main.MAX_WORKERS} hilos de síntesis, latencia del motor "
+          f"{args.latency}s + {args.char_latency * 1000:.2f}ms por carácter\n")
+    print(f"{'planificador':<14}{'cortas p50 (s)':>16}{'p95 (s)':>10}{'máx (s)':>10}"
+          f"{'fragmento p95 (s)':>20}{'grande (s)':>12}")
+    for name, scheduler in (("FIFO", FifoChunkScheduler()), ("WFQ", main.FairChunkScheduler())):
+        main.chunk_scheduler = scheduler
+        # Textos nuevos para cada planificador: ninguno aprovecha el caché del otro
+        big_chunks = main.split_text_optimized(make_document(rng, args.paragraphs * 10))
+        small_documents = [main.split_text_optimized(make_document(rng, 3)) for _ in range(args.small_jobs)]
+        results = run_mixed_load(big_chunks, small_documents, args.interval)
+        small = [elapsed for task, (elapsed, _) in results.items() if task != "grande"]
+        small_chunks = max(latency["p95"] for task, (_, latency) in results.items() if task != "grande")
+        small_latency = main.percentiles(small)
+        print(f"{name:<14}{small_latency['p50']:>16.2f}{small_latency['p95']:>10.2f}{max(small):>10.2f}"
+              f"{small_chunks:>20.2f}{results['grande'][0]:>12.2f}")
+
+BENCHMARKS = {
+    "cache": bench_cache,
+    "sqlite": bench_sqlite,
+    "taskstore": bench_taskstore,
+    "pipeline": bench_pipeline,
+    "concat": bench_concat,
+    "disk": bench_disk,
+    "coalesce": bench_coalesce,
+    "similarity": bench_similarity,
+    "split": bench_split,
+    "chunksize": bench_chunksize,
+    "normalize": bench_normalize,
+    "docx": bench_docx,
+    "isolation": bench_isolation,
+    "fairness": bench_fairness,
+}
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmarks sin conexión del convertidor")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--paragraphs", type=int, default=40)
+    parser.add_argument("--latency", type=float, default=0.01, help="latencia simulada del motor de voz (s)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keys", type=int, default=2000, help="claves usadas en los benchmarks sqlite y taskstore")
+    parser.add_argument("--threads", type=int, default=main.MAX_WORKERS)
+    parser.add_argument("--pages", type=int, default=60, help="páginas del PDF sintético")
+    parser.add_argument("--chunks", type=int, default=1000, help="fragmentos del benchmark concat")
+    parser.add_argument("--jobs", type=int, default=8, help="tareas simultáneas del benchmark coalesce")
+    parser.add_argument("--char-latency", type=float, default=0.0005,
+                        help="latencia simulada por carácter del motor de voz (s), benchmark chunksize")
+    parser.add_argument("--documents", type=int, default=2, help="documentos de --paragraphs párrafos unidos (chunksize)")
+    parser.add_argument("--reports", type=int, default=10, help="informes distintos (normalize)")
+    parser.add_argument("--docx-mb", type=float, default=50, help="tamaño del DOCX generado (docx)")
+    parser.add_argument("--xml-mb", type=float, default=30, help="tamaño de document.xml sin comprimir (docx)")
+    parser.add_argument("--parse-timeout", type=float, default=2.0, help="tiempo máximo de extracción (isolation)")
+    parser.add_argument("--parse-cpu", type=float, default=6.0, help="límite de CPU por documento (isolation)")
+    parser.add_argument("--small-jobs", type=int, default=6, help="tareas cortas (fairness)")
+    parser.add_argument("--interval", type=float, default=1.0, help="segundos entre tareas cortas (fairness)")
+    parser.add_argument("--cases", type=int, default=2000, help="textos aleatorios comparados en el benchmark split")
+    parser.add_argument("--sentences", type=int, default=4000, help="oraciones del párrafo único (split)")
+    parser.add_argument("--queries", type=int, default=500, help="consultas del benchmark similarity")
+    parser.add_argument("--shared", type=int, default=20, help="párrafos comunes a todas las tareas (coalesce)")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,29 +1,142 @@
 from fastapi import FastAPI, File, UploadFile, Request, BackgroundTasks
-from fastapi.responses import FileResponse, HTMLResponse, JSONResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
+from fastapi.concurrency import iterate_in_threadpool, run_in_threadpool
+from starlette.datastructures import Headers
 import os
 import uuid
 import time
 import threading
 import concurrent.futures
 from gtts import gTTS
-from pdfminer.high_level import extract_text
-from docx import Document
+from gtts.tts import gTTSError
 import io
 import math
 import shutil
 import hashlib
 import sqlite3
 import base64
-from functools import lru_cache
+import mmap
+import json
+import bisect
+import zlib
+import array
+import re
+import unicodedata
+import signal
+try:
+    import brotli  # Opcional: compresión br para /text
+except ImportError:
+    brotli = None
 from concurrent.futures import ThreadPoolExecutor
 import multiprocessing
 import traceback
+import socket
+import random
+import asyncio
+from collections import deque, OrderedDict
+# Extracción de texto: los procesos de extracción solo importan este módulo, no main.py
+from parsers import (
+    parser_worker_main, count_pdf_pages, extract_pdf_pages, extract_text_from_pdf_whole, iter_docx_pieces
+)
 
 # Número de procesadores disponibles para paralelización
 NUM_CORES = max(1, multiprocessing.cpu_count() - 1)
 MAX_WORKERS = NUM_CORES * 2  # Para operaciones I/O, podemos usar más workers que cores
 
+# Workers de uvicorn en esta máquina (uvicorn toma --workers de WEB_CONCURRENCY). Los límites de
+# trabajos, extracción y servicio de voz son de cada proceso, así que se reparten entre ellos
+SERVER_WORKERS = max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+
+# Entrega progresiva del audio: intervalo de espera entre fragmentos y tamaño de bloque
+STREAM_POLL_INTERVAL = 0.25
+STREAM_BLOCK_SIZE = 64 * 1024
+EVENTS_MIN_INTERVAL = 0.2  # segundos mínimos entre eventos SSE de una tarea (agrupa actualizaciones seguidas)
+EVENTS_REFRESH_INTERVAL = 5.0  # sin cambios, se reenvía el estado (tiempos, posición en cola) y mantiene viva la conexión
+TEXT_CHECKPOINT_CHARS = 64 * 1024  # caracteres entre puntos de control carácter -> byte del texto extraído
+TEXT_COMPRESS_MIN_BYTES = 1024  # respuestas de /text más pequeñas se envían sin comprimir
+SEGMENTS_DIR = "segments"  # segments/{task_id}/: enlaces a los fragmentos, cabecera y manifest.json
+RESUME_BATCH_CHUNKS = 32  # fragmentos por lote al reanudar un trabajo desde su manifiesto (job.jsonl)
+
+# Extracción de PDF: páginas máximas por tarea enviada al pool de procesos
+PDF_PAGES_PER_TASK = 8
+
+# Aislamiento de la extracción: procesos aparte con límites por documento; al superarlos se detienen
+PARSE_WORKERS = max(1, NUM_CORES // SERVER_WORKERS)
+PARSE_TIMEOUT = 600  # segundos de reloj como máximo para extraer un documento
+PARSE_CPU_SECONDS = 300  # segundos de CPU como máximo por documento, sumando todos sus procesos
+PARSE_MAX_MEMORY = 1024 * 1024 * 1024  # espacio de direcciones máximo de cada proceso de extracción
+
+# Límites de subida: tamaño máximo y tamaño de cada bloque leído del cliente
+MAX_UPLOAD_SIZE = 50 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB por bloque, la memoria por solicitud queda acotada
+
+# Planificador de trabajos: documentos procesados a la vez y tamaño máximo de la cola.
+# Un trabajo casi no usa CPU (la extracción va en procesos aparte y la síntesis se reparte entre
+# tareas), así que varios a la vez dejan que un documento corto avance junto a uno enorme
+MAX_CONCURRENT_JOBS = max(1, max(4, NUM_CORES) // SERVER_WORKERS)
+MAX_QUEUED_JOBS = 50
+QUEUE_RETRY_AFTER = 30  # segundos sugeridos al cliente cuando la cola está llena
+JOB_MAX_BYPASS = 5  # trabajos más cortos que pueden adelantar en la cola a uno que espera
+CHUNK_LATENCY_SAMPLES = 1000  # esperas recientes de fragmentos para los percentiles de /health
+
+# Síntesis de voz: motor ("gtts" o "stub" para pruebas sin red), límite de peticiones y reintentos
+TTS_BACKEND = os.environ.get("TTS_BACKEND", "gtts")
+TTS_RATE_LIMIT = 5.0 / SERVER_WORKERS  # peticiones por segundo al servicio de voz, en total entre los workers
+TTS_BURST = max(1, 10 // SERVER_WORKERS)  # ráfaga máxima permitida por el limitador
+TTS_MAX_IN_FLIGHT = max(1, MAX_WORKERS // SERVER_WORKERS)  # peticiones simultáneas como máximo, sumando todas las tareas
+TTS_MAX_RETRIES = 4
+TTS_BACKOFF_BASE = 1.0  # segundos; se duplica en cada reintento
+TTS_BACKOFF_MAX = 30.0
+TTS_MAX_CHARS = 5000  # caracteres máximos por petición; un texto más largo se sintetiza por partes
+
+# Tamaño de los fragmentos: "adaptive" lo elige según la longitud del documento, "fixed" usa siempre
+# CHUNK_FIXED_SIZE. Solo hay unos pocos tamaños posibles y no dependen de la carga del servidor: el
+# mismo texto se divide siempre igual y sus fragmentos se encuentran en el caché
+CHUNK_SIZE_MODE = os.environ.get("CHUNK_SIZE_MODE", "adaptive")
+CHUNK_FIXED_SIZE = 800
+CHUNK_MIN_CHARS = 300  # por debajo, la sobrecarga de cada petición domina
+CHUNK_MAX_CHARS = 2000  # por encima, un fragmento tarda demasiado y retrasa el primer audio
+CHUNK_SIZE_LEVELS = (CHUNK_MIN_CHARS, CHUNK_FIXED_SIZE, CHUNK_MAX_CHARS)
+CHUNK_TARGET_WAVES = 4  # fragmentos por hilo de síntesis: reparte la carga sin esperar a un fragmento rezagado
+CHUNK_REFERENCE_THREADS = TTS_MAX_IN_FLIGHT  # síntesis simultáneas configuradas (no las libres en ese momento) al elegir el tamaño
+
+# Normalización del texto extraído: cabeceras y pies de página se detectan en las líneas de los bordes
+NORMALIZE_EDGE_LINES = 2  # líneas examinadas al principio y al final de cada página
+NORMALIZE_HEADER_MAX_CHARS = 100  # una línea más larga no se considera cabecera ni pie
+NORMALIZE_HEADER_MIN_PAGES = 3  # páginas en cuyo borde debe repetirse una línea para eliminarla
+NORMALIZE_HEADER_PAGES = 6  # páginas retenidas al principio para que también se limpien las primeras
+
+# Caché de audio: presupuesto en bytes, número máximo de entradas y política de expulsión ("lru" o "lfu")
+CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+CACHE_MAX_ENTRIES = 100000
+CACHE_EVICTION_POLICY = "lru"
+CACHE_EVICTION_BATCH = 500  # filas borradas por transacción
+CACHE_EVICTION_TARGET = 0.9  # al expulsar se baja hasta este porcentaje del presupuesto
+CACHE_MAINTENANCE_EVERY = 6  # ciclos del hilo de limpieza (5 min cada uno) entre mantenimientos del caché
+
+# Capa en memoria delante de SQLite: entradas máximas y vida (s) de aciertos y de fallos
+MEMORY_CACHE_MAX_ENTRIES = 10000
+MEMORY_CACHE_TTL = 600
+MEMORY_CACHE_NEGATIVE_TTL = 30  # corta: otro proceso puede almacenar el fragmento mientras tanto
+
+# Fragmentos casi iguales: MinHash sobre tríos de palabras con LSH (bandas x filas = permutaciones)
+SIMILARITY_SHINGLE_WORDS = 3
+SIMILARITY_NUM_PERM = 64
+SIMILARITY_BANDS = 8
+SIMILARITY_MAX_ENTRIES = 20000  # firmas en memoria (unos 2 KB cada una con sus bandas); las más antiguas se olvidan
+SIMILARITY_THRESHOLD = 0.8  # similitud estimada mínima (tríos de palabras) para considerar dos fragmentos casi iguales
+# Reutilizar el audio de un fragmento casi igual en lugar de sintetizar: el oyente oiría palabras que no
+# están en el documento, así que por defecto el índice solo cuenta cuántos se podrían aprovechar
+SIMILARITY_REUSE_AUDIO = False
+
+# Estado de las tareas: "sqlite" (por defecto, compartido entre procesos y persistente), "redis" o "memory"
+TASK_STORE = os.environ.get("TASK_STORE", "sqlite")
+TASK_STORE_PATH = "cache/tasks.db"
+TASK_STORE_URL = os.environ.get("TASK_STORE_URL", "redis://localhost:6379/0")
+TASK_RETENTION = 3600  # segundos que se conservan las tareas terminadas
+EVENTS_STORE_POLL_INTERVAL = 1.0  # consulta del almacén compartido para las tareas que procesa otro worker o réplica
+
 app = FastAPI()
 
 # Asegurarse de que los directorios necesarios existan
@@ -32,87 +145,1595 @@ os.makedirs("temp", exist_ok=True)
 os.makedirs("templates", exist_ok=True)
 os.makedirs("static", exist_ok=True)  # Asegurarse que la carpeta static existe
 os.makedirs("cache", exist_ok=True)
+os.makedirs("cache/audio", exist_ok=True)  # Almacén persistente de audio direccionado por contenido
+os.makedirs("segments", exist_ok=True)  # Fragmentos de audio de cada tarea y su manifiesto
 
 # Montar carpeta estática para servir CSS, JS e imágenes
 # IMPORTANTE: Estas rutas deben venir después de crear los directorios
 app.mount("/static", StaticFiles(directory="static"), name="static")
 app.mount("/audio", StaticFiles(directory="audio"), name="audio")
 
-# Diccionario para almacenar el estado de las tareas
-task_status = {}
+def process_start_token(pid):
+    """
+    Identifica un arranque concreto de un proceso (arranque del sistema y momento en que empezó),
+    para que un PID reutilizado tras un reinicio no pase por el mismo proceso. "" si no hay /proc.
+    """
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as f:
+            boot_id = f.read().strip()[:8]
+        with open(f"/proc/{pid}/stat") as f:
+            start_ticks = f.read().rsplit(")", 1)[1].split()[19]  # Campo 22: starttime
+        return f"{boot_id}-{start_ticks}"
+    except (OSError, IndexError):
+        return ""
+
+# Identificador de este proceso (máquina:pid:arranque): varias réplicas o workers de uvicorn comparten el almacén de tareas
+WORKER_ID = ":".join(filter(None, (socket.gethostname(), str(os.getpid()), process_start_token(os.getpid()))))
+TERMINAL_STATUSES = ("completed", "error")
+
+class TaskStore:
+    """
+    Almacén del estado de las tareas. Cada tarea es un diccionario de campos con un número
+    de versión que aumenta en cada modificación. Las actualizaciones son atómicas.
+    """
+    shared = False  # True si otros procesos pueden leer y modificar las mismas tareas
+    
+    def init(self):
+        pass
+    
+    def create(self, task_id, fields):
+        raise NotImplementedError
+    
+    def get(self, task_id):
+        """Devuelve una copia de la tarea (con "version") o None si no existe."""
+        raise NotImplementedError
+    
+    def update(self, task_id, fields):
+        """Actualiza varios campos a la vez. Devuelve False si la tarea no existe."""
+        raise NotImplementedError
+    
+    def update_if(self, task_id, field, expected, fields):
+        """Actualiza solo si task[field] == expected (compara e intercambia). Devuelve True si se actualizó."""
+        raise NotImplementedError
+    
+    def increment(self, task_id, field, amount=1):
+        raise NotImplementedError
+    
+    def delete(self, task_id):
+        raise NotImplementedError
+    
+    def finished_before(self, timestamp):
+        """Tareas terminadas o fallidas antes de timestamp."""
+        raise NotImplementedError
+    
+    def unfinished(self):
+        """Tareas en cola o en proceso, como lista de (task_id, campos)."""
+        raise NotImplementedError
+    
+    # Índice de documentos: clave del documento (idioma + hash del archivo) -> tarea que lo convierte
+    def claim_document(self, doc_key, task_id):
+        """Asigna el documento a task_id si nadie lo tiene. Devuelve la tarea que lo tiene asignado."""
+        raise NotImplementedError
+    
+    def replace_document(self, doc_key, expected_task_id, task_id):
+        """Reasigna el documento solo si sigue asignado a expected_task_id. Devuelve True si se reasignó."""
+        raise NotImplementedError
+    
+    def release_document(self, doc_key, task_id):
+        """Olvida el documento si sigue asignado a task_id."""
+        raise NotImplementedError
+    
+    def __contains__(self, task_id):
+        return self.get(task_id) is not None
+
+class MemoryTaskStore(TaskStore):
+    """Tareas en un diccionario del proceso: sin persistencia y con un solo worker."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.documents = {}
+    
+    def create(self, task_id, fields):
+        with self.lock:
+            self.tasks[task_id] = dict(fields, version=0)
+    
+    def get(self, task_id):
+        with self.lock:
+            task = self.tasks.get(task_id)
+            return dict(task) if task is not None else None
+    
+    def update(self, task_id, fields):
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is None:
+                return False
+            task.update(fields)
+            task["version"] += 1
+            return True
+    
+    def update_if(self, task_id, field, expected, fields):
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is None or task.get(field) != expected:
+                return False
+            task.update(fields)
+            task["version"] += 1
+            return True
+    
+    def increment(self, task_id, field, amount=1):
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is not None:
+                task[field] = task.get(field, 0) + amount
+                task["version"] += 1
+    
+    def delete(self, task_id):
+        with self.lock:
+            self.tasks.pop(task_id, None)
+    
+    def finished_before(self, timestamp):
+        with self.lock:
+            return [task_id for task_id, task in self.tasks.items()
+                    if task["status"] in TERMINAL_STATUSES and task.get("completion_time", timestamp) < timestamp]
+    
+    def unfinished(self):
+        with self.lock:
+            return [(task_id, dict(task)) for task_id, task in self.tasks.items()
+                    if task["status"] not in TERMINAL_STATUSES]
+    
+    def claim_document(self, doc_key, task_id):
+        with self.lock:
+            return self.documents.setdefault(doc_key, task_id)
+    
+    def replace_document(self, doc_key, expected_task_id, task_id):
+        with self.lock:
+            if self.documents.get(doc_key) != expected_task_id:
+                return False
+            self.documents[doc_key] = task_id
+            return True
+    
+    def release_document(self, doc_key, task_id):
+        with self.lock:
+            if self.documents.get(doc_key) == task_id:
+                del self.documents[doc_key]
+
+class SQLiteTaskStore(TaskStore):
+    """
+    Tareas en SQLite (WAL), compartidas por todos los procesos del mismo servidor y
+    conservadas tras un reinicio. Los campos se guardan como JSON y cada actualización es
+    una sola sentencia UPDATE (json_set), por lo que es atómica.
+    """
+    shared = True
+    
+    def __init__(self, db_path=TASK_STORE_PATH):
+        self.db_path = db_path
+        self.local = threading.local()
+    
+    def connection(self):
+        """Devuelve la conexión del hilo actual, creándola si hace falta."""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+    
+    def init(self):
+        conn = self.connection()
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS tasks (
+            task_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            data TEXT NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0,
+            completion_time REAL
+        )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status, completion_time)')
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS documents (
+            doc_key TEXT PRIMARY KEY,
+            task_id TEXT NOT NULL
+        )
+        ''')
+        conn.commit()
+    
+    def create(self, task_id, fields):
+        conn = self.connection()
+        conn.execute(
+            'INSERT OR REPLACE INTO tasks (task_id, status, data, version, completion_time) VALUES (?, ?, ?, 0, ?)',
+            (task_id, fields["status"], json.dumps(fields, ensure_ascii=False), fields.get("completion_time"))
+        )
+        conn.commit()
+    
+    def get(self, task_id):
+        row = self.connection().execute(
+            'SELECT data, version FROM tasks WHERE task_id = ?', (task_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        task = json.loads(row[0])
+        task["version"] = row[1]
+        return task
+    
+    def _set_clause(self, fields):
+        """
+        SET de un UPDATE que escribe cada campo de primer nivel con json_set: un objeto se
+        sustituye entero (json_patch lo mezclaría con el anterior) y None se guarda como null.
+        """
+        paths = []
+        params = []
+        for field, value in fields.items():
+            paths.append("?, json(?)")
+            params += [f"$.{field}", json.dumps(value, ensure_ascii=False)]
+        clause = "version = version + 1"
+        if paths:
+            clause = f"data = json_set(data, {', '.join(paths)}), " + clause
+        # Las columnas status y completion_time se duplican fuera del JSON para poder indexarlas
+        for column in ("status", "completion_time"):
+            if column in fields:
+                clause += f", {column} = ?"
+                params.append(fields[column])
+        return clause, params
+    
+    def update(self, task_id, fields):
+        conn = self.connection()
+        clause, params = self._set_clause(fields)
+        cursor = conn.execute(f'UPDATE tasks SET {clause} WHERE task_id = ?', params + [task_id])
+        conn.commit()
+        return cursor.rowcount == 1
+    
+    def update_if(self, task_id, field, expected, fields):
+        conn = self.connection()
+        clause, params = self._set_clause(fields)
+        # La comparación se hace en Python, igual que en MemoryTaskStore; BEGIN IMMEDIATE toma
+        # el bloqueo de escritura antes de leer, así que nadie modifica la tarea entre SELECT y UPDATE
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT data FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+            if row is None or json.loads(row[0]).get(field) != expected:
+                conn.rollback()
+                return False
+            conn.execute(f'UPDATE tasks SET {clause} WHERE task_id = ?', params + [task_id])
+            conn.commit()
+            return True
+        except BaseException:
+            conn.rollback()
+            raise
+    
+    def increment(self, task_id, field, amount=1):
+        conn = self.connection()
+        path = f"$.{field}"
+        conn.execute(
+            'UPDATE tasks SET data = json_set(data, ?, COALESCE(json_extract(data, ?), 0) + ?), '
+            'version = version + 1 WHERE task_id = ?',
+            (path, path, amount, task_id)
+        )
+        conn.commit()
+    
+    def delete(self, task_id):
+        conn = self.connection()
+        conn.execute('DELETE FROM tasks WHERE task_id = ?', (task_id,))
+        conn.commit()
+    
+    def finished_before(self, timestamp):
+        return [row[0] for row in self.connection().execute(
+            'SELECT task_id FROM tasks WHERE status IN (?, ?) AND completion_time < ?',
+            TERMINAL_STATUSES + (timestamp,)
+        )]
+    
+    def unfinished(self):
+        return [(task_id, json.loads(data)) for task_id, data in self.connection().execute(
+            'SELECT task_id, data FROM tasks WHERE status NOT IN (?, ?)', TERMINAL_STATUSES
+        )]
+    
+    def claim_document(self, doc_key, task_id):
+        conn = self.connection()
+        # INSERT y SELECT en la misma transacción: ningún otro proceso escribe entre ambos
+        conn.execute('INSERT OR IGNORE INTO documents (doc_key, task_id) VALUES (?, ?)', (doc_key, task_id))
+        holder = conn.execute('SELECT task_id FROM documents WHERE doc_key = ?', (doc_key,)).fetchone()[0]
+        conn.commit()
+        return holder
+    
+    def replace_document(self, doc_key, expected_task_id, task_id):
+        conn = self.connection()
+        cursor = conn.execute(
+            'UPDATE documents SET task_id = ? WHERE doc_key = ? AND task_id = ?',
+            (task_id, doc_key, expected_task_id)
+        )
+        conn.commit()
+        return cursor.rowcount == 1
+    
+    def release_document(self, doc_key, task_id):
+        conn = self.connection()
+        conn.execute('DELETE FROM documents WHERE doc_key = ? AND task_id = ?', (doc_key, task_id))
+        conn.commit()
+
+class RedisTaskStore(TaskStore):
+    """
+    Tareas en un servidor Redis (o cualquier servidor compatible con su protocolo), para
+    varias réplicas en distintas máquinas. Cada tarea es un hash con los campos en JSON;
+    las actualizaciones son transacciones MULTI/EXEC vigiladas con WATCH.
+    """
+    shared = True
+    
+    def __init__(self, url=TASK_STORE_URL, prefix="tareas:"):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("TASK_STORE=redis necesita el paquete redis (pip install redis)") from e
+        self.redis = redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.finished_key = f"{prefix}terminadas"  # conjunto ordenado por completion_time
+        self.active_key = f"{prefix}activas"
+    
+    def key(self, task_id):
+        return f"{self.prefix}{task_id}"
+    
+    def create(self, task_id, fields):
+        pipe = self.client.pipeline()
+        pipe.delete(self.key(task_id))
+        pipe.hset(self.key(task_id), mapping=dict({k: json.dumps(v) for k, v in fields.items()}, version=0))
+        pipe.sadd(self.active_key, task_id)
+        pipe.execute()
+    
+    def get(self, task_id):
+        data = self.client.hgetall(self.key(task_id))
+        if not data:
+            return None
+        return {k.decode(): json.loads(v) for k, v in data.items()}
+    
+    def _modify(self, task_id, apply, check=None):
+        """Ejecuta apply(pipe) en una transacción solo si la tarea existe (y check(pipe) es cierto)."""
+        key = self.key(task_id)
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    if not pipe.exists(key) or (check and not check(pipe)):
+                        pipe.unwatch()
+                        return False
+                    pipe.multi()
+                    apply(pipe)
+                    pipe.hincrby(key, "version", 1)
+                    pipe.execute()
+                    return True
+                except self.redis.WatchError:
+                    continue  # Otro proceso modificó la tarea: reintentar
+    
+    def update(self, task_id, fields, check=None):
+        def apply(pipe):
+            pipe.hset(self.key(task_id), mapping={k: json.dumps(v) for k, v in fields.items()})
+            if fields.get("status") in TERMINAL_STATUSES:
+                pipe.srem(self.active_key, task_id)
+                pipe.zadd(self.finished_key, {task_id: fields.get("completion_time", time.time())})
+            elif fields.get("status"):
+                # Una tarea que vuelve a la cola (reanudada o reintentada) deja de estar terminada
+                pipe.zrem(self.finished_key, task_id)
+                pipe.sadd(self.active_key, task_id)
+        return self._modify(task_id, apply, check)
+    
+    def update_if(self, task_id, field, expected, fields):
+        def check(pipe):
+            value = pipe.hget(self.key(task_id), field)
+            return (json.loads(value) if value is not None else None) == expected
+        return self.update(task_id, fields, check)
+    
+    def increment(self, task_id, field, amount=1):
+        # Los enteros en JSON son el mismo texto que espera HINCRBY
+        self._modify(task_id, lambda pipe: pipe.hincrby(self.key(task_id), field, amount))
+    
+    def delete(self, task_id):
+        pipe = self.client.pipeline()
+        pipe.delete(self.key(task_id))
+        pipe.srem(self.active_key, task_id)
+        pipe.zrem(self.finished_key, task_id)
+        pipe.execute()
+    
+    def finished_before(self, timestamp):
+        return [task_id.decode() for task_id in
+                self.client.zrangebyscore(self.finished_key, "-inf", f"({timestamp}")]
+    
+    def unfinished(self):
+        tasks = []
+        for task_id in self.client.smembers(self.active_key):
+            task = self.get(task_id.decode())
+            if task is not None:
+                tasks.append((task_id.decode(), task))
+        return tasks
+    
+    def document_key(self, doc_key):
+        return f"{self.prefix}documento:{doc_key}"
+    
+    def claim_document(self, doc_key, task_id):
+        key = self.document_key(doc_key)
+        while True:
+            if self.client.set(key, task_id, nx=True):
+                return task_id
+            holder = self.client.get(key)
+            if holder is not None:
+                return holder.decode()
+            # La clave se borró entre SET y GET: volver a intentarlo
+    
+    def _swap_document(self, doc_key, expected_task_id, task_id):
+        """Cambia (o borra, si task_id es None) la asignación si sigue siendo expected_task_id."""
+        key = self.document_key(doc_key)
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    holder = pipe.get(key)
+                    if holder is None or holder.decode() != expected_task_id:
+                        pipe.unwatch()
+                        return False
+                    pipe.multi()
+                    if task_id is None:
+                        pipe.delete(key)
+                    else:
+                        pipe.set(key, task_id)
+                    pipe.execute()
+                    return True
+                except self.redis.WatchError:
+                    continue  # Otro proceso cambió la asignación: reintentar
+    
+    def replace_document(self, doc_key, expected_task_id, task_id):
+        return self._swap_document(doc_key, expected_task_id, task_id)
+    
+    def release_document(self, doc_key, task_id):
+        self._swap_document(doc_key, task_id, None)
+
+def create_task_store(name):
+    """Crea el almacén de tareas a partir de su nombre."""
+    stores = {
+        "memory": MemoryTaskStore,
+        "sqlite": SQLiteTaskStore,
+        "redis": RedisTaskStore
+    }
+    if name not in stores:
+        raise ValueError(f"Almacén de tareas desconocido: {name}")
+    return stores[name]()
+
+task_store = create_task_store(TASK_STORE)
+task_store.init()
+
+class TaskEvents:
+    """
+    Avisa a las conexiones SSE cuando cambia el estado de una tarea. Los hilos de trabajo
+    llaman a notify(); los suscriptores esperan dentro del bucle de asyncio con wait().
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.versions = {}
+        self.waiters = {}  # task_id -> {(bucle, asyncio.Event)}
+    
+    def version(self, task_id):
+        with self.lock:
+            return self.versions.get(task_id, 0)
+    
+    def notify(self, task_id):
+        with self.lock:
+            self.versions[task_id] = self.versions.get(task_id, 0) + 1
+            waiters = list(self.waiters.get(task_id, ()))
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass  # El bucle ya se ha cerrado
+    
+    async def wait(self, task_id, version, timeout):
+        """Espera hasta que la versión de la tarea cambie o pase timeout. Devuelve la versión actual."""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self.lock:
+            if self.versions.get(task_id, 0) != version:
+                return self.versions.get(task_id, 0)
+            self.waiters.setdefault(task_id, set()).add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self.lock:
+                task_waiters = self.waiters.get(task_id)
+                if task_waiters is not None:
+                    task_waiters.discard(waiter)
+                    if not task_waiters:
+                        del self.waiters[task_id]
+        return self.version(task_id)
+    
+    def forget(self, task_id):
+        with self.lock:
+            self.versions.pop(task_id, None)
+
+task_events = TaskEvents()
+
+def update_task(task_id, **fields):
+    """Actualiza campos del estado de una tarea y avisa a sus suscriptores."""
+    if task_store.update(task_id, fields):
+        task_events.notify(task_id)
+
+def fail_task(task_id, error):
+    """Marca una tarea como fallida; completion_time permite limpiarla más tarde."""
+    update_task(task_id, status="error", error=error, completion_time=time.time())
+
+def resubmit_task(task_id, task, field, expected):
+    """
+    Vuelve a encolar una tarea con su archivo original; el trabajo se reanuda desde su manifiesto
+    (JobCheckpoint). El cambio de estado es condicional (task[field] == expected) para que solo
+    un proceso la retome. Devuelve True si la tarea quedó encolada.
+    """
+    file_path = task.get("file_path")
+    if not file_path or not os.path.exists(file_path):
+        return False
+    if not task_store.update_if(task_id, field, expected, {
+        "status": "queued",
+        "owner": WORKER_ID,
+        "error": None,
+        "retryable": None,
+        "completion_time": None,
+        "progress": 0,
+        "segments_ready": 0,
+        "chunks_done": 0,
+        # Estadísticas del intento anterior: el nuevo intento las cuenta desde cero
+        "cache_hits": 0,
+        "cache_misses": 0,
+        "chunk_latency": None,
+        "time_to_first_audio": None,
+        "chunks_total": None,
+        "chunks_resumed": None,
+        "pages_done": 0,
+        "pages_total": None,
+        "start_time": time.time(),
+        "resumes": task.get("resumes", 0) + 1
+    }):
+        return False
+    task_events.notify(task_id)
+    try:
+        job_scheduler.submit(
+            task_id, process_file_thread, task_id, file_path, task["file_ext"], task.get("lang", "es"),
+            resume=True, estimated_time=task.get("estimated_time")
+        )
+    except JobQueueFullError:
+        update_task(task_id, status="error", error="El servidor está ocupado. Inténtalo de nuevo más tarde.",
+                    completion_time=time.time(), retryable=True)
+        return False
+    return True
+
+def recover_interrupted_tasks():
+    """
+    Reanuda las tareas en cola o en proceso de un proceso de este servidor que ya no existe
+    (reinicio o caída); si su archivo ya no está, las marca como fallidas. Las de otros workers
+    vivos o de otras máquinas no se tocan. Se llama al arrancar, antes de aceptar tareas: si el
+    dueño coincide con este proceso es un predecesor con el mismo PID (p. ej. el 1 de un contenedor).
+    """
+    if os.name != "posix":
+        return 0  # Sin una forma segura de comprobar si un proceso sigue vivo
+    hostname = socket.gethostname()
+    resumed = failed = 0
+    for task_id, task in task_store.unfinished():
+        owner = task.get("owner", "")
+        owner_host, owner_pid, owner_start = (owner.split(":") + [""])[:3]
+        if owner_host != hostname or not owner_pid.isdigit():
+            continue
+        if owner_pid != str(os.getpid()):
+            try:
+                os.kill(int(owner_pid), 0)
+            except ProcessLookupError:
+                pass
+            except PermissionError:
+                continue
+            else:
+                # Hay un proceso con ese PID: es el dueño salvo que haya arrancado en otro momento
+                if not owner_start or process_start_token(owner_pid) in ("", owner_start):
+                    continue
+        if resubmit_task(task_id, task, "owner", owner):
+            resumed += 1
+        elif task_store.update_if(task_id, "owner", owner, {"owner": WORKER_ID}):
+            # Sin el archivo original no se puede reanudar
+            fail_task(task_id, "El servidor se reinició antes de terminar la tarea. Vuelve a subir el archivo.")
+            failed += 1
+    if resumed or failed:
+        print(f"Tareas interrumpidas por un reinicio: {resumed} reanudadas, {failed} fallidas")
+    return resumed
+
+def document_key(file_hash, lang):
+    """Clave de un documento en el índice de documentos: mismo contenido y mismo idioma."""
+    return f"{lang}:{file_hash}"
+
+def resolve_duplicate_upload(task_id, file_hash, lang):
+    """
+    Registra la tarea (ya creada) en el índice de documentos. Si el mismo documento ya se
+    convirtió, la completa al instante enlazando el audio y el texto existentes; si se está
+    convirtiendo, devuelve el id de esa tarea para que el cliente la siga en lugar de empezar
+    otra conversión. Devuelve el id de la tarea que atiende la subida, o None si hay que procesarla.
+    """
+    doc_key = document_key(file_hash, lang)
+    while True:
+        holder_id = task_store.claim_document(doc_key, task_id)
+        if holder_id == task_id:
+            return None
+        holder = task_store.get(holder_id)
+        if holder is not None and holder["status"] not in TERMINAL_STATUSES:
+            return holder_id
+        if holder is not None and holder["status"] == "completed" and link_task_outputs(holder_id, task_id):
+            update_task(
+                task_id,
+                status="completed",
+                progress=100,
+                completion_time=time.time(),
+                audio_size=holder.get("audio_size"),
+                duration=holder.get("duration"),
+                chunks_total=holder.get("chunks_total"),
+                deduplicated_from=holder_id
+            )
+            # La copia más reciente es la que más tarda en limpiarse: los próximos duplicados se enlazan desde ella
+            task_store.replace_document(doc_key, holder_id, task_id)
+            return task_id
+        # Tarea fallida, ya limpiada o sin archivos: esta subida ocupa su lugar
+        if task_store.replace_document(doc_key, holder_id, task_id):
+            return None
+
+class UploadTooLargeError(Exception):
+    """Se lanza cuando una subida supera MAX_UPLOAD_SIZE mientras se recibe."""
+    pass
+
+class UploadSizeLimit:
+    """
+    Middleware ASGI que limita el cuerpo de las subidas a /convert mientras llega: Starlette guarda
+    todo el multipart antes de llamar al endpoint, así que su comprobación llega tarde. Si el
+    Content-Length declarado es mayor se rechaza sin leer nada; si no lo hay (Transfer-Encoding:
+    chunked) o miente, se responde 413 en cuanto se supera y la aplicación deja de recibir.
+    """
+    def __init__(self, app, max_body_size=MAX_UPLOAD_SIZE + UPLOAD_CHUNK_SIZE):
+        # El cuerpo multipart añade algo de sobrecarga, así que se deja un pequeño margen
+        self.app = app
+        self.max_body_size = max_body_size
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] != "/convert":
+            await self.app(scope, receive, send)
+            return
+        too_large = JSONResponse(content={"error": "El archivo excede el tamaño máximo permitido de 50MB"}, status_code=413)
+        content_length = Headers(scope=scope).get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_body_size:
+            await too_large(scope, receive, send)
+            return
+        
+        received = 0
+        rejected = False
+        async def limited_receive():
+            nonlocal received, rejected
+            if rejected:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body_size:
+                    # Responder ya y hacer creer a la aplicación que el cliente se ha ido
+                    rejected = True
+                    await too_large(scope, receive, send)
+                    return {"type": "http.disconnect"}
+            return message
+        
+        async def guarded_send(message):
+            if not rejected:
+                await send(message)
+        
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not rejected:
+                raise
+
+app.add_middleware(UploadSizeLimit)
+
+async def save_upload_streaming(file: UploadFile, destination: str, max_size: int = MAX_UPLOAD_SIZE):
+    """
+    Guarda el archivo subido en disco por bloques de tamaño fijo.
+    Comprueba el límite de tamaño a medida que llegan los bytes y calcula el hash del contenido.
+    Devuelve (tamaño, hash_sha256).
+    """
+    hasher = hashlib.sha256()
+    file_size = 0
+    try:
+        with open(destination, "wb") as buffer:
+            while True:
+                block = await file.read(UPLOAD_CHUNK_SIZE)
+                if not block:
+                    break
+                file_size += len(block)
+                if file_size > max_size:
+                    raise UploadTooLargeError(f"El archivo supera {max_size} bytes")
+                hasher.update(block)
+                buffer.write(block)
+    except Exception:
+        # No dejar archivos parciales en temp
+        cleanup_temp_files([destination])
+        raise
+    return file_size, hasher.hexdigest()
+
+# Ruta de la base de datos del caché
+CACHE_DB_PATH = 'cache/text_audio_cache.db'
+SQLITE_MAX_VARIABLES = 500  # parámetros por consulta en las búsquedas por lotes
+
+class CacheRepository:
+    """
+    Acceso a la base de datos del caché de fragmentos.
+    Mantiene una conexión por hilo en modo WAL (lectores y escritores no se bloquean entre sí)
+    y agrupa las búsquedas de una tarea en una sola consulta.
+    """
+    def __init__(self, db_path=CACHE_DB_PATH):
+        self.db_path = db_path
+        self.local = threading.local()
+    
+    def connection(self):
+        """Devuelve la conexión del hilo actual, creándola si hace falta."""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')  # Suficiente con WAL y mucho más rápido
+            self.local.conn = conn
+        return conn
+    
+    def init_schema(self):
+        conn = self.connection()
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS text_chunks (
+            hash_id TEXT PRIMARY KEY,
+            text TEXT,
+            audio_path TEXT,
+            created_at INTEGER
+        )
+        ''')
+        # Migración: bases de datos anteriores no tenían estas columnas
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(text_chunks)')]
+        new_columns = {
+            'lang': 'TEXT',
+            'last_access': 'INTEGER',
+            'hit_count': 'INTEGER DEFAULT 0',
+            'size_bytes': 'INTEGER DEFAULT 0',
+            'minhash': 'BLOB'  # firma MinHash del texto (ChunkSimilarityIndex)
+        }
+        for name, definition in new_columns.items():
+            if name not in columns:
+                conn.execute(f'ALTER TABLE text_chunks ADD COLUMN {name} {definition}')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_text_chunks_last_access ON text_chunks (last_access)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_text_chunks_hit_count ON text_chunks (hit_count, last_access)')
+        conn.commit()
+    
+    def get_audio_path(self, cache_key):
+        row = self.connection().execute(
+            'SELECT audio_path FROM text_chunks WHERE hash_id = ?', (cache_key,)
+        ).fetchone()
+        return row[0] if row else None
+    
+    def lookup_many(self, cache_keys):
+        """Busca varias claves a la vez. Devuelve {clave: audio_path} solo para las encontradas."""
+        keys = list(dict.fromkeys(cache_keys))
+        found = {}
+        conn = self.connection()
+        for i in range(0, len(keys), SQLITE_MAX_VARIABLES):
+            batch = keys[i:i + SQLITE_MAX_VARIABLES]
+            placeholders = ','.join('?' * len(batch))
+            for hash_id, audio_path in conn.execute(
+                    f'SELECT hash_id, audio_path FROM text_chunks WHERE hash_id IN ({placeholders})', batch):
+                found[hash_id] = audio_path
+        return found
+    
+    def insert(self, cache_key, text, audio_path, lang, size_bytes, minhash=None):
+        """Inserta una entrada si no existe. Devuelve True si la fila es nueva."""
+        now = int(time.time())
+        conn = self.connection()
+        cursor = conn.execute(
+            'INSERT OR IGNORE INTO text_chunks '
+            '(hash_id, text, audio_path, created_at, lang, last_access, hit_count, size_bytes, minhash) '
+            'VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?)',
+            (cache_key, text, audio_path, now, lang, now, size_bytes, minhash)
+        )
+        conn.commit()
+        return cursor.rowcount == 1
+    
+    def recent_signatures(self, limit):
+        """Firmas MinHash de las entradas usadas más recientemente: [(clave, idioma, firma)]."""
+        return self.connection().execute(
+            'SELECT hash_id, lang, minhash FROM text_chunks WHERE minhash IS NOT NULL '
+            'ORDER BY last_access DESC LIMIT ?', (limit,)
+        ).fetchall()
+    
+    def texts_without_signature(self, limit):
+        """Entradas de bases de datos anteriores a las firmas: [(clave, idioma, texto)]."""
+        return self.connection().execute(
+            'SELECT hash_id, lang, text FROM text_chunks WHERE minhash IS NULL AND text IS NOT NULL '
+            'ORDER BY last_access DESC LIMIT ?', (limit,)
+        ).fetchall()
+    
+    def set_signatures(self, rows):
+        """Guarda firmas calculadas más tarde: [(firma, clave)]."""
+        conn = self.connection()
+        conn.executemany('UPDATE text_chunks SET minhash = ? WHERE hash_id = ?', rows)
+        conn.commit()
+    
+    def touch_many(self, cache_keys):
+        """Registra aciertos: actualiza el último acceso y el contador de usos en una transacción."""
+        if not cache_keys:
+            return
+        now = int(time.time())
+        conn = self.connection()
+        conn.executemany(
+            'UPDATE text_chunks SET last_access = ?, hit_count = hit_count + 1 WHERE hash_id = ?',
+            [(now, key) for key in cache_keys]
+        )
+        conn.commit()
+
+# Repositorio único del caché
+cache_repository = CacheRepository()
+
+class MemoryCacheTier:
+    """
+    Capa de caché en memoria delante de SQLite, con expiración por tiempo.
+    Guarda también los fallos (valor None) con una vida más corta, y permite invalidar
+    entradas cuando se almacenan o expulsan fragmentos.
+    """
+    def __init__(self, max_entries=MEMORY_CACHE_MAX_ENTRIES, ttl=MEMORY_CACHE_TTL,
+                 negative_ttl=MEMORY_CACHE_NEGATIVE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "negative_hits": 0, "misses": 0, "expired": 0, "invalidations": 0}
+    
+    def get(self, key):
+        """Devuelve (encontrado, valor). valor es None si lo guardado es un fallo."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.counters["misses"] += 1
+                return False, None
+            value, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self.entries[key]
+                self.counters["expired"] += 1
+                self.counters["misses"] += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.counters["hits" if value is not None else "negative_hits"] += 1
+            return True, value
+    
+    def put(self, key, value):
+        """Guarda un valor (o None para un fallo) con la vida correspondiente."""
+        ttl = self.ttl if value is not None else self.negative_ttl
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+    
+    def invalidate(self, key):
+        self.invalidate_many([key])
+    
+    def invalidate_many(self, keys):
+        with self.lock:
+            for key in keys:
+                if self.entries.pop(key, None) is not None:
+                    self.counters["invalidations"] += 1
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+    
+    def stats(self):
+        with self.lock:
+            lookups = self.counters["hits"] + self.counters["negative_hits"] + self.counters["misses"]
+            answered = self.counters["hits"] + self.counters["negative_hits"]
+            return dict(self.counters, size=len(self.entries),
+                        hit_rate=(answered / lookups) if lookups else 0.0)
+
+# Capa en memoria compartida por todos los hilos del proceso
+memory_cache = MemoryCacheTier()
 
 # Inicializar la base de datos para el caché
 def init_cache_db():
-    conn = sqlite3.connect('cache/text_audio_cache.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS text_chunks (
-        hash_id TEXT PRIMARY KEY,
-        text TEXT,
-        audio_path TEXT,
-        created_at INTEGER
-    )
-    ''')
-    conn.commit()
-    conn.close()
+    cache_repository.init_schema()
 
 # Inicializar el caché
 init_cache_db()
 
-# Sistema de caché usando LRU para fragmentos de texto frecuentes
-@lru_cache(maxsize=100)
-def get_cached_audio_path(text_hash):
-    """Busca un fragmento de texto en el caché y devuelve la ruta del audio si existe."""
-    conn = sqlite3.connect('cache/text_audio_cache.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT audio_path FROM text_chunks WHERE hash_id = ?', (text_hash,))
-    result = cursor.fetchone()
-    conn.close()
-    
-    if result:
-        return result[0]
-    return None
+# Directorio del almacén de audio direccionado por contenido
+AUDIO_CACHE_DIR = "cache/audio"
+
+# Contadores de aciertos del caché de fragmentos
+cache_stats = {"hits": 0, "misses": 0}
+cache_stats_lock = threading.Lock()
+
+def record_cache_lookup(hit, task_id=None):
+    """Actualiza los contadores de aciertos y fallos del caché, globales y de la tarea."""
+    counter = "hits" if hit else "misses"
+    with cache_stats_lock:
+        cache_stats[counter] += 1
+    if task_id:
+        task_store.increment(task_id, f"cache_{counter}")
+
+def get_cache_hit_rate():
+    """Devuelve los contadores del caché junto con la tasa de aciertos."""
+    with cache_stats_lock:
+        total = cache_stats["hits"] + cache_stats["misses"]
+        return dict(cache_stats, hit_rate=(cache_stats["hits"] / total) if total else 0.0)
+
+def chunk_cache_key(text, lang):
+    """
+    Clave de caché de un fragmento: hash del idioma junto con el texto en forma canónica, de modo
+    que fragmentos que se pronuncian igual (solo cambian espacios o la forma Unicode) la comparten.
+    """
+    return hashlib.sha256(f"{lang}\0{canonical_text(text)}".encode('utf-8')).hexdigest()
+
+def audio_store_path(cache_key):
+    """Ruta del MP3 de un fragmento dentro del almacén direccionado por contenido."""
+    return os.path.join(AUDIO_CACHE_DIR, f"{cache_key}.mp3")
+
+def get_cached_audio_path(cache_key):
+    """Busca un fragmento en el caché (memoria y después SQLite) y devuelve la ruta del audio si existe."""
+    found, audio_path = memory_cache.get(cache_key)
+    if not found:
+        audio_path = cache_repository.get_audio_path(cache_key)
+        memory_cache.put(cache_key, audio_path)
+    return audio_path
 
-def store_in_cache(text, audio_path):
-    """Almacena un fragmento de texto y su audio correspondiente en el caché."""
-    text_hash = hashlib.md5(text.encode('utf-8')).hexdigest()
+def lookup_cached_audio_paths(cache_keys):
+    """
+    Busca varios fragmentos a la vez. Las claves que no están en memoria se resuelven
+    con una sola consulta a SQLite. Devuelve {clave: audio_path} solo para los aciertos.
+    """
+    found_paths = {}
+    pending = []
+    for key in dict.fromkeys(cache_keys):
+        found, audio_path = memory_cache.get(key)
+        if not found:
+            pending.append(key)
+        elif audio_path is not None:
+            found_paths[key] = audio_path
     
-    conn = sqlite3.connect('cache/text_audio_cache.db')
-    cursor = conn.cursor()
+    if pending:
+        db_paths = cache_repository.lookup_many(pending)
+        for key in pending:
+            memory_cache.put(key, db_paths.get(key))
+        found_paths.update(db_paths)
+    return found_paths
+
+def store_in_cache(text, lang, audio_path, signature=None):
+    """
+    Mueve el audio de un fragmento al almacén persistente y lo registra en el caché y en el
+    índice de fragmentos casi iguales. Devuelve la ruta definitiva dentro del almacén.
+    """
+    cache_key = chunk_cache_key(text, lang)
+    store_path = audio_store_path(cache_key)
+    if signature is None:
+        signature = similarity_index.signature(text)
     
-    # Comprobar si ya existe
-    cursor.execute('SELECT hash_id FROM text_chunks WHERE hash_id = ?', (text_hash,))
-    if cursor.fetchone() is None:
-        cursor.execute(
-            'INSERT INTO text_chunks (hash_id, text, audio_path, created_at) VALUES (?, ?, ?, ?)',
-            (text_hash, text, audio_path, int(time.time()))
-        )
+    # El reemplazo es atómico: un lector nunca ve un archivo a medio escribir
+    os.replace(audio_path, store_path)
+    
+    size_bytes = os.path.getsize(store_path)
+    minhash = signature.tobytes() if signature is not None else None
+    if cache_repository.insert(cache_key, text, store_path, lang, size_bytes, minhash):
+        cache_manager.record_insert(size_bytes)
+    # Sustituir un posible fallo guardado en memoria
+    memory_cache.put(cache_key, store_path)
+    similarity_index.add(cache_key, lang, signature)
+    return store_path
+
+def link_or_copy(source, destination):
+    """Enlaza el archivo sin copiar bytes (hardlink) y copia solo si el enlace no es posible."""
+    try:
+        os.link(source, destination)
+    except OSError:
+        # Copia atómica: un trabajo interrumpido nunca deja un fragmento a medias
+        shutil.copy2(source, f"{destination}.tmp")
+        os.replace(f"{destination}.tmp", destination)
+
+class CacheManager:
+    """
+    Mantiene el caché de audio dentro de un presupuesto de bytes y de entradas.
+    Expulsa por LRU (último acceso) o LFU (número de usos) en lotes, y repara las
+    inconsistencias entre filas de text_chunks y archivos de cache/audio tras una caída.
+    """
+    def __init__(self, repository, max_bytes=CACHE_MAX_BYTES, max_entries=CACHE_MAX_ENTRIES,
+                 policy=CACHE_EVICTION_POLICY, batch_size=CACHE_EVICTION_BATCH):
+        if policy not in ("lru", "lfu"):
+            raise ValueError(f"Política de expulsión desconocida: {policy}")
+        self.repository = repository
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.policy = policy
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.evict_lock = threading.Lock()
+        self.total_bytes, self.total_entries = self.usage()
+    
+    def usage(self):
+        """Devuelve (bytes, entradas) registrados en la base de datos."""
+        entries, total_bytes = self.repository.connection().execute(
+            'SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM text_chunks'
+        ).fetchone()
+        return total_bytes, entries
+    
+    def record_insert(self, size_bytes):
+        """Contabiliza una entrada nueva y expulsa si se supera el presupuesto."""
+        with self.lock:
+            self.total_bytes += size_bytes
+            self.total_entries += 1
+            over_budget = self.total_bytes > self.max_bytes or self.total_entries > self.max_entries
+        if over_budget:
+            self.evict()
+    
+    def _eviction_order(self):
+        if self.policy == "lfu":
+            return 'hit_count ASC, last_access ASC'
+        return 'last_access ASC'
+    
+    def _delete_entries(self, conn, rows):
+        """Borra primero las filas y después los archivos: una caída deja como mucho archivos huérfanos."""
+        conn.executemany('DELETE FROM text_chunks WHERE hash_id = ?', [(row[0],) for row in rows])
         conn.commit()
+        memory_cache.invalidate_many([row[0] for row in rows])
+        similarity_index.discard_many([row[0] for row in rows])
+        for _, audio_path, _ in rows:
+            if audio_path and os.path.exists(audio_path):
+                try:
+                    os.remove(audio_path)
+                except OSError:
+                    pass
     
-    conn.close()
-    return text_hash
+    def evict(self):
+        """Expulsa entradas hasta volver a estar dentro del presupuesto. Devuelve cuántas se borraron."""
+        if not self.evict_lock.acquire(blocking=False):
+            return 0  # Ya hay otra expulsión en curso
+        try:
+            total_bytes, total_entries = self.usage()
+            if total_bytes <= self.max_bytes and total_entries <= self.max_entries:
+                return 0
+            # Bajar por debajo del límite deja margen y evita expulsar en cada inserción
+            excess_bytes = total_bytes - int(self.max_bytes * CACHE_EVICTION_TARGET)
+            excess_entries = total_entries - int(self.max_entries * CACHE_EVICTION_TARGET)
+            evicted = 0
+            
+            conn = self.repository.connection()
+            while excess_bytes > 0 or excess_entries > 0:
+                rows = conn.execute(
+                    f'SELECT hash_id, audio_path, COALESCE(size_bytes, 0) FROM text_chunks '
+                    f'ORDER BY {self._eviction_order()} LIMIT ?',
+                    (self.batch_size,)
+                ).fetchall()
+                if not rows:
+                    break
+                
+                victims = []
+                for row in rows:
+                    if excess_bytes <= 0 and excess_entries <= 0:
+                        break
+                    victims.append(row)
+                    excess_bytes -= row[2]
+                    excess_entries -= 1
+                self._delete_entries(conn, victims)
+                evicted += len(victims)
+            
+            with self.lock:
+                self.total_bytes, self.total_entries = self.usage()
+            if evicted:
+                print(f"Caché: {evicted} entradas expulsadas ({self.policy})")
+            return evicted
+        finally:
+            self.evict_lock.release()
+    
+    def remove_older_than(self, max_age_days):
+        """Borra en lotes las entradas a las que no se ha accedido en max_age_days días."""
+        max_age = int(time.time()) - (max_age_days * 24 * 60 * 60)
+        removed = 0
+        conn = self.repository.connection()
+        while True:
+            rows = conn.execute(
+                'SELECT hash_id, audio_path, COALESCE(size_bytes, 0) FROM text_chunks '
+                'WHERE COALESCE(last_access, created_at) < ? LIMIT ?',
+                (max_age, self.batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            self._delete_entries(conn, rows)
+            removed += len(rows)
+        with self.lock:
+            self.total_bytes, self.total_entries = self.usage()
+        return removed
+    
+    def reconcile(self, grace_seconds=600):
+        """
+        Repara el caché tras una caída: borra filas cuyo archivo ya no existe, archivos sin fila
+        y corrige el tamaño de las filas antiguas. Los archivos recientes se respetan porque
+        store_in_cache mueve el archivo antes de insertar su fila.
+        """
+        conn = self.repository.connection()
+        known_paths = set()
+        missing = []
+        sizes = []
+        for hash_id, audio_path, size_bytes in conn.execute(
+                'SELECT hash_id, audio_path, size_bytes FROM text_chunks'):
+            if not audio_path or not os.path.exists(audio_path):
+                missing.append((hash_id,))
+                continue
+            known_paths.add(os.path.normpath(audio_path))
+            if not size_bytes:
+                sizes.append((os.path.getsize(audio_path), hash_id))
+        
+        for i in range(0, len(missing), self.batch_size):
+            conn.executemany('DELETE FROM text_chunks WHERE hash_id = ?', missing[i:i + self.batch_size])
+            conn.commit()
+        memory_cache.invalidate_many([row[0] for row in missing])
+        similarity_index.discard_many([row[0] for row in missing])
+        if sizes:
+            conn.executemany('UPDATE text_chunks SET size_bytes = ? WHERE hash_id = ?', sizes)
+            conn.commit()
+        
+        orphans = 0
+        now = time.time()
+        for entry in os.scandir(AUDIO_CACHE_DIR):
+            path = os.path.normpath(entry.path)
+            if entry.is_file() and path not in known_paths and now - entry.stat().st_mtime > grace_seconds:
+                try:
+                    os.remove(path)
+                    orphans += 1
+                except OSError:
+                    pass
+        
+        with self.lock:
+            self.total_bytes, self.total_entries = self.usage()
+        if missing or orphans:
+            print(f"Caché reparado: {len(missing)} filas sin archivo, {orphans} archivos huérfanos")
+        return {"missing_rows": len(missing), "orphan_files": orphans}
+    
+    def stats(self):
+        with self.lock:
+            return {
+                "bytes": self.total_bytes,
+                "entries": self.total_entries,
+                "max_bytes": self.max_bytes,
+                "max_entries": self.max_entries,
+                "policy": self.policy
+            }
+
+# Gestor único del caché de audio
+cache_manager = CacheManager(cache_repository)
 
 def clean_old_cache(max_age_days=30):
     """Limpia entradas de caché antiguas."""
-    max_age = int(time.time()) - (max_age_days * 24 * 60 * 60)
+    return cache_manager.remove_older_than(max_age_days)
+
+def run_cache_maintenance():
+    """Repara, limpia por antigüedad y ajusta el caché a su presupuesto."""
+    cache_manager.reconcile()
+    clean_old_cache()
+    cache_manager.evict()
+
+class JobQueueFullError(Exception):
+    """Se lanza cuando la cola de trabajos ha alcanzado MAX_QUEUED_JOBS."""
+    def __init__(self, retry_after):
+        super().__init__("La cola de trabajos está llena")
+        self.retry_after = retry_after
+
+class JobScheduler:
+    """
+    Planificador global de trabajos para todo el proceso.
+    Limita cuántos documentos se procesan a la vez y encola el resto, el más corto primero
+    (según su tiempo estimado); un trabajo solo puede ser adelantado JOB_MAX_BYPASS veces.
+    """
+    def __init__(self, max_concurrent=MAX_CONCURRENT_JOBS, max_queued=MAX_QUEUED_JOBS):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue = deque()
+        self.running = set()
+        self.condition = threading.Condition()
+        self.workers = []
+        self.recent_durations = deque(maxlen=20)
     
-    conn = sqlite3.connect('cache/text_audio_cache.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT audio_path FROM text_chunks WHERE created_at < ?', (max_age,))
-    old_files = cursor.fetchall()
+    def _ensure_started(self):
+        """Arranca los hilos trabajadores la primera vez que se necesitan."""
+        if self.workers:
+            return
+        for i in range(self.max_concurrent):
+            worker = threading.Thread(target=self._worker_loop, name=f"job-worker-{i}")
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
     
-    # Eliminar archivos físicos
-    for (file_path,) in old_files:
-        if os.path.exists(file_path):
+    def submit(self, task_id, func, *args, estimated_time=None, **kwargs):
+        """Encola un trabajo. Devuelve la posición en la cola o lanza JobQueueFullError."""
+        with self.condition:
+            if len(self.queue) >= self.max_queued:
+                raise JobQueueFullError(self.estimate_wait(len(self.queue)))
+            self._ensure_started()
+            # Adelantar a los trabajos más largos del final de la cola que aún se pueden adelantar
+            position = len(self.queue)
+            if estimated_time is not None:
+                while position > 0:
+                    queued = self.queue[position - 1]
+                    if queued["estimated_time"] is None or queued["estimated_time"] <= estimated_time:
+                        break
+                    if queued["bypassed"] >= JOB_MAX_BYPASS:
+                        break
+                    position -= 1
+                for i in range(position, len(self.queue)):
+                    self.queue[i]["bypassed"] += 1
+            self.queue.insert(position, {
+                "task_id": task_id, "func": func, "args": args, "kwargs": kwargs,
+                "estimated_time": estimated_time, "bypassed": 0
+            })
+            self.condition.notify()
+            return position + 1
+    
+    def position(self, task_id):
+        """Posición (1..N) de la tarea en la cola, 0 si ya se está procesando o no está encolada."""
+        with self.condition:
+            for i, queued in enumerate(self.queue):
+                if queued["task_id"] == task_id:
+                    return i + 1
+        return 0
+    
+    def estimate_wait(self, position):
+        """Estima en segundos cuánto esperará un trabajo en la posición dada."""
+        if self.recent_durations:
+            avg_duration = sum(self.recent_durations) / len(self.recent_durations)
+        else:
+            avg_duration = QUEUE_RETRY_AFTER
+        return max(1, math.ceil(avg_duration * math.ceil(position / self.max_concurrent)))
+    
+    def stats(self):
+        """Resumen del estado del planificador para diagnóstico."""
+        with self.condition:
+            return {
+                "max_concurrent": self.max_concurrent,
+                "max_queued": self.max_queued,
+                "running": len(self.running),
+                "queued": len(self.queue)
+            }
+    
+    def _worker_loop(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                job = self.queue.popleft()
+                task_id, func, args, kwargs = job["task_id"], job["func"], job["args"], job["kwargs"]
+                self.running.add(task_id)
+            
+            start = time.time()
             try:
-                os.remove(file_path)
-            except:
-                pass
+                update_task(task_id, status="processing")
+                func(*args, **kwargs)
+            except Exception as e:
+                print(f"Error no controlado en el trabajo {task_id}: {str(e)}")
+                traceback.print_exc()
+                fail_task(task_id, f"Error: {str(e)}")
+            finally:
+                with self.condition:
+                    self.running.discard(task_id)
+                    self.recent_durations.append(time.time() - start)
+
+# Planificador único para todas las subidas
+job_scheduler = JobScheduler()
+
+def percentiles(values, points=(50, 95, 99)):
+    """Percentiles (método del rango más cercano) de una lista de valores, redondeados a milisegundos."""
+    if not values:
+        return {}
+    ordered = sorted(values)
+    return {f"p{point}": round(ordered[min(len(ordered) - 1, math.ceil(point / 100 * len(ordered)) - 1)], 3)
+            for point in points}
+
+class FairChunkScheduler:
+    """
+    Hilos de síntesis compartidos por todas las tareas, repartidos con colas justas ponderadas (WFQ).
+    Cada tarea tiene su propia cola FIFO y se atiende antes la que menos servicio ha recibido
+    (caracteres enviados a sintetizar); con el mismo servicio, la que tiene menos fragmentos
+    pendientes. Una tarea que empieza parte del servicio de la última atendida: no espera detrás
+    de los miles de fragmentos ya encolados de un documento enorme, pero tampoco lo deja sin turno.
+    """
+    def __init__(self, max_workers=MAX_WORKERS, thread_name_prefix="tts"):
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self.queues = {}  # task_id -> deque de (future, fn, args, kwargs, coste, instante de envío)
+        self.served = {}  # task_id -> servicio virtual recibido
+        self.virtual_time = 0.0
+        self.latencies = {}  # task_id -> latencias de sus fragmentos (envío -> terminado)
+        self.recent_waits = deque(maxlen=CHUNK_LATENCY_SAMPLES)
+        self.condition = threading.Condition()
+        self.workers = []
+    
+    def submit(self, task_id, cost, fn, *args, **kwargs):
+        """Encola fn(*args) para la tarea; cost es el trabajo estimado (caracteres). Devuelve un Future."""
+        future = concurrent.futures.Future()
+        with self.condition:
+            if len(self.workers) < self.max_workers:
+                worker = threading.Thread(target=self._worker_loop, daemon=True,
+                                          name=f"{self.thread_name_prefix}-{len(self.workers)}")
+                worker.start()
+                self.workers.append(worker)
+            queue = self.queues.get(task_id)
+            if queue is None:
+                queue = self.queues[task_id] = deque()
+                self.served[task_id] = max(self.served.get(task_id, 0.0), self.virtual_time)
+            queue.append((future, fn, args, kwargs, max(1, cost), time.monotonic()))
+            self.condition.notify()
+        return future
+    
+    def _next(self):
+        task_id = min(self.queues, key=lambda task: (self.served[task], len(self.queues[task])))
+        queue = self.queues[task_id]
+        item = queue.popleft()
+        if not queue:
+            del self.queues[task_id]
+        self.virtual_time = self.served[task_id]
+        self.served[task_id] += item[4]
+        return task_id, item
+    
+    def _worker_loop(self):
+        while True:
+            with self.condition:
+                while not self.queues:
+                    self.condition.wait()
+                task_id, (future, fn, args, kwargs, _, submitted) = self._next()
+            if not future.set_running_or_notify_cancel():
+                continue
+            started = time.monotonic()
+            result = error = None
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                error = e
+            # Registrar la latencia antes de entregar el resultado: la tarea la lee al terminar
+            with self.condition:
+                self.recent_waits.append(started - submitted)
+                self.latencies.setdefault(task_id, []).append(time.monotonic() - submitted)
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
     
-    # Eliminar registros
-    cursor.execute('DELETE FROM text_chunks WHERE created_at < ?', (max_age,))
-    conn.commit()
-    conn.close()
+    def finish_task(self, task_id):
+        """Olvida una tarea terminada y devuelve los percentiles de latencia de sus fragmentos (s)."""
+        with self.condition:
+            self.served.pop(task_id, None)
+            self.queues.pop(task_id, None)
+            return percentiles(self.latencies.pop(task_id, []))
+    
+    def stats(self):
+        with self.condition:
+            return {
+                "workers": self.max_workers,
+                "tasks": len(self.queues),
+                "queued": sum(len(queue) for queue in self.queues.values()),
+                "chunk_wait": percentiles(list(self.recent_waits))
+            }
+
+# Hilos compartidos para la síntesis de voz: el número total de hilos que llaman a gTTS queda
+# limitado a MAX_WORKERS sin importar cuántos documentos haya en proceso, y se reparten entre ellos
+chunk_scheduler = FairChunkScheduler()
+
+class TTSError(Exception):
+    """Se lanza cuando la síntesis de voz falla después de agotar los reintentos, o con un error que no se reintenta."""
+    pass
+
+class TTSBackend:
+    """Interfaz para los motores de síntesis de voz."""
+    name = "base"
+    
+    def synthesize(self, text, lang, output_filename):
+        """Convierte el texto a voz y guarda el MP3 en output_filename."""
+        raise NotImplementedError
+    
+    def is_transient(self, error):
+        """True si el error puede desaparecer al reintentar (red, servicio saturado)."""
+        return isinstance(error, (ConnectionError, TimeoutError))
+
+class GTTSBackend(TTSBackend):
+    """Motor basado en Google Text-to-Speech (requiere conexión a internet)."""
+    name = "gtts"
+    
+    def synthesize(self, text, lang, output_filename):
+        tts = gTTS(text=text, lang=lang, slow=False)
+        tts.save(output_filename)
+    
+    def is_transient(self, error):
+        if isinstance(error, gTTSError):
+            # Sin respuesta (fallo de red), límite de peticiones (429) o error del servicio (5xx);
+            # un idioma no admitido o un texto vacío fallan siempre (ValueError, AssertionError)
+            status = getattr(error.rsp, "status_code", None)
+            return status is None or status == 429 or status >= 500
+        return super().is_transient(error)
+
+# Cabecera de un frame MP3 (MPEG-2 Layer III, 32kbps, 24kHz, mono), el mismo formato que devuelve gTTS
+SILENT_MP3_FRAME = b'\xff\xf3\x44\xc0' + b'\x00' * 92
+SILENT_MP3_FRAME_DURATION = 576 / 24000  # segundos por frame
+
+class StubTTSBackend(TTSBackend):
+    """
+    Motor local sin red para pruebas y benchmarks.
+    Genera un MP3 silencioso con una duración proporcional al texto y simula la latencia del servicio.
+    """
+    name = "stub"
+    
+    def __init__(self, latency=0.0, per_char_latency=0.0, fail_rate=0.0, chars_per_second=15):
+        self.latency = latency
+        self.per_char_latency = per_char_latency
+        self.fail_rate = fail_rate
+        self.chars_per_second = chars_per_second
+        self.calls = 0
+        self.lock = threading.Lock()
+    
+    def synthesize(self, text, lang, output_filename):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.latency + self.per_char_latency * len(text))
+        if self.fail_rate and random.random() < self.fail_rate:
+            raise ConnectionError("Fallo simulado del motor stub")
+        
+        duration = len(text) / self.chars_per_second
+        num_frames = max(1, int(duration / SILENT_MP3_FRAME_DURATION))
+        with open(output_filename, 'wb') as f:
+            f.write(SILENT_MP3_FRAME * num_frames)
+
+def create_tts_backend(name):
+    """Crea el motor de síntesis a partir de su nombre."""
+    backends = {
+        "gtts": GTTSBackend,
+        "stub": StubTTSBackend
+    }
+    if name not in backends:
+        raise ValueError(f"Motor de síntesis desconocido: {name}")
+    return backends[name]()
+
+class TokenBucket:
+    """Limitador de velocidad de tipo token bucket, seguro entre hilos."""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Bloquea hasta que haya un token disponible y lo consume."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class TTSDispatcher:
+    """
+    Capa única de envío al motor de voz para todo el proceso.
+    Aplica el limitador de velocidad, limita las peticiones simultáneas y reintenta con espera exponencial.
+    """
+    def __init__(self, backend, rate=TTS_RATE_LIMIT, burst=TTS_BURST, max_in_flight=TTS_MAX_IN_FLIGHT,
+                 max_retries=TTS_MAX_RETRIES, backoff_base=TTS_BACKOFF_BASE, backoff_max=TTS_BACKOFF_MAX):
+        self.backend = backend
+        self.rate_limiter = TokenBucket(rate, burst)
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.stats_lock = threading.Lock()
+        self.counters = {"requests": 0, "retries": 0, "failures": 0}
+    
+    def _count(self, name):
+        with self.stats_lock:
+            self.counters[name] += 1
+    
+    def synthesize(self, text, lang, output_filename):
+        """
+        Sintetiza el texto; lanza TTSError si todos los intentos fallan. Solo se reintentan los
+        errores transitorios según el motor; los demás fallan al primer intento.
+        """
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                self._count("retries")
+                # Espera exponencial con jitter para no sincronizar los reintentos de todos los hilos
+                delay = min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1)))
+                time.sleep(delay * random.uniform(0.5, 1.0))
+            
+            self.rate_limiter.acquire()
+            with self.in_flight:
+                self._count("requests")
+                try:
+                    self.backend.synthesize(text, lang, output_filename)
+                    if os.path.exists(output_filename) and os.path.getsize(output_filename) > 0:
+                        return
+                    last_error = TTSError("El motor de voz devolvió un audio vacío")
+                except Exception as e:
+                    last_error = e
+                    if not self.backend.is_transient(e):
+                        self._count("failures")
+                        cleanup_temp_files([output_filename])
+                        raise TTSError(f"El motor de voz rechazó el fragmento: {type(e).__name__}: {str(e)}") from e
+            print(f"Intento {attempt + 1} de síntesis fallido ({self.backend.name}): {str(last_error)}")
+        
+        self._count("failures")
+        cleanup_temp_files([output_filename])
+        raise TTSError(f"No se pudo sintetizar el fragmento tras {self.max_retries + 1} intentos: {str(last_error)}")
+    
+    def stats(self):
+        with self.stats_lock:
+            return dict(self.counters, backend=self.backend.name)
+
+# Capa de síntesis compartida por todas las tareas
+tts_dispatcher = TTSDispatcher(create_tts_backend(TTS_BACKEND))
+
+def set_tts_backend(backend):
+    """Cambia el motor de síntesis en uso (por ejemplo, StubTTSBackend en benchmarks)."""
+    tts_dispatcher.backend = backend
+
+class SingleFlight:
+    """
+    Agrupa las llamadas simultáneas con la misma clave: la primera ejecuta la función y las
+    demás esperan su resultado (o su excepción) en lugar de repetir el trabajo.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # clave -> Future de la llamada en curso
+        self.counters = {"leaders": 0, "shared": 0}
+    
+    def do(self, key, func, *args):
+        """Devuelve (resultado, compartido); compartido es True si otra llamada hizo el trabajo."""
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                self.calls[key] = future
+                self.counters["leaders"] += 1
+            else:
+                self.counters["shared"] += 1
+        if not leader:
+            return future.result(), True
+        try:
+            result = func(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self.lock:
+                del self.calls[key]
+    
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, in_flight=len(self.calls))
+
+# Síntesis en curso por clave de fragmento (idioma + texto), compartida por todas las tareas
+synthesis_flight = SingleFlight()
+
+def synthesize_to_store(text, lang, synth_filename, signature=None):
+    """
+    Sintetiza un fragmento y lo guarda en el almacén de caché; devuelve su ruta, o None si el
+    fragmento no tiene texto. Se ejecuta una sola vez por clave a la vez (synthesis_flight).
+    signature es la firma MinHash del texto si ya se calculó.
+    """
+    # Otra tarea pudo terminar el mismo fragmento entre la búsqueda del lote y este momento
+    cached_path = get_cached_audio_path(chunk_cache_key(text, lang))
+    if cached_path and os.path.exists(cached_path):
+        return cached_path
+    text_to_speech_optimized(text, synth_filename, lang=lang)
+    if os.path.getsize(synth_filename) == 0:
+        cleanup_temp_files([synth_filename])
+        return None
+    return store_in_cache(text, lang, synth_filename, signature)
 
 @app.get("/", response_class=HTMLResponse)
 def read_root():
@@ -157,6 +1778,16 @@ def health_check():
     return {
         "status": "OK",
         "timestamp": time.time(),
+        "jobs": job_scheduler.stats(),
+        "chunk_scheduler": chunk_scheduler.stats(),
+        "tts": tts_dispatcher.stats(),
+        "synthesis_flight": synthesis_flight.stats(),
+        "cache": dict(get_cache_hit_rate(), **cache_manager.stats()),
+        "memory_cache": memory_cache.stats(),
+        "similarity_index": similarity_index.stats(),
+        "parser_pool": parser_pool.stats(),
+        "task_store": TASK_STORE,
+        "server_workers": SERVER_WORKERS,
         "dirs": {
             "templates": os.path.exists("templates"),
             "static": os.path.exists("static"),
@@ -189,75 +1820,97 @@ async def convert_file_to_audio(file: UploadFile = File(...), lang: str = "es"):
         # Generar IDs únicos para los archivos
         task_id = str(uuid.uuid4().hex)
         temp_filename = f"temp/temp_{task_id}.{file_ext}"
-        mp3_filename = f"audio/{task_id}.mp3"
-        
-        # Guardar el archivo subido
-        file_content = await file.read()
-        file_size = len(file_content)
-        
-        # Verificar tamaño máximo (50MB)
-        if file_size > 50 * 1024 * 1024:
-            return JSONResponse(content={"error": "El archivo excede el tamaño máximo permitido de 50MB"}, status_code=400)
-        
-        with open(temp_filename, "wb") as buffer:
-            buffer.write(file_content)
         
-        # Estimar tiempo basado en el tamaño del archivo (ahora más optimista)
-        estimated_time = estimate_processing_time(file_size, file_ext)
+        # Verificar tamaño máximo (50MB) antes de copiar, si el tamaño ya es conocido
+        if file.size is not None and file.size > MAX_UPLOAD_SIZE:
+            return JSONResponse(content={"error": "El archivo excede el tamaño máximo permitido de 50MB"}, status_code=413)
         
-        # Inicializar el estado de la tarea
-        task_status[task_id] = {
-            "status": "processing",
-            "progress": 0,
-            "estimated_time": estimated_time,
-            "start_time": time.time(),
-            "file_size": file_size
-        }
-        
-        # Iniciar el procesamiento en un hilo separado    
-        thread = threading.Thread(
-        target=process_file_thread,
-        args=(task_id, temp_filename, file_ext, mp3_filename, lang)
-        )
-        thread.daemon = True
-        thread.start()
-    
-        return JSONResponse(content={
-            "task_id": task_id,
-            "estimated_time": estimated_time,
-            "file_size": file_size
-        })
+        # Guardar el archivo subido por bloques, sin cargarlo completo en memoria
+        try:
+            file_size, file_hash = await save_upload_streaming(file, temp_filename)
+        except UploadTooLargeError:
+            return JSONResponse(content={"error": "El archivo excede el tamaño máximo permitido de 50MB"}, status_code=413)
         
+        # El almacén de tareas (SQLite o Redis) bloquea: registrar y encolar fuera del bucle de eventos
+        return await run_in_threadpool(enqueue_upload, task_id, temp_filename, file_ext, file_size, file_hash, lang)
     except Exception as e:
         print(f"Error al procesar la solicitud de conversión: {str(e)}")
         traceback.print_exc()
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
-@app.get("/task/{task_id}")
-async def get_task_status(task_id: str):
-    """Obtener el estado actual de una tarea de procesamiento."""
-    if task_id not in task_status:
-        return JSONResponse(content={"error": "Tarea no encontrada"}, status_code=404)
+def enqueue_upload(task_id, temp_filename, file_ext, file_size, file_hash, lang):
+    """Registra la tarea de un archivo ya guardado y la encola, salvo que sea un documento duplicado."""
+    # Estimar tiempo basado en el tamaño del archivo (ahora más optimista)
+    estimated_time = estimate_processing_time(file_size, file_ext)
+    
+    # Inicializar el estado de la tarea
+    task_store.create(task_id, {
+        "status": "queued",
+        "progress": 0,
+        "estimated_time": estimated_time,
+        "start_time": time.time(),
+        "file_size": file_size,
+        "file_hash": file_hash,
+        "file_path": temp_filename,
+        "file_ext": file_ext,
+        "lang": lang,
+        "owner": WORKER_ID
+    })
     
-    status_info = task_status[task_id].copy()
+    # Mismo documento y mismo idioma ya convertido o en curso: no convertirlo otra vez
+    duplicate_id = resolve_duplicate_upload(task_id, file_hash, lang)
+    if duplicate_id is not None:
+        cleanup_temp_files([temp_filename])
+        if duplicate_id != task_id:
+            task_store.delete(task_id)
+        print(f"Documento duplicado: la subida {task_id} se atiende con la tarea {duplicate_id}")
+        return JSONResponse(content={
+            "task_id": duplicate_id,
+            "estimated_time": estimated_time,
+            "file_size": file_size,
+            "queue_position": job_scheduler.position(duplicate_id),
+            "deduplicated": True
+        })
+    
+    # Encolar el procesamiento en el planificador global
+    try:
+        queue_position = job_scheduler.submit(
+            task_id, process_file_thread, task_id, temp_filename, file_ext, lang, estimated_time=estimated_time
+        )
+    except JobQueueFullError as e:
+        task_store.release_document(document_key(file_hash, lang), task_id)
+        task_store.delete(task_id)
+        cleanup_temp_files([temp_filename])
+        return JSONResponse(
+            content={"error": "El servidor está ocupado. Inténtalo de nuevo más tarde."},
+            status_code=503,
+            headers={"Retry-After": str(e.retry_after)}
+        )
+
+    return JSONResponse(content={
+        "task_id": task_id,
+        "estimated_time": estimated_time,
+        "file_size": file_size,
+        "queue_position": queue_position
+    })
+
+def task_status_snapshot(task_id):
+    """Estado de una tarea para los clientes (sin el texto, que se entrega en /text). None si no existe."""
+    status_info = task_store.get(task_id)
+    if status_info is None:
+        return None
+    status_info.pop("file_path", None)  # Ruta interna del archivo subido
+    
+    # Si la tarea sigue en cola, informar de su posición (solo la conoce el proceso que la encoló)
+    if status_info["status"] == "queued" and status_info.get("owner") == WORKER_ID:
+        position = job_scheduler.position(task_id)
+        status_info["queue_position"] = position
+        status_info["estimated_wait"] = job_scheduler.estimate_wait(position)
     
     # Si la tarea está completa, devolver también las URLs
     if status_info["status"] == "completed":
-        status_info["audio_url"] = f"/audio/{task_id}.mp3"
-        
-        # Limpiar el estado después de completado y reportado
-        if "text" in status_info:
-            text = status_info["text"]
-            del status_info["text"]  # No enviar todo el texto en cada consulta de estado
-        else:
-            # Si el texto ya fue eliminado, leer el archivo de texto
-            try:
-                with open(f"temp/text_{task_id}.txt", "r", encoding="utf-8") as f:
-                    text = f.read()
-            except:
-                text = "El texto extraído no está disponible"
-                
-        status_info["text"] = text
+        status_info["audio_url"] = f"/listen/{task_id}.mp3"
+        status_info["text_url"] = f"/text/{task_id}"
     
     # Actualizar el tiempo transcurrido
     if status_info["status"] == "processing":
@@ -269,8 +1922,366 @@ async def get_task_status(task_id: str):
             remaining = (elapsed / status_info["progress"]) * (100 - status_info["progress"])
             status_info["remaining_time"] = remaining
     
+    return status_info
+
+@app.get("/task/{task_id}")
+def get_task_status(task_id: str):
+    """Obtener el estado actual de una tarea de procesamiento."""
+    status_info = task_status_snapshot(task_id)
+    if status_info is None:
+        return JSONResponse(content={"error": "Tarea no encontrada"}, status_code=404)
     return JSONResponse(content=status_info)
 
+@app.post("/task/{task_id}/retry")
+def retry_task(task_id: str):
+    """Reintenta una tarea fallida: se reanuda desde su manifiesto y solo se sintetizan los fragmentos que faltan."""
+    task = task_store.get(task_id)
+    if task is None:
+        return JSONResponse(content={"error": "Tarea no encontrada"}, status_code=404)
+    if task["status"] != "error" or not task.get("retryable"):
+        return JSONResponse(content={"error": "La tarea no se puede reintentar"}, status_code=409)
+    if not resubmit_task(task_id, task, "status", "error"):
+        return JSONResponse(content={"error": "No se pudo reintentar la tarea. Vuelve a subir el archivo."}, status_code=409)
+    return JSONResponse(content=task_status_snapshot(task_id))
+
+@app.get("/events/{task_id}")
+def get_task_events(task_id: str):
+    """
+    Canal Server-Sent Events con el estado de una tarea: se envía un evento cada vez que
+    el trabajo lo actualiza y la conexión se cierra cuando la tarea termina.
+    """
+    if task_id not in task_store:
+        return JSONResponse(content={"error": "Tarea no encontrada"}, status_code=404)
+    return StreamingResponse(
+        iter_task_events(task_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def iter_task_events(task_id):
+    """Genera un evento SSE por cada cambio de estado de la tarea, hasta que termina o falla."""
+    last_version = None
+    last_sent = 0.0
+    while True:
+        # Leer la versión antes del estado para no perder una actualización intermedia
+        local_version = task_events.version(task_id)
+        status_info = await run_in_threadpool(task_status_snapshot, task_id)
+        if status_info is None:
+            yield f"data: {json.dumps({'error': 'Tarea no encontrada'})}\n\n"
+            return
+        now = time.time()
+        if status_info["version"] != last_version or now - last_sent >= EVENTS_REFRESH_INTERVAL:
+            yield f"data: {json.dumps(status_info)}\n\n"
+            last_version = status_info["version"]
+            last_sent = now
+        if status_info["status"] in TERMINAL_STATUSES:
+            return
+        
+        # Los avisos llegan solo desde este proceso, que recibe así todos los cambios de sus tareas;
+        # la de otro worker o réplica (almacén compartido) se consulta cada EVENTS_STORE_POLL_INTERVAL
+        remote = task_store.shared and status_info.get("owner") != WORKER_ID
+        timeout = EVENTS_STORE_POLL_INTERVAL if remote else EVENTS_REFRESH_INTERVAL
+        await task_events.wait(task_id, local_version, timeout)
+        # Agrupar las actualizaciones muy seguidas (progreso de cada fragmento) en un solo evento
+        await asyncio.sleep(EVENTS_MIN_INTERVAL)
+
+@app.get("/text/{task_id}")
+def get_task_text(task_id: str, request: Request, page: int = None, chunk: int = None,
+                 start: int = None, end: int = None):
+    """
+    Texto extraído de una tarea, leído del disco con mmap. Se puede pedir una página (page,
+    desde 1), un fragmento (chunk, desde 0, el mismo índice que el audio), un rango de
+    caracteres (start/end) o un rango de bytes con la cabecera Range. Admite ETag y gzip/br.
+    """
+    if not task_id.isalnum():
+        return JSONResponse(content={"error": "Tarea no encontrada"}, status_code=404)
+    try:
+        index = load_text_index(task_id)
+    except FileNotFoundError:
+        return JSONResponse(content={"error": "El texto extraído no está disponible"}, status_code=404)
+    
+    text_filename, chunks_filename, _ = text_store_paths(task_id)
+    if sum(selector is not None for selector in (page, chunk, start if start is not None else end)) > 1:
+        return JSONResponse(content={"error": "Usa solo uno de page, chunk o start/end"}, status_code=400)
+    
+    path = text_filename
+    if page is not None:
+        if not 1 <= page <= len(index["pages"]):
+            return JSONResponse(content={"error": "Página fuera de rango"}, status_code=404)
+        first, last = index["pages"][page - 1]
+    elif chunk is not None:
+        if not 0 <= chunk < len(index["chunks"]):
+            return JSONResponse(content={"error": "Fragmento fuera de rango"}, status_code=404)
+        path = chunks_filename
+        first, last = index["chunks"][chunk]
+    elif start is not None or end is not None:
+        first_char = min(max(start or 0, 0), index["chars"])
+        last_char = min(max(end if end is not None else index["chars"], first_char), index["chars"])
+        first = char_to_byte(text_filename, index, first_char)
+        last = char_to_byte(text_filename, index, last_char)
+    else:
+        first, last = 0, index["size"]
+    
+    headers = {"Accept-Ranges": "bytes", "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+    range_header = request.headers.get("range")
+    try:
+        byte_range = parse_byte_range(range_header, last - first)
+    except ValueError:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{last - first}"})
+    
+    # Los rangos de bytes se refieren siempre al texto sin comprimir
+    encoding = None
+    if byte_range is None and last - first >= TEXT_COMPRESS_MIN_BYTES:
+        encoding = choose_text_encoding(request.headers.get("accept-encoding", ""))
+    
+    source = "c" if path == chunks_filename else "t"
+    etag = f'"{index["etag"]}-{source}{first:x}-{last:x}{"-" + encoding if encoding else ""}"'
+    headers["ETag"] = etag
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    
+    media_type = "text/plain; charset=utf-8"
+    if byte_range:
+        range_start, range_end = byte_range
+        headers["Content-Range"] = f"bytes {range_start}-{range_end - 1}/{last - first}"
+        headers["Content-Length"] = str(range_end - range_start)
+        return StreamingResponse(iter_file_bytes(path, first + range_start, first + range_end),
+                                 status_code=206, headers=headers, media_type=media_type)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+        return StreamingResponse(iter_compressed(iter_file_bytes(path, first, last), encoding),
+                                 headers=headers, media_type=media_type)
+    headers["Content-Length"] = str(last - first)
+    return StreamingResponse(iter_file_bytes(path, first, last), headers=headers, media_type=media_type)
+
+def text_store_paths(task_id):
+    """Rutas del texto extraído, del texto de cada fragmento y del índice de ambos."""
+    return f"temp/text_{task_id}.txt", f"temp/chunks_{task_id}.txt", f"temp/text_{task_id}.json"
+
+def remove_task_text(task_id):
+    cleanup_temp_files(list(text_store_paths(task_id)))
+
+class TextIndexWriter:
+    """
+    Escribe el texto extraído en disco (UTF-8) registrando los rangos de bytes de cada página
+    y de cada fragmento, y puntos de control carácter -> byte para servir rangos de caracteres.
+    """
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.text_filename, self.chunks_filename, self.index_filename = text_store_paths(task_id)
+        self.text_file = open(self.text_filename, "wb")
+        self.chunks_file = open(self.chunks_filename, "wb")
+        self.chars = 0
+        self.size = 0
+        self.chunks_size = 0
+        self.pages = []
+        self.chunks = []
+        self.checkpoints = [[0, 0]]
+        self.text_hash = hashlib.sha256()
+    
+    def write_page(self, text):
+        page_start = self.size
+        for i in range(0, len(text), TEXT_CHECKPOINT_CHARS):
+            part = text[i:i + TEXT_CHECKPOINT_CHARS]
+            data = part.encode("utf-8")
+            self.text_file.write(data)
+            self.text_hash.update(data)
+            self.chars += len(part)
+            self.size += len(data)
+            self.checkpoints.append([self.chars, self.size])
+        self.pages.append([page_start, self.size])
+    
+    def write_chunk(self, chunk):
+        """Escribe el texto de un fragmento y devuelve su rango de bytes en el archivo de fragmentos."""
+        data = chunk.encode("utf-8")
+        self.chunks_file.write(data)
+        self.chunks.append([self.chunks_size, self.chunks_size + len(data)])
+        self.chunks_size += len(data)
+        return self.chunks[-1]
+    
+    def close(self):
+        self.text_file.close()
+        self.chunks_file.close()
+    
+    def finish(self):
+        """Cierra los archivos y publica el índice (escritura atómica)."""
+        self.close()
+        stat = os.stat(self.text_filename)
+        index = {
+            "size": self.size,
+            "chars": self.chars,
+            "pages": self.pages,
+            "chunks": self.chunks,
+            "checkpoints": self.checkpoints,
+            "etag": f"{stat.st_mtime_ns:x}-{self.size:x}"
+        }
+        with open(f"{self.index_filename}.tmp", "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(f"{self.index_filename}.tmp", self.index_filename)
+
+def load_text_index(task_id):
+    with open(text_store_paths(task_id)[2], encoding="utf-8") as f:
+        return json.load(f)
+
+def char_to_byte(text_filename, index, char_pos):
+    """Convierte una posición en caracteres en un desplazamiento en bytes del texto UTF-8."""
+    checkpoints = index["checkpoints"]
+    idx = bisect.bisect_right([chars for chars, _ in checkpoints], char_pos) - 1
+    chars, byte_pos = checkpoints[idx]
+    if chars == char_pos:
+        return byte_pos
+    # Decodificar solo el tramo entre dos puntos de control (como mucho TEXT_CHECKPOINT_CHARS)
+    next_byte = checkpoints[idx + 1][1] if idx + 1 < len(checkpoints) else index["size"]
+    with open(text_filename, "rb") as f:
+        f.seek(byte_pos)
+        text = f.read(next_byte - byte_pos).decode("utf-8")
+    return byte_pos + len(text[:char_pos - chars].encode("utf-8"))
+
+def iter_file_bytes(path, start, end):
+    """Genera los bytes [start, end) de un archivo por bloques a través de mmap."""
+    if end <= start:
+        return
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for position in range(start, end, STREAM_BLOCK_SIZE):
+            yield data[position:min(position + STREAM_BLOCK_SIZE, end)]
+
+def choose_text_encoding(accept_encoding):
+    """Elige br (si está instalado brotli) o gzip según la cabecera Accept-Encoding."""
+    accepted = set()
+    for token in accept_encoding.lower().split(","):
+        name, _, params = token.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(name.strip())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+def iter_compressed(blocks, encoding):
+    """Comprime al vuelo una secuencia de bloques, sin cargar el texto completo en memoria."""
+    compressor = brotli.Compressor() if encoding == "br" else zlib.compressobj(6, zlib.DEFLATED, 31)
+    for block in blocks:
+        data = compressor.process(block) if encoding == "br" else compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.finish() if encoding == "br" else compressor.flush()
+
+@app.get("/stream/{task_id}")
+def stream_task_audio(task_id: str):
+    """
+    Sirve el audio de una tarea mientras se procesa, con transferencia por bloques.
+    Entrega en orden los fragmentos ya terminados y espera a los siguientes, de modo que
+    se puede empezar a escuchar antes de que termine la conversión.
+    """
+    if task_id not in task_store:
+        return JSONResponse(content={"error": "Tarea no encontrada"}, status_code=404)
+    return StreamingResponse(
+        iter_task_audio(task_id),
+        media_type="audio/mpeg",
+        headers={"Cache-Control": "no-cache"}
+    )
+
+def read_segment_frames(chunk_path):
+    """Solo los frames de audio de un fragmento, igual que en el archivo virtual."""
+    segment = scan_mp3_segment(chunk_path)
+    if not segment:
+        return b""
+    with open(chunk_path, "rb") as f:
+        f.seek(segment["start"])
+        return f.read(segment["end"] - segment["start"])
+
+async def iter_task_audio(task_id):
+    """Genera los bytes del audio de una tarea a medida que sus fragmentos están listos."""
+    next_segment = 0
+    bytes_sent = 0
+    while True:
+        status = await run_in_threadpool(task_store.get, task_id)
+        if status is None or status["status"] == "error":
+            return
+        
+        if status["status"] == "completed":
+            # Enviar el resto desde el archivo virtual, que contiene los mismos frames en el
+            # mismo orden precedidos por su cabecera Info/Xing
+            manifest = await run_in_threadpool(load_audio_manifest, task_id)
+            blocks = iter_manifest_bytes(manifest, manifest["header_bytes"] + bytes_sent, manifest["size"])
+            async for block in iterate_in_threadpool(blocks):
+                yield block
+            return
+        
+        if next_segment < status.get("segments_ready", 0):
+            try:
+                data = await run_in_threadpool(read_segment_frames, segment_path(task_id, next_segment))
+            except FileNotFoundError:
+                # La tarea ha fallado y se están borrando sus fragmentos
+                await asyncio.sleep(STREAM_POLL_INTERVAL)
+                continue
+            next_segment += 1
+            bytes_sent += len(data)
+            if data:
+                yield data
+            continue
+        
+        await asyncio.sleep(STREAM_POLL_INTERVAL)
+
+@app.api_route("/listen/{task_id}.mp3", methods=["GET", "HEAD"])
+def listen_task_audio(task_id: str, request: Request):
+    """
+    Sirve el MP3 de una tarea terminada a partir de su manifiesto, sin un archivo final:
+    los rangos pedidos (cabecera Range) se traducen a los segmentos correspondientes.
+    """
+    if not task_id.isalnum():
+        return JSONResponse(content={"error": "Tarea no encontrada"}, status_code=404)
+    try:
+        manifest = load_audio_manifest(task_id)
+    except FileNotFoundError:
+        return JSONResponse(content={"error": "Audio no disponible"}, status_code=404)
+    
+    size = manifest["size"]
+    headers = {"Accept-Ranges": "bytes"}
+    try:
+        byte_range = parse_byte_range(request.headers.get("range"), size)
+    except ValueError:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    
+    start, end = byte_range or (0, size)
+    status_code = 206 if byte_range else 200
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+    headers["Content-Length"] = str(end - start)
+    if request.method == "HEAD":
+        return Response(status_code=status_code, headers=headers, media_type="audio/mpeg")
+    return StreamingResponse(
+        iter_manifest_bytes(manifest, start, end),
+        status_code=status_code,
+        headers=headers,
+        media_type="audio/mpeg"
+    )
+
+def parse_byte_range(range_header, size):
+    """
+    Interpreta una cabecera Range de un solo intervalo ("bytes=a-b", "bytes=a-" o "bytes=-n").
+    Devuelve (inicio, fin exclusivo), None si hay que servir el archivo completo, o lanza
+    ValueError si el rango no se puede satisfacer.
+    """
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    first, _, last = range_header[len("bytes="):].strip().partition("-")
+    if not (first or last) or not (first.isdigit() or not first) or not (last.isdigit() or not last):
+        return None
+    
+    if not first:
+        suffix = int(last)
+        if suffix == 0 or size == 0:
+            raise ValueError("Rango vacío")
+        return max(0, size - suffix), size
+    start = int(first)
+    end = min(int(last) + 1, size) if last else size
+    if start >= size or start >= end:
+        raise ValueError("Rango fuera del archivo")
+    return start, end
+
 def estimate_processing_time(file_size, file_ext):
     """Estima el tiempo de procesamiento basado en el tamaño del archivo."""
     # Tiempo base más bajo gracias a la optimización
@@ -289,69 +2300,354 @@ def estimate_processing_time(file_size, file_ext):
     # La estimación ahora considera que el procesamiento es paralelo
     estimated_time = base_time + (size_mb * factor / NUM_CORES)
     
-    # Añadir factor para archivos muy grandes (pero menor que antes)
-    if size_mb > 20:
-        estimated_time *= 1.1
+    # Añadir factor para archivos muy grandes (pero menor que antes)
+    if size_mb > 20:
+        estimated_time *= 1.1
+    
+    return math.ceil(estimated_time)
+
+class ChunkSimilarityIndex:
+    """
+    Índice de fragmentos casi iguales por idioma: firma MinHash de los tríos de palabras de
+    cada fragmento y LSH por bandas, de modo que una búsqueda solo compara con los candidatos
+    que comparten alguna banda. La firma usa un solo hash por trío repartido en num_perm
+    compartimentos (one permutation hashing, con densificación de los vacíos), en lugar de
+    num_perm permutaciones. Las firmas se guardan con su entrada del caché (columna minhash),
+    se cargan al arrancar y se olvidan con ella. En memoria se conservan como mucho
+    max_entries firmas (LRU).
+    """
+    def __init__(self, num_perm=SIMILARITY_NUM_PERM, bands=SIMILARITY_BANDS,
+                 shingle_words=SIMILARITY_SHINGLE_WORDS, max_entries=SIMILARITY_MAX_ENTRIES):
+        if num_perm % bands:
+            raise ValueError("El número de permutaciones debe ser múltiplo del de bandas")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_words = shingle_words
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # clave -> (idioma, firma)
+        self.buckets = {}  # (idioma, banda, hash de la banda) -> [claves]
+        self.lookups = 0
+        self.matched = 0  # búsquedas que encontraron algún fragmento casi igual
+    
+    def signature(self, text):
+        """Firma MinHash del texto (array de enteros), o None si no tiene palabras."""
+        words = text.lower().split()
+        if not words:
+            return None
+        size = min(self.shingle_words, len(words))
+        bins = [None] * self.num_perm
+        for i in range(len(words) - size + 1):
+            # Hash estable (no depende del proceso): las firmas guardadas siguen valiendo tras un reinicio
+            h = int.from_bytes(hashlib.blake2b(" ".join(words[i:i + size]).encode("utf-8"), digest_size=8).digest(), "little")
+            slot, value = h % self.num_perm, (h // self.num_perm) & 0xFFFFFFFF
+            if bins[slot] is None or value < bins[slot]:
+                bins[slot] = value
+        # Densificación: un compartimento vacío toma el valor del siguiente ocupado, desplazado según la distancia
+        for slot in range(self.num_perm):
+            if bins[slot] is None:
+                distance = 1
+                while bins[(slot + distance) % self.num_perm] is None:
+                    distance += 1
+                bins[slot] = (bins[(slot + distance) % self.num_perm] + distance * 0x9E3779B1) & 0xFFFFFFFF
+        return array.array("I", bins)
+    
+    def _band_keys(self, lang, signature):
+        data = signature.tobytes()
+        width = self.rows * signature.itemsize
+        return [(lang, band, hash(data[band * width:(band + 1) * width])) for band in range(self.bands)]
+    
+    def add(self, cache_key, lang, signature):
+        if signature is None:
+            return
+        with self.lock:
+            if cache_key in self.entries:
+                self.entries.move_to_end(cache_key)
+                return
+            self.entries[cache_key] = (lang, signature)
+            for band_key in self._band_keys(lang, signature):
+                self.buckets.setdefault(band_key, []).append(cache_key)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+    
+    def _remove(self, cache_key):
+        lang, signature = self.entries.pop(cache_key)
+        for band_key in self._band_keys(lang, signature):
+            bucket = self.buckets.get(band_key)
+            if bucket is not None:
+                bucket.remove(cache_key)
+                if not bucket:
+                    del self.buckets[band_key]
+    
+    def discard_many(self, cache_keys):
+        with self.lock:
+            for cache_key in cache_keys:
+                if cache_key in self.entries:
+                    self._remove(cache_key)
+    
+    def find_similar(self, signature, lang, threshold=SIMILARITY_THRESHOLD):
+        """Fragmentos del mismo idioma con similitud estimada >= threshold: [(clave, similitud)], de mayor a menor."""
+        if signature is None:
+            return []
+        with self.lock:
+            candidates = set()
+            for band_key in self._band_keys(lang, signature):
+                candidates.update(self.buckets.get(band_key, ()))
+            matches = []
+            for cache_key in candidates:
+                other = self.entries[cache_key][1]
+                similarity = sum(1 for x, y in zip(signature, other) if x == y) / self.num_perm
+                if similarity >= threshold:
+                    matches.append((cache_key, similarity))
+                    self.entries.move_to_end(cache_key)
+            self.lookups += 1
+            self.matched += bool(matches)
+        return sorted(matches, key=lambda match: match[1], reverse=True)
+    
+    def load(self, repository):
+        """Carga las firmas guardadas y calcula las de las entradas de bases de datos anteriores."""
+        rows = repository.recent_signatures(self.max_entries)
+        # Las más antiguas primero, para que el orden LRU coincida con el último acceso
+        for cache_key, lang, blob in reversed(rows):
+            self.add(cache_key, lang, array.array("I", blob))
+        missing = repository.texts_without_signature(max(0, self.max_entries - len(rows)))
+        updates = []
+        for cache_key, lang, text in missing:
+            signature = self.signature(text)
+            if signature is not None:
+                self.add(cache_key, lang, signature)
+                updates.append((signature.tobytes(), cache_key))
+        if updates:
+            repository.set_signatures(updates)
+        return len(rows) + len(updates)
+    
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "buckets": len(self.buckets),
+                    "lookups": self.lookups, "near_duplicates": self.matched}
+
+# Índice de fragmentos casi iguales, compartido por todas las tareas
+similarity_index = ChunkSimilarityIndex()
+
+class ParseLimitError(Exception):
+    """La extracción de un documento superó su tiempo, su CPU o su memoria y se detuvo su proceso."""
+    pass
+
+class ParseCPULimitError(ParseLimitError):
+    """Un proceso de extracción agotó la CPU que había reservado para su tarea."""
+    pass
+
+class ParseBudget:
+    """
+    Límites de la extracción de un documento, compartidos por todas sus tareas: plazo y CPU restante.
+    Cada tarea reserva parte de la CPU antes de empezar y ese es el límite de su proceso; la suma
+    de las reservas de las tareas en curso nunca supera lo que le queda al documento.
+    """
+    def __init__(self, timeout=PARSE_TIMEOUT, cpu_seconds=PARSE_CPU_SECONDS):
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.deadline = time.monotonic() + timeout
+        self.cpu_left = cpu_seconds
+        self.reserved = 0.0
+        self.lock = threading.Lock()
+    
+    def remaining(self):
+        return self.deadline - time.monotonic()
+    
+    def reserve(self, share=1):
+        """Reserva 1/share de la CPU no reservada (share > 1 si hay tareas del documento en paralelo)."""
+        with self.lock:
+            cpu_seconds = max(0.0, self.cpu_left - self.reserved) / share
+            self.reserved += cpu_seconds
+            return cpu_seconds
+    
+    def charge(self, reserved, cpu_seconds):
+        """Libera una reserva y descuenta la CPU que usó de verdad la tarea."""
+        with self.lock:
+            self.reserved -= reserved
+            self.cpu_left -= cpu_seconds
+
+class ParserWorker:
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=parser_worker_main, args=(child_conn, PARSE_MAX_MEMORY), daemon=True)
+        self.process.start()
+        child_conn.close()
+    
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+class ParserPool:
+    """
+    Procesos para extraer el texto de los documentos fuera del proceso web: pdfminer y python-docx
+    consumen CPU con el GIL tomado y un documento patológico ralentizaría todas las peticiones.
+    Cada tarea se ejecuta con el plazo que le queda a su documento, con la parte de su CPU que
+    reserva (ParseBudget) y con la memoria limitada; si los supera, su proceso se mata, se sustituye
+    y se lanza ParseLimitError.
+    Se usa "spawn" porque el proceso web tiene muchos hilos activos y fork no es seguro con ellos;
+    las funciones que se ejecutan en los procesos están en parsers.py, así que estos no importan main.py
+    (ni abren sus bases de datos ni crean la aplicación) bajo su límite de memoria.
+    """
+    def __init__(self, size=PARSE_WORKERS):
+        self.size = size
+        self.context = multiprocessing.get_context("spawn")
+        self.available = threading.Semaphore(size)
+        self.idle = []
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="parser")
+        self.started = 0
+        self.killed = {"timeout": 0, "cpu": 0, "memory": 0, "crashed": 0, "abandoned": 0}
+    
+    def _acquire(self, budget):
+        if not self.available.acquire(timeout=max(0, budget.remaining())):
+            raise ParseLimitError(f"La extracción del documento superó el tiempo máximo ({budget.timeout} s)")
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+            self.started += 1
+        try:
+            return ParserWorker(self.context)
+        except Exception:
+            self.available.release()
+            raise
+    
+    def _release(self, worker, reason=None):
+        if reason:
+            worker.kill()
+        with self.lock:
+            if reason:
+                self.killed[reason] += 1
+            else:
+                self.idle.append(worker)
+        self.available.release()
+    
+    def iterate(self, budget, func, *args, share=1):
+        """
+        Ejecuta func(*args) en un proceso de extracción y genera sus elementos (o su resultado).
+        El proceso puede usar 1/share de la CPU que el documento no tiene ya reservada.
+        """
+        if budget.cpu_left <= 0:
+            raise ParseLimitError(f"La extracción del documento superó el límite de CPU ({budget.cpu_seconds} s)")
+        if budget.remaining() <= 0:
+            raise ParseLimitError(f"La extracción del documento superó el tiempo máximo ({budget.timeout} s)")
+        worker = self._acquire(budget)
+        reason = "abandoned"  # Si el consumidor deja de leer, el proceso sigue enviando: se detiene
+        cpu_reserved = budget.reserve(share)
+        cpu_used = cpu_reserved  # Si el proceso se detiene sin informar, se cuenta toda la reserva
+        try:
+            if cpu_reserved <= 0:
+                reason = None
+                raise ParseLimitError(f"La extracción del documento superó el límite de CPU ({budget.cpu_seconds} s)")
+            worker.conn.send((func, args, cpu_reserved))
+            while True:
+                if not worker.conn.poll(max(0, budget.remaining())):
+                    reason = "timeout"
+                    raise ParseLimitError(f"La extracción del documento superó el tiempo máximo ({budget.timeout} s)")
+                try:
+                    kind, value, *reported_cpu = worker.conn.recv()
+                except EOFError:
+                    worker.process.join(1)
+                    if hasattr(signal, "SIGPROF") and worker.process.exitcode == -signal.SIGPROF:
+                        reason = "cpu"
+                        raise ParseCPULimitError(f"La extracción del documento superó el límite de CPU ({budget.cpu_seconds} s)")
+                    reason = "crashed"
+                    raise ParseLimitError(f"El proceso de extracción terminó inesperadamente (código {worker.process.exitcode})")
+                if kind == "item":
+                    yield value
+                    continue
+                cpu_used = reported_cpu[0]
+                if kind == "memory":
+                    reason = "memory"
+                    raise ParseLimitError(f"La extracción del documento superó el límite de memoria ({PARSE_MAX_MEMORY // (1024 * 1024)} MB)")
+                reason = None
+                if kind == "error":
+                    raise RuntimeError(value)
+                return
+        finally:
+            budget.charge(cpu_reserved, cpu_used)
+            self._release(worker, reason)
+    
+    def run(self, budget, func, *args, share=1):
+        """
+        Ejecuta func(*args) en un proceso de extracción y devuelve su resultado. Si agota su parte
+        de la CPU (share > 1), se repite una vez con toda la CPU que el documento no tiene reservada:
+        solo falla por CPU cuando se acaba la del documento, no la parte de una tarea.
+        """
+        try:
+            (result,) = self.iterate(budget, func, *args, share=share)
+        except ParseCPULimitError:
+            if share == 1:
+                raise
+            (result,) = self.iterate(budget, func, *args)
+        return result
+    
+    def submit(self, budget, func, *args):
+        """
+        Como run, pero devuelve un Future (varias tareas de un documento en paralelo). Hasta size
+        tareas del documento pueden estar en curso, así que cada una reserva 1/size de la CPU libre.
+        """
+        return self.executor.submit(self.run, budget, func, *args, share=self.size)
     
-    return math.ceil(estimated_time)
+    def stats(self):
+        with self.lock:
+            return {"workers": self.started - sum(self.killed.values()), "idle": len(self.idle),
+                    "killed": dict(self.killed)}
 
-# Árbol de fragmentos para optimizar el procesamiento de texto
-class TextChunkTree:
+# Procesos de extracción, compartidos por todas las tareas
+parser_pool = ParserPool()
+
+def iter_pdf_pages(pdf_path: str, progress_callback=None, budget=None):
     """
-    Estructura de árbol para organizar fragmentos de texto y optimizar la conversión.
-    Esta estructura ayuda a identificar patrones comunes y frases repetitivas.
+    Genera el texto de cada página del PDF, en orden, a medida que se extrae.
+    Las páginas se reparten por grupos entre los procesos de extracción, con los límites de budget
+    (uno nuevo para este documento si no se indica); progress_callback(páginas_hechas,
+    páginas_totales) se llama cada vez que se entrega un grupo.
     """
-    def __init__(self):
-        self.chunks = {}
-        self.children = {}
-        
-    def add_chunk(self, text, chunk_id):
-        """Añade un fragmento al árbol"""
-        # Usar las primeras palabras como clave
-        words = text.split()
-        key = " ".join(words[:3]) if len(words) >= 3 else text[:20]
-        
-        if key not in self.children:
-            self.children[key] = TextChunkTree()
-        
-        self.children[key].chunks[chunk_id] = text
+    budget = budget or ParseBudget()
+    pdf_path = os.path.abspath(pdf_path)
+    try:
+        total_pages = parser_pool.run(budget, count_pdf_pages, pdf_path)
+    except ParseLimitError:
+        raise
+    except Exception as e:
+        print(f"No se pudieron contar las páginas del PDF: {str(e)}")
+        total_pages = 0
     
-    def find_similar_chunks(self, text, threshold=0.8):
-        """Encuentra fragmentos similares en el árbol"""
-        words = text.split()
-        key = " ".join(words[:3]) if len(words) >= 3 else text[:20]
-        
-        similar_chunks = []
-        
-        if key in self.children:
-            # Calcular similitud con fragmentos existentes
-            for chunk_id, chunk_text in self.children[key].chunks.items():
-                similarity = self._calculate_similarity(text, chunk_text)
-                if similarity >= threshold:
-                    similar_chunks.append((chunk_id, similarity))
-        
-        return similar_chunks
+    if total_pages == 0:
+        yield parser_pool.run(budget, extract_text_from_pdf_whole, pdf_path)
+        return
     
-    def _calculate_similarity(self, text1, text2):
-        """Calcula la similitud entre dos textos (método simple)"""
-        # Convertir a conjuntos de palabras
-        words1 = set(text1.lower().split())
-        words2 = set(text2.lower().split())
-        
-        # Usar coeficiente de Jaccard
-        if not words1 or not words2:
-            return 0
-        
-        intersection = words1.intersection(words2)
-        union = words1.union(words2)
-        
-        return len(intersection) / len(union)
-
-# Crear un árbol de fragmentos global
-text_chunk_tree = TextChunkTree()
+    # Grupos pequeños para repartir la carga y reportar progreso con frecuencia
+    pages_per_task = max(1, min(PDF_PAGES_PER_TASK, math.ceil(total_pages / (NUM_CORES * 4))))
+    groups = [list(range(i, min(i + pages_per_task, total_pages)))
+              for i in range(0, total_pages, pages_per_task)]
+    futures = [parser_pool.submit(budget, extract_pdf_pages, pdf_path, group) for group in groups]
+    
+    pages_done = 0
+    try:
+        for group, future in zip(groups, futures):
+            try:
+                texts = future.result()
+            except ParseLimitError:
+                raise
+            except Exception as e:
+                # Error inesperado en el grupo: reintentarlo una vez (página por página dentro del proceso)
+                print(f"Error en el proceso de extracción de PDF: {str(e)}")
+                texts = parser_pool.run(budget, extract_pdf_pages, pdf_path, group)
+            pages_done += len(group)
+            if progress_callback:
+                progress_callback(pages_done, total_pages)
+            yield from texts
+    finally:
+        # Si el consumidor abandona la extracción o se supera un límite, no dejar grupos pendientes
+        for future in futures:
+            future.cancel()
 
-def extract_text_from_pdf_optimized(pdf_path: str) -> str:
-    """Extrae el texto del PDF usando pdfminer.six con mayor robustez y diagnóstico."""
+def extract_text_from_pdf_optimized(pdf_path: str, progress_callback=None) -> str:
+    """Extrae el texto completo del PDF por páginas, repartidas entre varios procesos."""
     try:
         print(f"Intentando extraer texto de PDF: {pdf_path}")
         
@@ -364,310 +2660,521 @@ def extract_text_from_pdf_optimized(pdf_path: str) -> str:
             print(f"Error: El archivo PDF está vacío: {pdf_path}")
             return ""
         
-        # Intentar con parámetros más básicos primero
-        try:
-            text = extract_text(pdf_path, page_numbers=None, maxpages=0)
-            if text.strip():
-                return text
-        except Exception as e:
-            print(f"Primer intento de extracción de PDF falló: {str(e)}")
-        
-        # Si falló, intentar con configuración alternativa
-        try:
-            text = extract_text(
-                pdf_path, 
-                page_numbers=None, 
-                maxpages=0, 
-                laparams=None  # Sin parámetros de layout
-            )
-            return text
-        except Exception as e:
-            print(f"Segundo intento de extracción de PDF falló: {str(e)}")
-            
-        # Último intento con configuración mínima
-        from pdfminer.high_level import extract_text_to_fp
-        from pdfminer.layout import LAParams
-        from io import StringIO
-        
-        output = StringIO()
-        with open(pdf_path, 'rb') as fp:
-            extract_text_to_fp(fp, output, laparams=LAParams(), 
-                             output_type='text', codec='utf-8')
-        return output.getvalue()
+        return "".join(iter_pdf_pages(pdf_path, progress_callback))
             
     except Exception as e:
         print(f"Error al extraer texto de PDF (método final): {str(e)}")
         traceback.print_exc()  # Imprimir traza completa para diagnóstico
         return "No se pudo extraer texto del PDF. Por favor, verifique que el archivo no esté protegido o dañado."
 
-def extract_text_from_docx_optimized(docx_path: str) -> str:
-    """Extrae el texto de un archivo DOCX con mayor robustez y diagnóstico."""
-    try:
-        print(f"Intentando extraer texto de DOCX: {docx_path}")
-        
-        # Verificar si el archivo existe y tiene contenido
-        if not os.path.exists(docx_path):
-            print(f"Error: El archivo DOCX no existe: {docx_path}")
-            return ""
-            
-        if os.path.getsize(docx_path) == 0:
-            print(f"Error: El archivo DOCX está vacío: {docx_path}")
-            return ""
-        
-        # Intentar abrir el documento
-        try:
-            doc = Document(docx_path)
-        except Exception as e:
-            print(f"Error al abrir DOCX con python-docx: {str(e)}")
-            # Intentar método alternativo
-            return extract_docx_fallback(docx_path)
-        
-        text_parts = []
-        
-        # Extraer texto de párrafos
-        try:
-            for para in doc.paragraphs:
-                if para.text.strip():
-                    text_parts.append(para.text)
-        except Exception as e:
-            print(f"Error al extraer párrafos: {str(e)}")
-        
-        # Extraer texto de tablas
-        try:
-            for table in doc.tables:
-                for row in table.rows:
-                    row_text = []
-                    for cell in row.cells:
-                        if cell.text.strip():
-                            row_text.append(cell.text)
-                    if row_text:
-                        text_parts.append(" | ".join(row_text))
-        except Exception as e:
-            print(f"Error al extraer tablas: {str(e)}")
-        
-        result = "\n".join(text_parts)
-        
-        # Si no se extrajo nada, probar método alternativo
-        if not result.strip():
-            print("No se extrajo texto con python-docx, intentando método alternativo")
-            return extract_docx_fallback(docx_path)
-            
-        return result
-        
-    except Exception as e:
-        print(f"Error al extraer texto de DOCX (general): {str(e)}")
-        traceback.print_exc()  # Imprimir traza completa para diagnóstico
-        return "No se pudo extraer texto del DOCX. Por favor, verifique que el archivo no esté protegido o dañado."
+# Espacios que se reducen a uno solo dentro de una línea (incluye el espacio duro y el salto de página)
+LINE_SPACE_PATTERN = re.compile(r"[ \t\r\f\v\u00a0\u2000-\u200a\u202f\u3000]+")
+# Caracteres invisibles que solo indican cortes o formato: guion blando, espacios de ancho cero, BOM
+INVISIBLE_CHARS = dict.fromkeys(map(ord, "\u00ad\u200b\u200c\u200d\u2060\ufeff"))
+DIGITS_PATTERN = re.compile(r"\d+")
+# Línea que solo contiene el número de página: "3", "- 3 -", "Página 3 de 10", "Page 3/10"
+PAGE_NUMBER_PATTERN = re.compile(
+    r"[-–—\s]*(?:(?:página|pagina|pág\.?|page|p\.)\s*)?\d+(?:\s*(?:de|of|/)\s*\d+)?[-–—\s]*",
+    re.IGNORECASE
+)
+# Un párrafo que termina así no continúa en la página siguiente
+PARAGRAPH_END_CHARS = ".!?:…\"»”)"
 
-def extract_docx_fallback(docx_path):
-    """Método alternativo para extraer texto de DOCX usando zipfile."""
-    try:
-        print("Usando método alternativo para DOCX con zipfile")
-        import zipfile
-        from xml.etree.ElementTree import XML
+def clean_lines(text):
+    """Líneas del texto en forma NFC, sin caracteres invisibles y con los espacios reducidos."""
+    text = unicodedata.normalize("NFC", text).translate(INVISIBLE_CHARS)
+    return [LINE_SPACE_PATTERN.sub(" ", line).strip() for line in text.split("\n")]
+
+def edge_line_signature(line):
+    """
+    Firma de una línea de borde. Solo en los números de página se ignoran las cifras, que cambian
+    en cada página; cualquier otra línea tiene que repetirse igual, o títulos numerados como
+    "Capítulo 1", "Capítulo 2" pasarían por una cabecera repetida.
+    """
+    if PAGE_NUMBER_PATTERN.fullmatch(line):
+        return DIGITS_PATTERN.sub("#", line.lower())
+    return line
+
+def join_wrapped_lines(first, second):
+    """Une dos líneas de un mismo párrafo, quitando el guion si una palabra quedó partida."""
+    if len(first) > 1 and first[-1] in "-‐" and first[-2].isalpha() and second[:1].islower():
+        return first[:-1] + second
+    return f"{first} {second}"
+
+class TextNormalizer:
+    """
+    Normaliza el texto extraído página a página antes de dividirlo: Unicode NFC y espacios
+    reducidos. Con paged=True (PDF) además se eliminan las cabeceras y pies de página repetidos,
+    se unen las líneas de cada párrafo y se recomponen las palabras partidas con guion; en DOCX
+    cada línea ya es un párrafo. Así dos exportaciones del mismo documento producen los mismos
+    fragmentos y comparten el caché. Las primeras NORMALIZE_HEADER_PAGES páginas se retienen
+    hasta conocer las cabeceras.
+    """
+    def __init__(self, paged=True):
+        self.paged = paged
+        self.edge_pages = {}  # firma -> páginas en cuyo borde aparece
+        self.body_pages = {}  # firma -> páginas en cuyo interior aparece (entonces no es cabecera)
+        self.pages_seen = 0
+        self.pending = []
+        self.carry = None  # último párrafo, que puede continuar en la página siguiente
+    
+    def feed(self, page: str) -> list:
+        """Añade una página y devuelve el texto normalizado de las páginas que ya se pueden entregar."""
+        lines = clean_lines(page)
+        self.pending.append(lines)
+        if not self.paged:
+            return self._flush()
+        self.pages_seen += 1
+        edge, body = self._edge_lines(lines)
+        for counts, candidates in ((self.edge_pages, edge), (self.body_pages, body)):
+            for signature in {edge_line_signature(line) for line in candidates}:
+                counts[signature] = counts.get(signature, 0) + 1
+        if self.pages_seen < NORMALIZE_HEADER_PAGES:
+            return []
+        return self._flush()
+    
+    def finish(self) -> list:
+        """Indica que no llegarán más páginas y devuelve el texto pendiente."""
+        pages = self._flush()
+        if self.carry:
+            pages.append(f"{self.carry}\n")
+            self.carry = None
+        return pages
+    
+    def _edge_lines(self, lines):
+        """Líneas cortas de los bordes de la página y del interior."""
+        content = [line for line in lines if line and len(line) <= NORMALIZE_HEADER_MAX_CHARS]
+        if len(content) <= 2 * NORMALIZE_EDGE_LINES:
+            return content, []
+        return (content[:NORMALIZE_EDGE_LINES] + content[-NORMALIZE_EDGE_LINES:],
+                content[NORMALIZE_EDGE_LINES:-NORMALIZE_EDGE_LINES])
+    
+    def _is_header(self, line):
+        if not self.paged or len(line) > NORMALIZE_HEADER_MAX_CHARS:
+            return False
+        signature = edge_line_signature(line)
+        edge_pages = self.edge_pages.get(signature, 0)
+        return edge_pages >= NORMALIZE_HEADER_MIN_PAGES and edge_pages > self.body_pages.get(signature, 0)
+    
+    def _strip_headers(self, lines):
+        """Vacía las cabeceras y pies de la página; una línea vacía separa párrafos como antes."""
+        content = [i for i, line in enumerate(lines) if line]
+        removed = set()
+        for edge in (content[:NORMALIZE_EDGE_LINES], content[:-NORMALIZE_EDGE_LINES - 1:-1]):
+            for i in edge:
+                if not self._is_header(lines[i]):
+                    break
+                removed.add(i)
+        return ["" if i in removed else line for i, line in enumerate(lines)]
+    
+    def _paragraphs(self, lines):
+        if not self.paged:
+            return [line for line in lines if line]
+        # Las líneas en blanco separan párrafos; las demás se unen
+        paragraphs = []
+        current = None
+        for line in lines:
+            if not line:
+                if current:
+                    paragraphs.append(current)
+                current = None
+            elif current is None:
+                current = line
+            else:
+                current = join_wrapped_lines(current, line)
+        if current:
+            paragraphs.append(current)
+        return paragraphs
+    
+    def _flush(self):
+        pages = []
+        for lines in self.pending:
+            paragraphs = self._paragraphs(self._strip_headers(lines))
+            if self.carry and paragraphs and paragraphs[0][:1].islower():
+                # Un párrafo cortado por el salto de página continúa en la primera línea de la siguiente
+                paragraphs[0] = join_wrapped_lines(self.carry, paragraphs[0])
+            elif self.carry:
+                paragraphs.insert(0, self.carry)
+            self.carry = None
+            if (self.paged and paragraphs and len(paragraphs[-1]) < CHUNK_MAX_CHARS
+                    and not paragraphs[-1].endswith(tuple(PARAGRAPH_END_CHARS))):
+                self.carry = paragraphs.pop()
+            pages.append("".join(f"{paragraph}\n" for paragraph in paragraphs))
+        self.pending = []
+        return pages
+
+def normalize_text(text, paged=True):
+    """Normaliza un texto completo (ver TextNormalizer)."""
+    normalizer = TextNormalizer(paged)
+    return "".join(normalizer.feed(text) + normalizer.finish())
+
+def canonical_text(text):
+    """Forma canónica de un fragmento para su clave de caché: NFC y espacios reducidos a uno."""
+    return " ".join(unicodedata.normalize("NFC", text).translate(INVISIBLE_CHARS).split())
+
+class TextChunker:
+    """
+    Divide el texto en fragmentos de forma incremental: recibe el texto por partes (páginas,
+    párrafos) y devuelve los fragmentos en cuanto están completos. Produce exactamente los mismos
+    fragmentos que dividir el texto completo de una vez.
+    """
+    def __init__(self, max_length: int = 800):
+        self.max_length = max_length
+        # Mientras el texto total no supere max_length se guarda tal cual (será un único fragmento)
+        self.head = []
+        self.head_length = 0
+        self.streaming = False
+        self.line_buffer = []
+        # Fragmento en construcción: párrafos que se unirán con '\n' y su longitud una vez unidos
+        self.current_parts = []
+        self.current_length = 0
+    
+    def feed(self, piece: str) -> list:
+        """Añade texto y devuelve los fragmentos que ya están completos."""
+        if not self.streaming:
+            self.head.append(piece)
+            self.head_length += len(piece)
+            if self.head_length <= self.max_length:
+                return []
+            self.streaming = True
+            piece = "".join(self.head)
+            self.head = None
+        return self._feed_lines(piece)
+    
+    def finish(self) -> list:
+        """Indica que no llegará más texto y devuelve los fragmentos pendientes."""
+        if not self.streaming:
+            # Si el texto es más corto que el máximo, devolverlo como un solo fragmento
+            return ["".join(self.head)]
+        chunks = self._add_paragraph("".join(self.line_buffer))
+        self.line_buffer = []
+        # Añadir el último chunk
+        if self.current_parts:
+            chunks.extend(self._split_long_chunk("\n".join(self.current_parts)))
+            self.current_parts = []
+            self.current_length = 0
+        return chunks
+    
+    def _feed_lines(self, piece):
+        # Dividir por párrafos; la última línea puede continuar en la siguiente parte
+        lines = piece.split('\n')
+        if len(lines) == 1:
+            self.line_buffer.append(piece)
+            return []
+        self.line_buffer.append(lines[0])
+        chunks = self._add_paragraph("".join(self.line_buffer))
+        for para in lines[1:-1]:
+            chunks.extend(self._add_paragraph(para))
+        self.line_buffer = [lines[-1]]
+        return chunks
+    
+    def _add_paragraph(self, para):
+        # Agrupar párrafos en chunks de tamaño óptimo
+        if not para.strip():
+            return []
+        if self.current_parts and self.current_length + len(para) + 1 > self.max_length:
+            chunks = self._split_long_chunk("\n".join(self.current_parts))
+            self.current_parts = [para]
+            self.current_length = len(para)
+            return chunks
+        if self.current_parts:
+            self.current_length += 1
+        self.current_parts.append(para)
+        self.current_length += len(para)
+        return []
+    
+    def _split_long_chunk(self, chunk):
+        # Si hay párrafos muy largos, dividirlos por oraciones
+        if len(chunk) <= self.max_length:
+            return [chunk]
+        final_chunks = []
+        # Oraciones del fragmento en construcción (se unen con ' ') y su longitud una vez unidas
+        parts = []
+        length = 0
         
-        # Definir NAMESPACE
-        NAMESPACE = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
-        PARA = NAMESPACE + 'p'
-        TEXT = NAMESPACE + 't'
+        for sentence in split_into_sentences(chunk):
+            # Una oración más larga que el máximo se divide por sus pausas, sin perder texto
+            pieces = [sentence] if len(sentence) <= self.max_length else split_long_sentence(sentence, self.max_length)
+            for piece in pieces:
+                if parts and length + 1 + len(piece) > self.max_length:
+                    final_chunks.append(' '.join(parts))
+                    parts = [piece]
+                    length = len(piece)
+                else:
+                    if parts:
+                        length += 1
+                    parts.append(piece)
+                    length += len(piece)
         
-        # Abrir el archivo como un zip
-        with zipfile.ZipFile(docx_path) as docx:
-            # Extraer document.xml que contiene el contenido
-            try:
-                content = docx.read('word/document.xml')
-            except KeyError:
-                print("No se pudo encontrar 'word/document.xml' en el archivo DOCX")
-                return ""
-                
-            # Analizar el XML
-            tree = XML(content)
-            
-            # Extraer párrafos
-            paragraphs = []
-            for paragraph in tree.iter(PARA):
-                texts = [node.text for node in paragraph.iter(TEXT) if node.text]
-                if texts:
-                    paragraphs.append(''.join(texts))
-                    
-            return '\n'.join(paragraphs)
-    except Exception as e:
-        print(f"Error en método alternativo DOCX: {str(e)}")
-        return ""
+        if parts:
+            final_chunks.append(' '.join(parts))
+        return final_chunks
+
+# Pausas dentro de una oración, de más a menos natural: punto y coma o dos puntos, coma o guion
+CLAUSE_BREAK_PATTERNS = (re.compile(r"[;:][ \n]"), re.compile(r"(?:,| [-–—])[ \n]"))
+WHITESPACE_PATTERN = re.compile(r"\s")
+
+def last_match_end(pattern, text, start, end):
+    """Final de la última coincidencia de pattern dentro de text[start:end], o None."""
+    last = None
+    for last in pattern.finditer(text, start, end):
+        pass
+    return last.end() if last else None
+
+def split_long_sentence(sentence, max_length):
+    """
+    Divide una oración más larga que max_length en partes que no lo superan, sin perder texto.
+    Cada corte se hace en la última pausa de la segunda mitad de la ventana (';' o ':', después
+    ',' o un guion); si no hay ninguna, en el último espacio, y solo sin espacios a mitad de palabra.
+    """
+    parts = []
+    start = 0
+    while len(sentence) - start > max_length:
+        window_end = start + max_length
+        cut = None
+        for pattern in CLAUSE_BREAK_PATTERNS:
+            cut = last_match_end(pattern, sentence, start + max_length // 2, window_end)
+            if cut:
+                break
+        if not cut:
+            cut = last_match_end(WHITESPACE_PATTERN, sentence, start + 1, window_end) or window_end
+        parts.append(sentence[start:cut])
+        start = cut
+    parts.append(sentence[start:])
+    return parts
+
+def choose_chunk_size(total_chars):
+    """
+    Tamaño de fragmento para un documento de total_chars caracteres: el menor de CHUNK_SIZE_LEVELS
+    que da como mucho CHUNK_TARGET_WAVES fragmentos por hilo de CHUNK_REFERENCE_THREADS.
+    Depende solo de la longitud del texto y de la configuración, de modo que el mismo documento
+    recibe siempre el mismo tamaño y los mismos fragmentos, sin importar cuántos trabajos haya en marcha.
+    """
+    for size in CHUNK_SIZE_LEVELS:
+        if total_chars <= size * CHUNK_REFERENCE_THREADS * CHUNK_TARGET_WAVES:
+            return size
+    return CHUNK_SIZE_LEVELS[-1]
+
+# Con más caracteres que estos el tamaño ya es el mayor: no hace falta esperar al resto del texto
+CHUNK_SIZE_DECISION_CHARS = CHUNK_SIZE_LEVELS[-2] * CHUNK_REFERENCE_THREADS * CHUNK_TARGET_WAVES + 1
 
 def split_text_optimized(text: str, max_length: int = 800) -> list:
     """
     Divide el texto en fragmentos más pequeños para procesamiento eficiente.
     Utiliza un tamaño máximo más pequeño para mejor paralelización.
     """
-    # Si el texto es más corto que el máximo, devolverlo como un solo fragmento
-    if len(text) <= max_length:
-        return [text]
+    chunker = TextChunker(max_length)
+    return chunker.feed(text) + chunker.finish()
+
+def iter_chunk_batches(text_pieces, max_length: int = 800, size_for=None):
+    """
+    Genera listas de fragmentos a medida que llegan las partes del texto (una lista por parte).
+    Si se indica size_for(caracteres), el tamaño máximo se elige con la longitud del texto: se
+    retienen las partes hasta reunir CHUNK_SIZE_DECISION_CHARS caracteres o hasta el final, de
+    modo que la elección no depende de cómo se reparte el texto en páginas.
+    """
+    chunker = None if size_for else TextChunker(max_length)
+    pending = []
+    pending_chars = 0
+    for piece in text_pieces:
+        if chunker is None:
+            pending.append(piece)
+            pending_chars += len(piece)
+            if pending_chars < CHUNK_SIZE_DECISION_CHARS:
+                continue
+            chunker = TextChunker(size_for(pending_chars))
+            chunks = [chunk for held in pending for chunk in chunker.feed(held)]
+            pending = None
+        else:
+            chunks = chunker.feed(piece)
+        if chunks:
+            yield chunks
+    if chunker is None:
+        # Documento corto: su longitud ya es la definitiva
+        chunker = TextChunker(size_for(pending_chars))
+        chunks = [chunk for held in pending for chunk in chunker.feed(held)]
+    else:
+        chunks = []
+    chunks += chunker.finish()
+    if chunks:
+        yield chunks
+
+# Final de oración: '.', '!' o '?' seguido de espacio o salto de línea ("... " termina en el mismo sitio)
+SENTENCE_END_PATTERN = re.compile(r"[.!?][ \n]")
+
+def split_into_sentences(text):
+    """Divide un texto en oraciones en una sola pasada; cada oración conserva su final."""
+    result = []
+    start = 0
+    for match in SENTENCE_END_PATTERN.finditer(text):
+        result.append(text[start:match.end()])
+        start = match.end()
+    if start < len(text):
+        result.append(text[start:])
+    return result
+
+class ExtractionError(Exception):
+    """Error durante la extracción de texto dentro del flujo de conversión."""
+    pass
+
+def iter_document_text(file_path, file_ext, progress_callback=None):
+    """
+    Genera el texto del documento por partes (páginas en PDF) a medida que se extrae.
+    El análisis se hace en los procesos de extracción, con los límites de tiempo, CPU y memoria
+    de un documento; si se superan se lanza ParseLimitError.
+    """
+    print(f"Iniciando extracción de texto del archivo {file_ext}: {file_path}")
+    budget = ParseBudget()
+    if file_ext == "pdf":
+        yield from iter_pdf_pages(file_path, progress_callback, budget)
+    else:
+        for piece, pieces_done, pieces_total in parser_pool.iterate(budget, iter_docx_pieces, os.path.abspath(file_path)):
+            if progress_callback:
+                progress_callback(pieces_done, pieces_total)
+            yield piece
+
+def run_conversion_pipeline(task_id, file_path, file_ext, lang: str = "es", resume=False):
+    """
+    Extrae, divide y sintetiza en flujo continuo: cada página pasa al divisor de texto y cada
+    fragmento completo se envía a la síntesis sin esperar a que termine la extracción.
+    El texto y el de cada fragmento se van guardando en disco con su índice (TextIndexWriter),
+    y la lista de fragmentos en el manifiesto del trabajo (JobCheckpoint).
+    Con resume=True se aprovecha el manifiesto de una ejecución anterior: si la división había
+    terminado no se vuelve a extraer el texto, y los fragmentos con audio no se sintetizan otra vez.
+    Devuelve (archivos de audio, caracteres).
+    """
+    source_hash = (task_store.get(task_id) or {}).get("file_hash")
+    previous = JobCheckpoint.load(task_id) if resume else None
+    if previous and (previous.source_hash != source_hash or previous.lang != lang):
+        previous = None
+    done_keys = previous.done_chunks() if previous else {}
     
-    # Dividir por párrafos
-    paragraphs = text.split('\n')
+    if previous and previous.text_intact():
+        print(f"Reanudando {task_id}: {len(done_keys)} de {len(previous.chunks)} fragmentos ya sintetizados")
+        audio_files = process_chunk_stream(previous.iter_chunk_batches(), task_id, lang=lang, done_keys=done_keys)
+        return audio_files, load_text_index(task_id)["chars"]
     
-    # Agrupar párrafos en chunks de tamaño óptimo
-    chunks = []
-    current_chunk = ""
+    extraction = {"fraction": 0.0, "chars": 0, "visible_chars": 0}
+    text_writer = TextIndexWriter(task_id)
+    checkpoint = JobCheckpoint(task_id)
+    checkpoint.start(source_hash, lang)
     
-    for para in paragraphs:
-        if not para.strip():
-            continue
-            
-        if len(current_chunk) + len(para) + 1 > max_length and current_chunk:
-            chunks.append(current_chunk)
-            current_chunk = para
-        else:
-            if current_chunk:
-                current_chunk += '\n' + para
-            else:
-                current_chunk = para
+    def report_pages(pages_done, total_pages):
+        extraction["fraction"] = pages_done / total_pages
+        extraction["pages_total"] = total_pages
+        if file_ext == "pdf":
+            # En DOCX son partes del XML, no páginas que mostrar al usuario
+            update_task(task_id, pages_done=pages_done, pages_total=total_pages)
     
-    # Añadir el último chunk
-    if current_chunk:
-        chunks.append(current_chunk)
+    def record_piece(piece):
+        text_writer.write_page(piece)
+        extraction["chars"] += len(piece)
+        if not extraction["visible_chars"]:
+            extraction["visible_chars"] = len(piece.strip())
+        return piece
     
-    # Si hay párrafos muy largos, dividirlos por oraciones
-    final_chunks = []
-    for chunk in chunks:
-        if len(chunk) <= max_length:
-            final_chunks.append(chunk)
+    def chunk_size_for(text_chars):
+        # Al reanudar se usa el mismo tamaño para que los fragmentos (y sus claves) coincidan
+        if previous and previous.chunk_size:
+            chunk_size = previous.chunk_size
+        elif CHUNK_SIZE_MODE == "adaptive":
+            chunk_size = choose_chunk_size(text_chars)
         else:
-            # Dividir por oraciones
-            sentences = split_into_sentences(chunk)
-            current_sentence_chunk = ""
-            
-            for sentence in sentences:
-                if len(current_sentence_chunk) + len(sentence) > max_length and current_sentence_chunk:
-                    final_chunks.append(current_sentence_chunk)
-                    current_sentence_chunk = sentence
-                else:
-                    if current_sentence_chunk:
-                        current_sentence_chunk += ' ' + sentence
-                    else:
-                        current_sentence_chunk = sentence
-            
-            if current_sentence_chunk:
-                final_chunks.append(current_sentence_chunk)
+            chunk_size = CHUNK_FIXED_SIZE
+        checkpoint.set_chunk_size(chunk_size)
+        update_task(task_id, chunk_size=chunk_size)
+        return chunk_size
     
-    return final_chunks
-
-def split_into_sentences(text):
-    """Divide un texto en oraciones."""
-    # Patrones comunes de final de oración en español
-    sentence_endings = ['. ', '! ', '? ', '.\n', '!\n', '?\n', '... ', '...\n']
-    result = []
+    def text_pieces():
+        normalizer = TextNormalizer(paged=file_ext == "pdf")
+        try:
+            for page in iter_document_text(file_path, file_ext, report_pages):
+                for piece in normalizer.feed(page):
+                    yield record_piece(piece)
+            for piece in normalizer.finish():
+                yield record_piece(piece)
+        except Exception as e:
+            raise ExtractionError(str(e)) from e
+        extraction["fraction"] = 1.0
+        print(f"Texto extraído: {extraction['chars']} caracteres")
     
-    remaining_text = text
-    while remaining_text:
-        min_idx = len(remaining_text)
-        min_ending = None
-        
-        for ending in sentence_endings:
-            idx = remaining_text.find(ending)
-            if idx != -1 and idx < min_idx:
-                min_idx = idx
-                min_ending = ending
-        
-        if min_ending:
-            sentence = remaining_text[:min_idx + len(min_ending)]
-            result.append(sentence)
-            remaining_text = remaining_text[min_idx + len(min_ending):]
-        else:
-            result.append(remaining_text)
-            break
+    def recorded_batches():
+        for batch in iter_chunk_batches(text_pieces(), size_for=chunk_size_for):
+            entries = []
+            for chunk in batch:
+                start, end = text_writer.write_chunk(chunk)
+                entries.append([chunk_cache_key(chunk, lang), start, end])
+            checkpoint.add_chunks(entries)
+            yield batch
+        # División terminada: el índice del texto y el manifiesto completo permiten reanudar sin extraer
+        text_writer.finish()
+        checkpoint.finish(text_writer.text_hash.hexdigest())
     
-    return result
+    try:
+        audio_files = process_chunk_stream(
+            recorded_batches(), task_id, lang=lang, done_keys=done_keys,
+            extract_progress=lambda: extraction["fraction"]
+        )
+    finally:
+        text_writer.close()
+        checkpoint.close()
+    
+    if not extraction["visible_chars"]:
+        cleanup_temp_files(audio_files)
+        raise ExtractionError("No se pudo extraer texto del archivo. Verifique que no esté protegido o dañado.")
+    return audio_files, extraction["chars"]
 
-def process_file_thread(task_id, file_path, file_ext, mp3_filename, lang: str = "es"):
+def process_file_thread(task_id, file_path, file_ext, lang: str = "es", resume=False):
     try:
         # Verificar archivo
         if not os.path.exists(file_path):
-            task_status[task_id]["status"] = "error"
-            task_status[task_id]["error"] = f"El archivo no existe: {file_path}"
+            fail_task(task_id, f"El archivo no existe: {file_path}")
             return
             
         if os.path.getsize(file_path) == 0:
-            task_status[task_id]["status"] = "error"
-            task_status[task_id]["error"] = "El archivo está vacío"
+            fail_task(task_id, "El archivo está vacío")
             return
         
-        # Extraer texto según el tipo de archivo
-        task_status[task_id]["progress"] = 5
-        print(f"Iniciando extracción de texto del archivo {file_ext}: {file_path}")
+        update_task(task_id, progress=5)
         
         try:
-            # Extracción de texto según formato
-            if file_ext == "pdf":
-                text = extract_text_from_pdf_optimized(file_path)
-            else:
-                text = extract_text_from_docx_optimized(file_path)
-                
-            print(f"Texto extraído: {len(text)} caracteres")
-            task_status[task_id]["progress"] = 30
+            # Extracción, división y síntesis en flujo continuo
+            audio_files, text_length = run_conversion_pipeline(task_id, file_path, file_ext, lang=lang, resume=resume)
+            print(f"Texto procesado: {text_length} caracteres en {len(audio_files)} fragmentos")
             
-            if not text or not text.strip():
-                task_status[task_id]["status"] = "error"
-                task_status[task_id]["error"] = "No se pudo extraer texto del archivo. Verifique que no esté protegido o dañado."
-                cleanup_temp_files([file_path])
-                return
-            
-            # Guardar el texto extraído
-            text_filename = f"temp/text_{task_id}.txt"
-            with open(text_filename, "w", encoding="utf-8") as f:
-                f.write(text)
-            # Almacenar el texto para consultas posterior
-            task_status[task_id]["text"] = text
+            update_task(task_id, progress=90)
+            # Archivo virtual: los fragmentos se quedan donde están y solo se escribe el manifiesto
+            manifest = build_audio_manifest(task_id, audio_files)
+            print(f"Manifiesto de audio creado: {len(audio_files)} fragmentos, {manifest['size']} bytes")
+            # Limpiar archivos temporales
+            cleanup_temp_files([file_path])
             
-        except Exception as e:
-            task_status[task_id]["status"] = "error"
-            task_status[task_id]["error"] = f"Error al extraer texto: {str(e)}"
+            update_task(
+                task_id,
+                progress=100,
+                status="completed",
+                completion_time=time.time(),
+                audio_size=manifest["size"],
+                duration=manifest["duration"]
+            )
+        
+        except ExtractionError as e:
+            fail_task(task_id, f"Error al extraer texto: {str(e)}")
             traceback.print_exc()
             cleanup_temp_files([file_path])
-            return
-        
-        try:
-            # Dividir el texto en fragmentos optimizado
-            text_chunks = split_text_optimized(text)
-            print(f"Texto dividido en {len(text_chunks)} fragmentos")
-            task_status[task_id]["progress"] = 40
-            
-            # Aquí usamos la versión paralela y pasamos el idioma seleccionado
-            audio_files = process_chunks_parallel(text_chunks, task_id, lang=lang)
-            
-            task_status[task_id]["progress"] = 90
-            # Concatenar archivos
-            if audio_files:
-                try:
-                    concatenate_audio_files_simple(audio_files, mp3_filename)
-                    print(f"Archivos de audio concatenados: {len(audio_files)}")
-                except Exception as e:
-                    print(f"Error al concatenar audio: {str(e)}")
-                    fallback_concatenate(audio_files, mp3_filename)
-            else:
-                print("No se generaron archivos de audio para concatenar")
-                with open(mp3_filename, 'wb') as f:
-                    f.write(b'')
-            # Limpiar archivos temporales
-            cleanup_temp_files(audio_files + [file_path])
-            
-            task_status[task_id]["progress"] = 100
-            task_status[task_id]["status"] = "completed"
-            task_status[task_id]["completion_time"] = time.time()
+            remove_task_segments(task_id)
                 
         except Exception as e:
             print(f"Error en el procesamiento de archivo: {str(e)}")
             traceback.print_exc()
-            task_status[task_id]["status"] = "error"
-            task_status[task_id]["error"] = f"Error en procesamiento: {str(e)}"
-            cleanup_temp_files([file_path])
+            # Se conservan el archivo y los fragmentos hechos: un reintento solo rehace los que faltan
+            update_task(task_id, status="error", error=f"Error en procesamiento: {str(e)}",
+                        completion_time=time.time(), retryable=True)
     
     except Exception as e:
         print(f"Error general en procesamiento: {str(e)}")
         traceback.print_exc()
-        task_status[task_id]["status"] = "error"
-        task_status[task_id]["error"] = f"Error: {str(e)}"
+        fail_task(task_id, f"Error: {str(e)}")
         if os.path.exists(file_path):
             try:
                 os.remove(file_path)
@@ -676,72 +3183,495 @@ def process_file_thread(task_id, file_path, file_ext, mp3_filename, lang: str =
 
 
 def text_to_speech_optimized(text: str, output_filename: str, lang: str = "es"):
-    try:
-        # Verificar que el texto no esté vacío
-        if not text or not text.strip():
-            print("Error: Texto vacío para conversión a voz")
-            with open(output_filename, 'wb') as f:
-                f.write(b'')
-            return
-        # Normalizar texto - eliminar caracteres problemáticos
-        text = text.replace('|', ',').replace('\x00', ' ')
+    """Convierte un fragmento de texto a MP3 a través de la capa de síntesis compartida."""
+    # Verificar que el texto no esté vacío
+    if not text or not text.strip():
+        print("Error: Texto vacío para conversión a voz")
+        with open(output_filename, 'wb') as f:
+            f.write(b'')
+        return
+    # Normalizar texto - eliminar caracteres problemáticos
+    text = text.replace('|', ',').replace('\x00', ' ')
+    
+    if len(text) > TTS_MAX_CHARS:
+        # Nunca recortar: sintetizar por partes y unir los frames
+        parts = split_text_optimized(text, TTS_MAX_CHARS)
+        print(f"Texto largo ({len(text)} caracteres): se sintetiza en {len(parts)} partes")
+        part_files = [f"{output_filename}.{i}.part" for i in range(len(parts))]
+        try:
+            for part, part_file in zip(parts, part_files):
+                tts_dispatcher.synthesize(part, lang, part_file)
+            concatenate_audio_files(part_files, output_filename)
+        finally:
+            cleanup_temp_files(part_files)
+        return
+    
+    print(f"Intentando convertir texto a voz ({len(text)} caracteres) en idioma '{lang}'")
+    # Los errores se propagan como TTSError para no generar audio vacío en silencio
+    tts_dispatcher.synthesize(text, lang, output_filename)
+    print(f"Audio guardado: {output_filename}")
+
+
+# Tablas de cabeceras MP3: versión -> índices de bitrate (kbps) por capa, frecuencias y muestras por frame
+MP3_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLE_RATES = {1: [44100, 48000, 32000], 2: [22050, 24000, 16000], 2.5: [11025, 12000, 8000]}
+MP3_COPY_BUFFER = 1024 * 1024  # bloque de la copia cuando no hay copia sin pasar por memoria
+
+mp3_header_cache = {}  # cabecera (4 bytes) -> dict de parse_mp3_header; hay pocas combinaciones distintas
+
+def parse_mp3_header(header):
+    """Interpreta los 4 bytes de cabecera de un frame MP3. Devuelve un dict o None si no es válida."""
+    header = bytes(header[:4])
+    if header in mp3_header_cache:
+        return mp3_header_cache[header]
+    info = _parse_mp3_header(header)
+    if info is not None:
+        mp3_header_cache[header] = info
+    return info
+
+def _parse_mp3_header(header):
+    if len(header) < 4 or header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+        return None
+    version = {0: 2.5, 2: 2, 3: 1}.get((header[1] >> 3) & 0x03)
+    layer = {1: 3, 2: 2, 3: 1}.get((header[1] >> 1) & 0x03)
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0x03
+    if version is None or layer is None or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    
+    bitrate = MP3_BITRATES[(1 if version == 1 else 2, layer)][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][sample_rate_index]
+    padding = (header[2] >> 1) & 0x01
+    if layer == 1:
+        frame_length = (12 * bitrate // sample_rate + padding) * 4
+        samples = 384
+    elif layer == 2 or version == 1:
+        frame_length = 144 * bitrate // sample_rate + padding
+        samples = 1152
+    else:
+        frame_length = 72 * bitrate // sample_rate + padding
+        samples = 576
+    return {
+        "version": version,
+        "layer": layer,
+        "bitrate": bitrate,
+        "sample_rate": sample_rate,
+        "mono": (header[3] >> 6) == 3,
+        "frame_length": frame_length,
+        "samples": samples
+    }
+
+def xing_offset(info):
+    """Posición de la etiqueta Xing/Info dentro de un frame de Layer III (tras la información lateral)."""
+    if info["version"] == 1:
+        return 4 + (17 if info["mono"] else 32)
+    return 4 + (9 if info["mono"] else 17)
+
+def id3v2_size(data):
+    """Tamaño total de una etiqueta ID3v2 al principio de data, o 0 si no hay."""
+    if len(data) >= 10 and data[:3] == b"ID3":
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        footer = 10 if data[5] & 0x10 else 0
+        return 10 + size + footer
+    return 0
+
+def scan_mp3_segment(path):
+    """
+    Localiza los frames de audio de un MP3 sin copiarlo en memoria (mmap).
+    Omite etiquetas ID3v2/ID3v1 y un frame Xing/Info inicial. Devuelve un dict con el rango
+    de bytes de audio, el número de frames, las muestras, la cabecera del primer frame y
+    si el bitrate es constante, o None si el archivo no contiene frames válidos.
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return None
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        end = size
+        if size >= 128 and data[size - 128:size - 125] == b"TAG":
+            end -= 128
         
-        if len(text) > 5000:
-            print(f"Texto demasiado largo ({len(text)} caracteres), recortando a 5000")
-            text = text[:5000]
+        pos = 0
+        while True:
+            tag_size = id3v2_size(data[pos:pos + 10])
+            if not tag_size:
+                break
+            pos += tag_size
+        
+        start = None
+        first_header = None
+        frames = 0
+        samples = 0
+        bitrates = set()
+        try_run = True
+        while pos + 4 <= end:
+            info = parse_mp3_header(data[pos:pos + 4])
+            if info is None or pos + info["frame_length"] > end:
+                # Resincronizar: buscar la siguiente palabra de sincronización
+                next_sync = data.find(b"\xff", pos + 1, end)
+                if next_sync == -1:
+                    break
+                pos = next_sync
+                continue
+            
+            if start is None:
+                tag_pos = pos + xing_offset(info)
+                if info["layer"] == 3 and data[tag_pos:tag_pos + 4] in (b"Xing", b"Info"):
+                    # Cabecera de duración del fragmento: no es audio y no debe repetirse
+                    pos += info["frame_length"]
+                    continue
+                start = pos
+                first_header = bytes(data[pos:pos + 4])
+            
+            frame_length = info["frame_length"]
+            if try_run:
+                # Caso habitual (bitrate constante sin relleno): todas las cabeceras son iguales y
+                # se comprueban de una vez con cortes escalonados en lugar de frame a frame
+                try_run = False
+                run = (end - pos) // frame_length
+                header = data[pos:pos + 4]
+                if all(data[pos + i:pos + run * frame_length:frame_length] == header[i:i + 1] * run
+                       for i in range(4)):
+                    frames += run
+                    samples += run * info["samples"]
+                    bitrates.add(info["bitrate"])
+                    pos += run * frame_length
+                    continue
+            frames += 1
+            samples += info["samples"]
+            bitrates.add(info["bitrate"])
+            pos += frame_length
+    
+    if start is None:
+        return None
+    return {
+        "path": path,
+        "start": start,
+        "end": pos,
+        "frames": frames,
+        "samples": samples,
+        "sample_rate": parse_mp3_header(first_header)["sample_rate"],
+        "first_header": first_header,
+        "constant_bitrate": len(bitrates) == 1
+    }
+
+def build_xing_frame(first_header, total_frames, total_audio_bytes, constant_bitrate=True):
+    """
+    Construye un frame Xing/Info con el número total de frames y de bytes, para que los
+    reproductores conozcan la duración y puedan buscar dentro del archivo concatenado.
+    """
+    header = bytearray(first_header)
+    header[2] &= 0xFD  # sin relleno
+    info = parse_mp3_header(header)
+    # El frame debe ser lo bastante grande para la etiqueta (offset + 16 bytes)
+    while info["frame_length"] < xing_offset(info) + 16 and (header[2] >> 4) < 14:
+        header[2] += 0x10
+        info = parse_mp3_header(header)
+    
+    frame = bytearray(info["frame_length"])
+    frame[:4] = header
+    offset = xing_offset(info)
+    frame[offset:offset + 4] = b"Info" if constant_bitrate else b"Xing"
+    frame[offset + 4:offset + 8] = (0x03).to_bytes(4, "big")  # campos presentes: frames y bytes
+    frame[offset + 8:offset + 12] = total_frames.to_bytes(4, "big")
+    frame[offset + 12:offset + 16] = (total_audio_bytes + len(frame)).to_bytes(4, "big")
+    return bytes(frame)
+
+def copy_file_range_to(source_path, offset, length, out_fd):
+    """Copia un rango de un archivo al descriptor de salida sin pasar los datos por Python si es posible."""
+    with open(source_path, "rb") as source:
+        in_fd = source.fileno()
+        remaining = length
+        position = offset
+        for zero_copy in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+            if zero_copy is None:
+                continue
+            try:
+                while remaining > 0:
+                    if zero_copy is os.sendfile:
+                        copied = os.sendfile(out_fd, in_fd, position, remaining)
+                    else:
+                        copied = os.copy_file_range(in_fd, out_fd, remaining, offset_src=position)
+                    if copied == 0:
+                        break
+                    position += copied
+                    remaining -= copied
+                if remaining == 0:
+                    return
+            except OSError:
+                # Sistema de archivos sin soporte: probar el siguiente método con lo que falte
+                continue
         
+        # Copia con búfer de tamaño fijo
+        source.seek(position)
+        while remaining > 0:
+            block = source.read(min(MP3_COPY_BUFFER, remaining))
+            if not block:
+                break
+            os.write(out_fd, block)
+            remaining -= len(block)
+
+def plan_audio_segments(input_files):
+    """
+    Analiza los fragmentos y devuelve (frame Info/Xing, segmentos), donde cada segmento es
+    [ruta, inicio, longitud] con solo los frames de audio. Lanza ValueError si algún
+    fragmento no contiene frames MP3 válidos.
+    """
+    scanned = []
+    for fname in input_files:
+        if os.path.exists(fname) and os.path.getsize(fname) > 0:
+            segment = scan_mp3_segment(fname)
+            if segment is None:
+                raise ValueError(f"El fragmento no contiene frames MP3 válidos: {fname}")
+            scanned.append(segment)
+    if not scanned:
+        return b"", [], 0.0
+    
+    total_frames = sum(segment["frames"] for segment in scanned)
+    total_bytes = sum(segment["end"] - segment["start"] for segment in scanned)
+    constant_bitrate = (all(segment["constant_bitrate"] for segment in scanned)
+                        and len({segment["first_header"][2] >> 4 for segment in scanned}) == 1)
+    xing_frame = build_xing_frame(scanned[0]["first_header"], total_frames, total_bytes, constant_bitrate)
+    segments = [[segment["path"], segment["start"], segment["end"] - segment["start"]] for segment in scanned]
+    duration = sum(segment["samples"] / segment["sample_rate"] for segment in scanned)
+    return xing_frame, segments, duration
+
+def concatenate_audio_files(input_files, output_file):
+    """
+    Concatena los MP3 de los fragmentos a nivel de frame: quita las etiquetas y cabeceras
+    Xing de cada fragmento, copia los frames sin cargarlos en memoria y escribe al principio
+    una cabecera Info/Xing con la duración total. Devuelve el tamaño de esa cabecera.
+    """
+    xing_frame, segments, _ = plan_audio_segments(input_files)
+    out_fd = os.open(output_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(out_fd, xing_frame)
+        for path, start, length in segments:
+            copy_file_range_to(path, start, length, out_fd)
+        return len(xing_frame)
+    finally:
+        os.close(out_fd)
+
+def task_segments_dir(task_id):
+    return os.path.join(SEGMENTS_DIR, task_id)
+
+def segment_path(task_id, idx):
+    """Ruta del audio del fragmento idx de una tarea (un enlace al almacén de caché si es posible)."""
+    return os.path.join(SEGMENTS_DIR, task_id, f"{idx}.mp3")
+
+def remove_task_segments(task_id):
+    """Borra los fragmentos, la cabecera y el manifiesto de una tarea."""
+    shutil.rmtree(task_segments_dir(task_id), ignore_errors=True)
+
+class JobCheckpoint:
+    """
+    Manifiesto de un trabajo (segments/{task_id}/job.jsonl) para reanudarlo tras un reinicio o
+    un reintento. Es un registro de solo añadir: una cabecera con el hash del archivo y el idioma,
+    una línea por lote con la clave y el rango de cada fragmento en temp/chunks_{task_id}.txt,
+    y una línea final con el hash del texto cuando la división ha terminado. Un fragmento está
+    hecho si su MP3 existe en segments/{task_id}, porque el audio se escribe de forma atómica.
+    """
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.path = os.path.join(task_segments_dir(task_id), "job.jsonl")
+        self.file = None
+        self.source_hash = None
+        self.lang = None
+        self.chunks = []  # [clave, inicio, fin] por fragmento
+        self.chunk_size = None
+        self.text_hash = None
+        self.complete = False
+    
+    @classmethod
+    def load(cls, task_id):
+        """Lee el manifiesto de una ejecución anterior. Devuelve None si no existe."""
+        checkpoint = cls(task_id)
         try:
-            # Convertir a audio con manejo de errores específicos
-            print(f"Intentando convertir texto a voz ({len(text)} caracteres) en idioma '{lang}'")
-            tts = gTTS(text=text, lang=lang, slow=False)
-            tts.save(output_filename)
-            print(f"Audio guardado: {output_filename}")
-        except AssertionError as e:
-            print(f"Error de aserción en gTTS: {str(e)}")
-            with open(output_filename, 'wb') as f:
-                f.write(b'')
-        except Exception as e:
-            print(f"Error desconocido en gTTS: {str(e)}")
-            if len(text) > 100:
-                print("Intentando con fragmento del texto")
-                try:
-                    tts = gTTS(text=text[:100] + "...", lang=lang, slow=False)
-                    tts.save(output_filename)
-                except:
-                    with open(output_filename, 'wb') as f:
-                        f.write(b'')
-            else:
-                with open(output_filename, 'wb') as f:
-                    f.write(b'')
-                    
+            with open(checkpoint.path, "rb") as f:
+                lines = f.read().split(b"\n")
+        except OSError:
+            return None
+        # La última línea no termina en salto de línea si el proceso murió mientras la escribía
+        for line in lines[:-1]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if "source_hash" in record:
+                checkpoint.source_hash = record["source_hash"]
+                checkpoint.lang = record["lang"]
+            elif "chunk_size" in record:
+                checkpoint.chunk_size = record["chunk_size"]
+            elif "chunks" in record:
+                checkpoint.chunks.extend(record["chunks"])
+            elif record.get("complete"):
+                checkpoint.text_hash = record["text_hash"]
+                checkpoint.complete = True
+        return checkpoint if checkpoint.source_hash is not None else None
+    
+    def _append(self, record):
+        self.file.write(json.dumps(record).encode("utf-8") + b"\n")
+        self.file.flush()
+    
+    def start(self, source_hash, lang):
+        """Empieza un manifiesto nuevo (la división del texto vuelve a empezar)."""
+        os.makedirs(task_segments_dir(self.task_id), exist_ok=True)
+        self.file = open(self.path, "wb")
+        self.source_hash = source_hash
+        self.lang = lang
+        self._append({"source_hash": source_hash, "lang": lang})
+    
+    def set_chunk_size(self, chunk_size):
+        self.chunk_size = chunk_size
+        self._append({"chunk_size": chunk_size})
+    
+    def add_chunks(self, entries):
+        self.chunks.extend(entries)
+        self._append({"chunks": entries})
+    
+    def finish(self, text_hash):
+        self.text_hash = text_hash
+        self.complete = True
+        self._append({"complete": True, "text_hash": text_hash})
+        self.close()
+    
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+    
+    def done_chunks(self):
+        """Fragmentos con MP3 en disco, como {índice: clave}."""
+        return {idx: key for idx, (key, _, _) in enumerate(self.chunks)
+                if os.path.exists(segment_path(self.task_id, idx))}
+    
+    def text_intact(self):
+        """True si el texto extraído y su índice siguen en disco y coinciden con el manifiesto."""
+        text_filename, chunks_filename, index_filename = text_store_paths(self.task_id)
+        if not self.complete or not os.path.exists(index_filename):
+            return False
+        try:
+            if self.chunks and os.path.getsize(chunks_filename) < self.chunks[-1][2]:
+                return False
+            text_hash = hashlib.sha256()
+            with open(text_filename, "rb") as f:
+                for block in iter(lambda: f.read(STREAM_BLOCK_SIZE), b""):
+                    text_hash.update(block)
+        except OSError:
+            return False
+        return text_hash.hexdigest() == self.text_hash
+    
+    def iter_chunk_batches(self, batch_size=RESUME_BATCH_CHUNKS):
+        """Vuelve a leer los fragmentos registrados, por lotes, sin extraer el documento otra vez."""
+        chunks_filename = text_store_paths(self.task_id)[1]
+        with open(chunks_filename, "rb") as f:
+            for i in range(0, len(self.chunks), batch_size):
+                batch = []
+                for _, start, end in self.chunks[i:i + batch_size]:
+                    f.seek(start)
+                    batch.append(f.read(end - start).decode("utf-8"))
+                yield batch
+
+def build_audio_manifest(task_id, audio_files):
+    """
+    Crea el archivo virtual de una tarea sin copiar audio: un frame Info/Xing guardado aparte
+    y la lista ordenada de rangos de frames de cada fragmento, en segments/{task_id}/manifest.json.
+    Si algún fragmento no se puede analizar, el manifiesto usa los archivos completos.
+    """
+    segments_dir = task_segments_dir(task_id)
+    try:
+        xing_frame, segments, duration = plan_audio_segments(audio_files)
+        if xing_frame:
+            header_path = os.path.join(segments_dir, "header.mp3")
+            with open(header_path, "wb") as f:
+                f.write(xing_frame)
+            segments.insert(0, [header_path, 0, len(xing_frame)])
     except Exception as e:
-        print(f"Error general en text-to-speech: {str(e)}")
+        print(f"Error al analizar los fragmentos de audio: {str(e)}")
         traceback.print_exc()
-        # Crear archivo vacío para evitar errores
-        with open(output_filename, 'wb') as f:
-            f.write(b'')
+        xing_frame = b""
+        duration = None
+        segments = [[f, 0, os.path.getsize(f)] for f in audio_files
+                    if os.path.exists(f) and os.path.getsize(f) > 0]
+    
+    manifest = {
+        "segments": segments,
+        "size": sum(length for _, _, length in segments),
+        "header_bytes": len(xing_frame),
+        "duration": duration
+    }
+    write_audio_manifest(task_id, manifest)
+    return manifest
 
+def write_audio_manifest(task_id, manifest):
+    # Escritura atómica: un lector nunca ve un manifiesto a medias
+    manifest_path = os.path.join(task_segments_dir(task_id), "manifest.json")
+    with open(f"{manifest_path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
 
-def concatenate_audio_files_simple(input_files, output_file):
-    """Versión simplificada de concatenación de archivos para diagnóstico."""
-    with open(output_file, 'wb') as outfile:
-        for fname in input_files:
-            if os.path.exists(fname) and os.path.getsize(fname) > 0:
-                with open(fname, 'rb') as infile:
-                    outfile.write(infile.read())
-                    
-def fallback_concatenate(input_files, output_file):
-    """Método de último recurso para concatenar archivos."""
-    # Simplemente copiar el primer archivo si existe
-    for file in input_files:
-        if os.path.exists(file) and os.path.getsize(file) > 0:
-            shutil.copy2(file, output_file)
-            print(f"Método de reserva: copiando {file} a {output_file}")
-            return
-            
-    # Si no hay archivos, crear uno vacío
-    with open(output_file, 'wb') as f:
-        f.write(b'')
+def link_task_outputs(source_id, task_id):
+    """
+    Da a task_id el audio y el texto de otra tarea terminada con enlaces (hardlinks), sin copiar
+    bytes: cada tarea conserva sus archivos aunque la otra se limpie antes. False si faltan archivos.
+    """
+    target_dir = task_segments_dir(task_id)
+    try:
+        with open(os.path.join(task_segments_dir(source_id), "manifest.json"), encoding="utf-8") as f:
+            manifest = json.load(f)
+        os.makedirs(target_dir, exist_ok=True)
+        for segment in manifest["segments"]:
+            target = os.path.join(target_dir, os.path.basename(segment[0]))
+            if not os.path.exists(target):
+                link_or_copy(segment[0], target)
+            segment[0] = target
+        for source, target in zip(text_store_paths(source_id), text_store_paths(task_id)):
+            link_or_copy(source, target)
+        write_audio_manifest(task_id, manifest)
+    except (OSError, ValueError, KeyError):
+        # La otra tarea se limpió mientras tanto
+        remove_task_segments(task_id)
+        remove_task_text(task_id)
+        return False
+    return True
+
+def load_audio_manifest(task_id):
+    """Lee el manifiesto de una tarea y añade el desplazamiento de cada segmento en el archivo virtual."""
+    with open(os.path.join(task_segments_dir(task_id), "manifest.json"), encoding="utf-8") as f:
+        manifest = json.load(f)
+    offsets = []
+    position = 0
+    for _, _, length in manifest["segments"]:
+        offsets.append(position)
+        position += length
+    manifest["offsets"] = offsets
+    return manifest
+
+def iter_manifest_bytes(manifest, start, end):
+    """Genera los bytes [start, end) del archivo virtual leyendo solo los segmentos que los contienen."""
+    segments = manifest["segments"]
+    idx = max(0, bisect.bisect_right(manifest["offsets"], start) - 1)
+    position = start
+    while position < end and idx < len(segments):
+        path, segment_start, length = segments[idx]
+        offset_in_segment = position - manifest["offsets"][idx]
+        remaining = min(length - offset_in_segment, end - position)
+        with open(path, "rb") as f:
+            f.seek(segment_start + offset_in_segment)
+            while remaining > 0:
+                block = f.read(min(STREAM_BLOCK_SIZE, remaining))
+                if not block:
+                    return  # Segmento truncado: no inventar bytes
+                position += len(block)
+                remaining -= len(block)
+                yield block
+        idx += 1
 
 def cleanup_temp_files(file_paths):
     """Elimina archivos temporales de forma segura."""
@@ -753,94 +3683,173 @@ def cleanup_temp_files(file_paths):
                 pass
 
 def process_chunks_parallel(text_chunks, task_id, lang: str = "es"):
-    audio_files = []
+    """Sintetiza una lista de fragmentos ya conocida y devuelve los archivos de audio en orden."""
+    return process_chunk_stream([text_chunks], task_id, lang=lang)
+
+def process_chunk_stream(chunk_batches, task_id, lang: str = "es", extract_progress=None, done_keys=None):
+    """
+    Sintetiza fragmentos a medida que llegan por lotes (una búsqueda en el caché por lote) y
+    devuelve los archivos de audio en orden. extract_progress() devuelve la fracción del
+    documento ya extraída, para combinarla con los fragmentos terminados en el progreso.
+    done_keys ({índice: clave}) son los fragmentos con audio de una ejecución anterior: se
+    reutilizan si la clave coincide con la del fragmento en esa posición.
+    """
+    done_keys = done_keys or {}
+    hit_keys = []
+    futures = []
+    counts = {"submitted": 0, "done": 0, "resumed": 0}
+    counts_lock = threading.Lock()
+    ready = []
+    progress_state = {"segments_ready": 0}
+    start_time = (task_store.get(task_id) or {}).get("start_time", time.time())
+    os.makedirs(task_segments_dir(task_id), exist_ok=True)
     
-    def process_chunk(chunk_data):
-        idx, chunk = chunk_data
-        chunk_filename = f"temp/chunk_{task_id}_{idx}.mp3"
-        
-        # Calcular hash y buscar en caché (sin cambios)
-        chunk_hash = hashlib.md5(chunk.encode('utf-8')).hexdigest()
-        cached_path = get_cached_audio_path(chunk_hash)
-        # Buscar en caché
-        if cached_path and os.path.exists(cached_path):
-        # Si existe en caché, copiar el archivo
-            shutil.copy2(cached_path, chunk_filename)
-        else:
-            # Buscar fragmentos similares en el árbol
-            similar_chunks = text_chunk_tree.find_similar_chunks(chunk)
-            if similar_chunks:
-                # Usar el fragmento más similar que ya tenga audio
-                most_similar = max(similar_chunks, key=lambda x: x[1])
-                similar_id, similarity = most_similar
-                similar_path = f"temp/chunk_{similar_id}.mp3"
-                if os.path.exists(similar_path) and similarity > 0.9:
-                    shutil.copy2(similar_path, chunk_filename)
-                else:
-                    # Convertir a voz
-                    # Almacenar en caché
-                    text_to_speech_optimized(chunk, chunk_filename, lang=lang)
-                    store_in_cache(chunk, chunk_filename)
+    def mark_ready(idx):
+        # segments_ready = fragmentos consecutivos ya disponibles desde el principio
+        with counts_lock:
+            ready.extend([False] * (idx + 1 - len(ready)))
+            ready[idx] = True
+            segments_ready = progress_state["segments_ready"]
+            while segments_ready < len(ready) and ready[segments_ready]:
+                segments_ready += 1
+            if segments_ready != progress_state["segments_ready"]:
+                progress_state["segments_ready"] = segments_ready
+                update_task(task_id, segments_ready=segments_ready)
+    
+    def update_progress():
+        extracted = extract_progress() if extract_progress else 1.0
+        with counts_lock:
+            synthesized = counts["done"] / counts["submitted"] if counts["submitted"] else 0.0
+            done = counts["done"]
+        # Extracción entre 5 y 30; la síntesis llena hasta 90 según lo extraído hasta ahora
+        update_task(task_id, progress=5 + 25 * extracted + 60 * extracted * synthesized, chunks_done=done)
+    
+    def process_chunk(idx, chunk, chunk_key, cached_path):
+        chunk_filename = segment_path(task_id, idx)
+        try:
+            if done_keys.get(idx) == chunk_key and os.path.exists(chunk_filename):
+                # Ya sintetizado en una ejecución anterior del trabajo
+                with counts_lock:
+                    counts["resumed"] += 1
             else:
-                text_to_speech_optimized(chunk, chunk_filename, lang=lang)
-                store_in_cache(chunk, chunk_filename)
-                # Añadir al árbol
-                text_chunk_tree.add_chunk(chunk, f"{task_id}_{idx}")
+                if idx in done_keys:
+                    # Audio de otro texto en esta posición: el documento se dividió de otra forma
+                    cleanup_temp_files([chunk_filename])
+                synthesize_chunk(chunk, chunk_key, cached_path, chunk_filename)
+            mark_ready(idx)
+            return chunk_filename
+        finally:
+            with counts_lock:
+                counts["done"] += 1
+            if idx == 0:
+                # Tiempo hasta que el primer fragmento de audio está disponible
+                update_task(task_id, time_to_first_audio=time.time() - start_time)
+            update_progress()
+    
+    def synthesize_chunk(chunk, chunk_key, cached_path, chunk_filename):
+        # Buscar en el almacén direccionado por contenido (clave = idioma + texto)
+        if cached_path and os.path.exists(cached_path):
+            # Si existe en caché, enlazar el archivo en lugar de copiarlo
+            record_cache_lookup(True, task_id)
+            hit_keys.append(chunk_key)
+            link_or_copy(cached_path, chunk_filename)
+            return chunk_filename
+        if cached_path:
+            # El archivo ya no existe: descartar la entrada en memoria
+            memory_cache.invalidate(chunk_key)
+        
+        record_cache_lookup(False, task_id)
+        # Buscar un fragmento casi igual del mismo idioma que ya tenga audio; su audio solo se
+        # reutiliza con SIMILARITY_REUSE_AUDIO, porque no dice exactamente el texto de este
+        signature = similarity_index.signature(chunk)
+        similar = similarity_index.find_similar(signature, lang)
+        for similar_key, _ in (similar if SIMILARITY_REUSE_AUDIO else []):
+            similar_path = audio_store_path(similar_key)
+            if os.path.exists(similar_path):
+                hit_keys.append(similar_key)
+                link_or_copy(similar_path, chunk_filename)
+                return chunk_filename
+            similarity_index.discard_many([similar_key])
         
+        # Convertir a voz y guardar en el almacén; si otra tarea está sintetizando el mismo
+        # fragmento en este momento, esperar su resultado en lugar de repetir la petición
+        store_path, _ = synthesis_flight.do(
+            chunk_key, synthesize_to_store, chunk, lang, f"{chunk_filename}.tmp", signature
+        )
+        if store_path is None:
+            # Fragmento sin texto: no se almacena en caché
+            open(chunk_filename, 'wb').close()
+            return chunk_filename
+        link_or_copy(store_path, chunk_filename)
         return chunk_filename
     
-    # Procesar fragmentos en paralelo
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        chunk_data = [(i, chunk) for i, chunk in enumerate(text_chunks)]
-        # Procesar por lotes para evitar sobrecargar la memoria
-        batch_size = 10
-        total_chunks = len(chunk_data)
-        audio_files = []
+    try:
+        # Enviar cada lote al pool compartido de síntesis en cuanto está disponible
+        for batch in chunk_batches:
+            chunk_keys = [chunk_cache_key(chunk, lang) for chunk in batch]
+            cached_paths = lookup_cached_audio_paths(chunk_keys)
+            with counts_lock:
+                counts["submitted"] += len(batch)
+            for chunk, chunk_key in zip(batch, chunk_keys):
+                futures.append(chunk_scheduler.submit(
+                    task_id, len(chunk), process_chunk, len(futures), chunk, chunk_key, cached_paths.get(chunk_key)
+                ))
+            update_progress()
         
-        for i in range(0, total_chunks, batch_size):
-            batch = chunk_data[i:min(i+batch_size, total_chunks)]
-            batch_results = list(executor.map(process_chunk, batch))
-            audio_files.extend(batch_results)
-            # Actualizar progreso
-            progress = 40 + (50 * min(i + batch_size, total_chunks) / total_chunks)
-            task_status[task_id]["progress"] = progress
+        audio_files = [future.result() for future in futures]
+    except Exception:
+        # No seguir sintetizando fragmentos de una tarea que ya ha fallado; los terminados se
+        # conservan para reanudarla
+        for future in futures:
+            future.cancel()
+        concurrent.futures.wait(futures)
+        raise
+    finally:
+        # Actualizar las estadísticas de uso de los aciertos en una sola transacción
+        cache_repository.touch_many(hit_keys)
+        chunk_latency = chunk_scheduler.finish_task(task_id)
     
+    update_task(task_id, chunks_total=len(audio_files), chunks_resumed=counts["resumed"], chunk_latency=chunk_latency)
     return audio_files
 
 
 # Limpieza periódica mejorada
 def cleanup_thread():
     """Función para limpiar periódicamente las tareas y archivos antiguos."""
+    cycles = 0
+    # Reparar el caché al arrancar por si el proceso anterior terminó de forma abrupta
+    try:
+        run_cache_maintenance()
+    except Exception as e:
+        print(f"Error en el mantenimiento inicial del caché: {str(e)}")
+    # Cargar las firmas de fragmentos casi iguales guardadas con el caché (en segundo plano)
+    try:
+        print(f"Índice de fragmentos similares: {similarity_index.load(cache_repository)} firmas cargadas")
+    except Exception as e:
+        print(f"Error al cargar el índice de fragmentos similares: {str(e)}")
+    
     while True:
         try:
             current_time = time.time()
-            to_delete = []
-            
-            # Hacer una copia del diccionario para evitar errores
-            tasks_copy = task_status.copy()
             
-            for task_id, task_info in tasks_copy.items():
-                # Limpiar tareas completadas después de 1 hora
-                if task_info["status"] in ["completed", "error"]:
-                    if "completion_time" in task_info and (current_time - task_info["completion_time"]) > 3600:
-                        to_delete.append(task_id)
-            
-            # Eliminar tareas antiguas
-            for task_id in to_delete:
-                if task_id in task_status:
-                    del task_status[task_id]
+            # Limpiar tareas terminadas o fallidas después de TASK_RETENTION segundos
+            for task_id in task_store.finished_before(current_time - TASK_RETENTION):
+                task = task_store.get(task_id) or {}
+                task_store.delete(task_id)
+                task_events.forget(task_id)
+                if task.get("file_hash") and task.get("lang"):
+                    task_store.release_document(document_key(task["file_hash"], task["lang"]), task_id)
                 
-                # Eliminar archivos de texto asociados
-                text_file = f"temp/text_{task_id}.txt"
-                if os.path.exists(text_file):
-                    try:
-                        os.remove(text_file)
-                    except:
-                        pass
+                # Eliminar el audio (enlaces y manifiestos), el texto y el archivo que se conservaba para reintentar
+                remove_task_segments(task_id)
+                remove_task_text(task_id)
+                if task.get("file_path"):
+                    cleanup_temp_files([task["file_path"]])
             
-            # Limpieza de caché periódica (cada 5 ejecuciones)
-            if time.time() % 5 == 0:
-                clean_old_cache()
+            # Mantenimiento periódico del caché (cada CACHE_MAINTENANCE_EVERY ejecuciones)
+            cycles += 1
+            if cycles % CACHE_MAINTENANCE_EVERY == 0:
+                run_cache_maintenance()
             
             # Dormir durante 5 minutos
             time.sleep(300)
@@ -852,6 +3861,12 @@ def cleanup_thread():
 @app.on_event("startup")
 def startup_event():
     """Iniciar el hilo de limpieza al arrancar la aplicación."""
+    # Reanudar las tareas de un proceso anterior que no terminaron
+    try:
+        recover_interrupted_tasks()
+    except Exception as e:
+        print(f"Error al revisar las tareas interrumpidas: {str(e)}")
+    
     cleanup_thread_instance = threading.Thread(target=cleanup_thread)
     cleanup_thread_instance.daemon = True
     cleanup_thread_instance.start()
\ No newline at end of file
@@ -0,0 +1,351 @@
+"""
+Extracción del texto de los documentos (PDF y DOCX).
+
+Este módulo es lo único que importan los procesos de extracción (ver ParserPool en main.py):
+no abre bases de datos ni crea la aplicación, así que cada proceso arranca rápido y solo carga
+pdfminer y python-docx bajo su límite de memoria.
+"""
+import os
+import math
+import time
+import signal
+import inspect
+import traceback
+from pdfminer.high_level import extract_text
+from docx import Document
+try:
+    import resource  # Límite de memoria de los procesos de extracción (solo Unix)
+except ImportError:
+    resource = None
+
+# Extracción de DOCX: el texto se entrega por partes, una por cada bloque de este tamaño del XML (descomprimido)
+DOCX_PIECE_BYTES = 1024 * 1024
+
+def parser_worker_main(conn, max_memory):
+    """
+    Bucle de un proceso de extracción: recibe (función, argumentos, CPU disponible) y envía cada
+    elemento si la función es un generador, o su resultado, y al final ("done", CPU usada).
+    Cada tarea arranca un temporizador de CPU (ITIMER_PROF) con la que ha reservado en el
+    documento: al agotarla el sistema termina el proceso con SIGPROF. Se usa en vez de RLIMIT_CPU
+    porque este cuenta en segundos enteros y cada tarea podría pasarse casi un segundo.
+    """
+    if resource:
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory, resource.getrlimit(resource.RLIMIT_AS)[1]))
+    while True:
+        try:
+            func, args, cpu_seconds = conn.recv()
+        except EOFError:
+            return
+        start_cpu = time.process_time()
+        if hasattr(signal, "setitimer"):
+            signal.setitimer(signal.ITIMER_PROF, max(cpu_seconds, 0.01))
+        try:
+            result = func(*args)
+            for item in (result if inspect.isgenerator(result) else [result]):
+                conn.send(("item", item))
+            message = ("done", None)
+        except MemoryError:
+            message = ("memory", None)
+        except Exception as e:
+            message = ("error", f"{type(e).__name__}: {str(e)}")
+        if hasattr(signal, "setitimer"):
+            signal.setitimer(signal.ITIMER_PROF, 0)
+        conn.send((*message, time.process_time() - start_cpu))
+
+def count_pdf_pages(pdf_path):
+    """Cuenta las páginas de un PDF sin analizar su contenido."""
+    from pdfminer.pdfpage import PDFPage
+    with open(pdf_path, 'rb') as fp:
+        return sum(1 for _ in PDFPage.get_pages(fp))
+
+def extract_pdf_pages(pdf_path, page_numbers):
+    """
+    Extrae el texto de un grupo de páginas (se ejecuta en el pool de procesos).
+    El archivo se analiza una sola vez por grupo; si una página falla, solo esa página se
+    reintenta sin parámetros de layout. Devuelve la lista de textos en el mismo orden.
+    """
+    from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+    from pdfminer.converter import TextConverter
+    from pdfminer.pdfpage import PDFPage
+    from pdfminer.layout import LAParams
+    from io import StringIO
+    
+    page_numbers = sorted(page_numbers)
+    texts = {}
+    try:
+        resource_manager = PDFResourceManager(caching=True)
+        with open(pdf_path, 'rb') as fp:
+            pages = PDFPage.get_pages(fp, pagenos=set(page_numbers))
+            for page_number, page in zip(page_numbers, pages):
+                output = StringIO()
+                device = TextConverter(resource_manager, output, laparams=LAParams())
+                try:
+                    PDFPageInterpreter(resource_manager, device).process_page(page)
+                    texts[page_number] = output.getvalue()
+                except Exception as e:
+                    print(f"Error al extraer la página {page_number + 1}: {str(e)}")
+                finally:
+                    device.close()
+    except Exception as e:
+        print(f"Error al recorrer las páginas {page_numbers[0] + 1}-{page_numbers[-1] + 1}: {str(e)}")
+    
+    # Reintentar de forma individual las páginas que fallaron
+    for page_number in page_numbers:
+        if page_number in texts:
+            continue
+        try:
+            texts[page_number] = extract_text(pdf_path, page_numbers=[page_number], laparams=None)
+        except Exception as e:
+            print(f"Segundo intento de la página {page_number + 1} falló: {str(e)}")
+            texts[page_number] = ""
+    
+    return [texts[page_number] for page_number in page_numbers]
+
+def extract_text_from_pdf_whole(pdf_path: str) -> str:
+    """Extrae el texto del PDF completo de una vez; se usa si no se pueden recorrer sus páginas."""
+    try:
+        # Intentar con parámetros más básicos primero
+        try:
+            text = extract_text(pdf_path, page_numbers=None, maxpages=0)
+            if text.strip():
+                return text
+        except Exception as e:
+            print(f"Primer intento de extracción de PDF falló: {str(e)}")
+        
+        # Si falló, intentar con configuración alternativa
+        text = extract_text(
+            pdf_path, 
+            page_numbers=None, 
+            maxpages=0, 
+            laparams=None  # Sin parámetros de layout
+        )
+        return text
+    except Exception as e:
+        print(f"Error al extraer texto de PDF completo: {str(e)}")
+        traceback.print_exc()
+        return "No se pudo extraer texto del PDF. Por favor, verifique que el archivo no esté protegido o dañado."
+
+# Elementos de word/document.xml que interesan al leerlo en streaming
+WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+DOCX_PARAGRAPH = WORD_NAMESPACE + "p"
+DOCX_TEXT = WORD_NAMESPACE + "t"
+DOCX_TAB = WORD_NAMESPACE + "tab"
+DOCX_BREAKS = (WORD_NAMESPACE + "br", WORD_NAMESPACE + "cr")
+DOCX_TABLE_ROW = WORD_NAMESPACE + "tr"
+DOCX_TABLE_CELL = WORD_NAMESPACE + "tc"
+DOCX_BODY = WORD_NAMESPACE + "body"
+# Contenido alternativo para lectores antiguos: repite el texto de cuadros de texto y formas
+DOCX_FALLBACK = "{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback"
+
+def iter_docx_blocks(stream):
+    """
+    Genera en orden del documento el texto de cada párrafo y de cada fila de tabla (celdas no vacías
+    unidas con " | ") leyendo word/document.xml con iterparse. Cada párrafo, celda y fila se libera al
+    terminar, así la memoria no depende del tamaño del documento. Una celda combinada aparece una
+    sola vez: el XML la guarda una vez y sus continuaciones (vMerge) están vacías.
+    """
+    from xml.etree.ElementTree import iterparse
+    # Pilas de párrafos (partes de texto), celdas (párrafos) y filas (celdas) abiertos
+    paragraphs = []
+    cells = []
+    rows = []
+    fallback_depth = 0
+    body = None
+    for event, elem in iterparse(stream, events=("start", "end")):
+        tag = elem.tag
+        if tag == DOCX_FALLBACK:
+            fallback_depth += 1 if event == "start" else -1
+            continue
+        if fallback_depth:
+            continue
+        if event == "start":
+            if tag == DOCX_PARAGRAPH:
+                paragraphs.append([])
+            elif tag == DOCX_TABLE_CELL:
+                cells.append([])
+            elif tag == DOCX_TABLE_ROW:
+                rows.append([])
+            elif tag == DOCX_BODY:
+                body = elem
+            continue
+        
+        if not paragraphs and not cells and not rows:
+            continue  # Fuera de párrafos y tablas (propiedades de sección, etc.)
+        if tag == DOCX_TEXT:
+            if paragraphs and elem.text:
+                paragraphs[-1].append(elem.text)
+        elif tag == DOCX_TAB:
+            if paragraphs:
+                paragraphs[-1].append("\t")
+        elif tag in DOCX_BREAKS:
+            if paragraphs:
+                paragraphs[-1].append("\n")
+        elif tag == DOCX_PARAGRAPH:
+            text = "".join(paragraphs.pop())
+            elem.clear()
+            if not text.strip():
+                pass
+            elif cells and not paragraphs:
+                cells[-1].append(text)
+            else:
+                # Párrafo del cuerpo, o de un cuadro de texto dentro de otro párrafo
+                yield text
+        elif tag == DOCX_TABLE_CELL:
+            text = "\n".join(cells.pop())
+            elem.clear()
+            if text and rows:
+                rows[-1].append(text)
+        elif tag == DOCX_TABLE_ROW:
+            text = " | ".join(rows.pop())
+            elem.clear()
+            if not text:
+                pass
+            elif cells:
+                cells[-1].append(text)  # Fila de una tabla anidada: forma parte de la celda exterior
+            else:
+                yield text
+        # Bloque de primer nivel terminado: el cuerpo no necesita conservar los elementos ya leídos
+        if body is not None and not paragraphs and not cells and not rows:
+            body.clear()
+
+def iter_docx_text(docx_path, progress_callback=None):
+    """
+    Genera el texto de un DOCX por partes a medida que se lee (un párrafo o fila de tabla por línea).
+    Cada parte corresponde a unos DOCX_PIECE_BYTES del XML; progress_callback(partes_hechas,
+    partes_estimadas) se llama al entregar cada una. Si el XML no se puede leer desde el principio,
+    se usa python-docx (extract_text_from_docx_optimized).
+    """
+    import zipfile
+    pieces_done = 0
+    try:
+        with zipfile.ZipFile(docx_path) as docx, docx.open("word/document.xml") as stream:
+            pieces_total = max(1, math.ceil(docx.getinfo("word/document.xml").file_size / DOCX_PIECE_BYTES))
+            lines = []
+            for block in iter_docx_blocks(stream):
+                lines.append(f"{block}\n")
+                position = min(pieces_total - 1, stream.tell() // DOCX_PIECE_BYTES)
+                if position > pieces_done:
+                    pieces_done = position
+                    if progress_callback:
+                        progress_callback(pieces_done, pieces_total)
+                    yield "".join(lines)
+                    lines = []
+    except Exception as e:
+        if pieces_done:
+            raise
+        print(f"No se pudo leer el XML del DOCX en streaming, se usa python-docx: {str(e)}")
+        yield extract_text_from_docx_optimized(docx_path)
+        if progress_callback:
+            progress_callback(1, 1)
+        return
+    if progress_callback:
+        progress_callback(pieces_total, pieces_total)
+    yield "".join(lines)
+
+def extract_text_from_docx_optimized(docx_path: str) -> str:
+    """Extrae el texto de un archivo DOCX con python-docx (se usa si no se puede leer su XML en streaming)."""
+    try:
+        print(f"Intentando extraer texto de DOCX: {docx_path}")
+        
+        # Verificar si el archivo existe y tiene contenido
+        if not os.path.exists(docx_path):
+            print(f"Error: El archivo DOCX no existe: {docx_path}")
+            return ""
+            
+        if os.path.getsize(docx_path) == 0:
+            print(f"Error: El archivo DOCX está vacío: {docx_path}")
+            return ""
+        
+        # Intentar abrir el documento
+        try:
+            doc = Document(docx_path)
+        except Exception as e:
+            print(f"Error al abrir DOCX con python-docx: {str(e)}")
+            # Intentar método alternativo
+            return extract_docx_fallback(docx_path)
+        
+        text_parts = []
+        
+        # Extraer texto de párrafos
+        try:
+            for para in doc.paragraphs:
+                if para.text.strip():
+                    text_parts.append(para.text)
+        except Exception as e:
+            print(f"Error al extraer párrafos: {str(e)}")
+        
+        # Extraer texto de tablas
+        try:
+            for table in doc.tables:
+                # Una celda combinada se repite en cada columna y fila que ocupa: leerla una vez
+                seen_cells = set()
+                for row in table.rows:
+                    row_text = []
+                    for cell in row.cells:
+                        if cell._tc in seen_cells:
+                            continue
+                        seen_cells.add(cell._tc)
+                        if cell.text.strip():
+                            row_text.append(cell.text)
+                    if row_text:
+                        text_parts.append(" | ".join(row_text))
+        except Exception as e:
+            print(f"Error al extraer tablas: {str(e)}")
+        
+        result = "\n".join(text_parts)
+        
+        # Si no se extrajo nada, probar método alternativo
+        if not result.strip():
+            print("No se extrajo texto con python-docx, intentando método alternativo")
+            return extract_docx_fallback(docx_path)
+            
+        return result
+        
+    except Exception as e:
+        print(f"Error al extraer texto de DOCX (general): {str(e)}")
+        traceback.print_exc()  # Imprimir traza completa para diagnóstico
+        return "No se pudo extraer texto del DOCX. Por favor, verifique que el archivo no esté protegido o dañado."
+
+def extract_docx_fallback(docx_path):
+    """Método alternativo para extraer texto de DOCX usando zipfile."""
+    try:
+        print("Usando método alternativo para DOCX con zipfile")
+        import zipfile
+        from xml.etree.ElementTree import XML
+        
+        # Definir NAMESPACE
+        NAMESPACE = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+        PARA = NAMESPACE + 'p'
+        TEXT = NAMESPACE + 't'
+        
+        # Abrir el archivo como un zip
+        with zipfile.ZipFile(docx_path) as docx:
+            # Extraer document.xml que contiene el contenido
+            try:
+                content = docx.read('word/document.xml')
+            except KeyError:
+                print("No se pudo encontrar 'word/document.xml' en el archivo DOCX")
+                return ""
+                
+            # Analizar el XML
+            tree = XML(content)
+            
+            # Extraer párrafos
+            paragraphs = []
+            for paragraph in tree.iter(PARA):
+                texts = [node.text for node in paragraph.iter(TEXT) if node.text]
+                if texts:
+                    paragraphs.append(''.join(texts))
+                    
+            return '\n'.join(paragraphs)
+    except Exception as e:
+        print(f"Error en método alternativo DOCX: {str(e)}")
+        return ""
+
+def iter_docx_pieces(docx_path):
+    """Partes del DOCX con su progreso, (texto, hechas, estimadas); se ejecuta en un proceso de extracción."""
+    progress = [0, 1]
+    def report(pieces_done, pieces_total):
+        progress[:] = [pieces_done, pieces_total]
+    for piece in iter_docx_text(docx_path, report):
+        yield piece, progress[0], progress[1]